@@ -9,8 +9,24 @@ https://docs.djangoproject.com/en/5.2/howto/deployment/asgi/
 
 import os
 
+from django.conf import settings
+from django.contrib.staticfiles.handlers import ASGIStaticFilesHandler
 from django.core.asgi import get_asgi_application
 
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'config.settings')
 
-application = get_asgi_application()
+django_application = get_asgi_application()
+
+from photos.streaming import STREAM_PATH, streaming_upload_app  # noqa: E402 (needs the apps loaded)
+
+
+async def application(scope, receive, send):
+    # The pipelined upload reads the request body itself; Django would receive all of it before the view
+    if scope['type'] == 'http' and scope['path'] == STREAM_PATH:
+        return await streaming_upload_app(scope, receive, send)
+    return await django_application(scope, receive, send)
+
+
+if settings.DEBUG:
+    # runserver serves static files itself, ASGI servers do not
+    django_application = ASGIStaticFilesHandler(django_application)
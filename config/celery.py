@@ -1,8 +1,14 @@
 import os
+import time
 import socket
 import logging
+import asyncio
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
 
 from celery import Celery
+from kombu import Queue
 
 
 logger = logging.getLogger(__name__)
@@ -13,8 +19,36 @@ app = Celery('config')
 app.config_from_object('django.conf:settings', namespace='CELERY')
 app.autodiscover_tasks()
 
+# CPU-bound processing and network-bound notifications are consumed by
+# separate workers (see compose.yaml): a prefork pool for "images" and a
+# threads pool for "notifications", so slow webhooks never occupy a
+# processing slot.
+IMAGES_QUEUE = 'images'
+NOTIFICATIONS_QUEUE = 'notifications'
 
-def check_celery_available(timeout=3) -> bool | None:
+app.conf.task_queues = (
+    Queue(IMAGES_QUEUE),
+    Queue(NOTIFICATIONS_QUEUE),
+)
+app.conf.task_default_queue = IMAGES_QUEUE
+app.conf.task_routes = {
+    'photos.tasks.image_task': {'queue': IMAGES_QUEUE},
+    'photos.tasks.image_batch_task': {'queue': IMAGES_QUEUE},
+    'photos.tasks.send_digest_task': {'queue': NOTIFICATIONS_QUEUE},
+    'photos.tasks.send_alert_task': {'queue': NOTIFICATIONS_QUEUE},
+}
+# Processing tasks take seconds: reserve one message per process and
+# acknowledge only after the task finished, so a busy process does not hold
+# messages an idle one could run and a killed worker's task is redelivered.
+# Notification workers raise the prefetch on the command line.
+app.conf.worker_prefetch_multiplier = 1
+app.conf.task_annotations = {
+    'photos.tasks.image_task': {'acks_late': True, 'reject_on_worker_lost': True},
+    'photos.tasks.image_batch_task': {'acks_late': True, 'reject_on_worker_lost': True},
+}
+
+
+def ping_workers(timeout=3) -> bool:
     """
     Check if Celery workers are available with a timeout
     Returns True if workers are available else raises exception
@@ -40,4 +74,107 @@ def check_celery_available(timeout=3) -> bool | None:
 
     except Exception as e:
         logger.exception("Celery check error: %s", str(e))
-        raise
\ No newline at end of file
+        raise
+
+
+class WorkerHealth:
+    """
+    Cached worker availability with circuit-breaker semantics.
+
+    A positive result is trusted for `ttl` seconds; after an outage the
+    breaker stays open for `reset_timeout` seconds and every check fails fast.
+    Once the state goes stale it is refreshed in a background thread while
+    requests keep reading the last known state, so only the very first check
+    waits for a ping.
+    """
+
+    def __init__(self, probe, ttl: float, reset_timeout: float):
+        self.probe = probe
+        self.ttl = ttl
+        self.reset_timeout = reset_timeout
+        self._lock = threading.Lock()
+        self._available = None
+        self._checked_at = 0.0
+        self._refreshing = False
+
+    def refresh(self):
+        try:
+            available = bool(self.probe())
+        except Exception:
+            available = False
+        with self._lock:
+            if available != self._available:
+                logger.info("Celery workers %s", "available" if available else "unavailable")
+            self._available = available
+            self._checked_at = time.monotonic()
+            self._refreshing = False
+
+    def _refresh_in_background(self):
+        with self._lock:
+            if self._refreshing:
+                return
+            self._refreshing = True
+        threading.Thread(target=self.refresh, name="celery-health", daemon=True).start()
+
+    def check(self) -> bool:
+        with self._lock:
+            available, checked_at = self._available, self._checked_at
+
+        if available is None:
+            self.refresh()
+            available = self._available
+        else:
+            max_age = self.ttl if available else self.reset_timeout
+            if time.monotonic() - checked_at >= max_age:
+                self._refresh_in_background()
+
+        if not available:
+            raise ConnectionError("Celery server unavailable")
+        return True
+
+
+_worker_health = None
+
+
+def check_celery_available(timeout=3) -> bool | None:
+    """
+    Check if Celery workers are available using the cached worker state
+    Returns True if workers are available else raises ConnectionError
+    """
+    global _worker_health
+    if _worker_health is None:
+        from django.conf import settings
+
+        _worker_health = WorkerHealth(
+            probe=lambda: ping_workers(timeout=timeout),
+            ttl=settings.WORKER_HEALTH_TTL,
+            reset_timeout=settings.WORKER_HEALTH_RESET_TIMEOUT,
+        )
+    return _worker_health.check()
+
+
+_broker_executor = None
+_broker_executor_lock = threading.Lock()
+
+
+def broker_executor() -> ThreadPoolExecutor:
+    """
+    Threads for blocking kombu calls made from async views.
+
+    One thread per connection of the producer pool (broker_pool_limit), so
+    publishes never queue for a connection inside a thread, and a burst of
+    uploads cannot grow the number of threads of the web process.
+    """
+    global _broker_executor
+    with _broker_executor_lock:
+        if _broker_executor is None:
+            _broker_executor = ThreadPoolExecutor(
+                max_workers=app.conf.broker_pool_limit or 10, thread_name_prefix='broker',
+            )
+        return _broker_executor
+
+
+async def run_in_broker_executor(func, *args, **kwargs):
+    """Awaits a blocking broker call (publish, ping) running in broker_executor()."""
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(broker_executor(), partial(func, *args, **kwargs))
@@ -0,0 +1,43 @@
+"""
+Production app server: gunicorn, once per Compose web service.
+
+    gunicorn -c config/gunicorn.conf.py config.wsgi:application
+    GUNICORN_WORKER_CLASS=uvicorn.workers.UvicornWorker gunicorn -c config/gunicorn.conf.py config.asgi:application
+
+Sync views run in gthread workers: every worker process handles up to
+GUNICORN_THREADS requests at a time. Under ASGI Django runs all sync
+views of a worker in one shared thread, so the uvicorn workers only
+serve the async endpoints (nginx routes them, see config/nginx.conf),
+where one event loop per process keeps many uploads and SSE streams in
+flight. Either way CPU-bound request work scales across processes.
+"""
+
+import os
+import multiprocessing
+
+
+bind = os.getenv('GUNICORN_BIND', '0.0.0.0:8000')
+worker_class = os.getenv('GUNICORN_WORKER_CLASS', 'gthread')
+workers = int(os.getenv('WEB_CONCURRENCY', multiprocessing.cpu_count() * 2 + 1))
+# Concurrent sync requests per gthread worker; ignored by uvicorn workers
+threads = int(os.getenv('GUNICORN_THREADS', 8))
+
+# Large uploads on slow links take a while; SSE streams send keep-alives
+timeout = int(os.getenv('GUNICORN_TIMEOUT', 120))
+graceful_timeout = int(os.getenv('GUNICORN_GRACEFUL_TIMEOUT', 30))
+keepalive = int(os.getenv('GUNICORN_KEEPALIVE', 5))
+
+# Workers are recycled now and then so leaks cannot accumulate; jitter keeps them from restarting at once
+max_requests = int(os.getenv('GUNICORN_MAX_REQUESTS', 10000))
+max_requests_jitter = int(os.getenv('GUNICORN_MAX_REQUESTS_JITTER', 1000))
+
+accesslog = '-'
+errorlog = '-'
+
+
+def child_exit(server, worker):
+    # Samples of a dead worker stay in PROMETHEUS_MULTIPROC_DIR; live gauges must be dropped
+    if 'PROMETHEUS_MULTIPROC_DIR' in os.environ:
+        from prometheus_client import multiprocess
+
+        multiprocess.mark_process_dead(worker.pid)
@@ -64,6 +64,8 @@ TEMPLATES = [
 
 WSGI_APPLICATION = 'config.wsgi.application'
 
+ASGI_APPLICATION = 'config.asgi.application'
+
 DATABASES = {
     "default": {
         "ENGINE": "django.db.backends.postgresql",
@@ -72,9 +74,55 @@ DATABASES = {
         "PASSWORD": os.getenv('POSTGRES_PASSWORD'),
         "HOST": os.getenv('POSTGRES_HOST', 'localhost'),
         "PORT": os.getenv('POSTGRES_PORT', 5432),
+        # Connections are kept open between requests/tasks and checked before reuse
+        "CONN_MAX_AGE": int(os.getenv('DATABASE_CONN_MAX_AGE', 60)),
+        "CONN_HEALTH_CHECKS": True,
+    }
+}
+
+# psycopg 3 connection pool per process. Needed under ASGI, where
+# persistent connections are not reused across requests; excludes CONN_MAX_AGE.
+if os.getenv('DATABASE_POOL') == '1':
+    DATABASES['default']['CONN_MAX_AGE'] = 0
+    DATABASES['default']['OPTIONS'] = {
+        'pool': {
+            'min_size': int(os.getenv('DATABASE_POOL_MIN_SIZE', 2)),
+            'max_size': int(os.getenv('DATABASE_POOL_MAX_SIZE', 10)),
+            'timeout': float(os.getenv('DATABASE_POOL_TIMEOUT', 10)),
+        },
     }
+
+# Локальный запуск без PostgreSQL (например, manage.py benchmark)
+if os.getenv('DATABASE_ENGINE') == 'sqlite':
+    DATABASES = {
+        "default": {
+            "ENGINE": "django.db.backends.sqlite3",
+            "NAME": os.getenv('SQLITE_PATH', os.path.join(BASE_DIR, 'db.sqlite3')),
+            "CONN_MAX_AGE": int(os.getenv('DATABASE_CONN_MAX_AGE', 60)),
+        }
+    }
+
+
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+    },
+    'results': {
+        'BACKEND': 'django.core.cache.backends.redis.RedisCache',
+        'LOCATION': os.getenv('RESULT_CACHE_URL', 'redis://localhost:6379/2'),
+    },
 }
 
+# Processing results by content hash; Redis evicts them by TTL/LRU (see compose.yaml)
+RESULT_CACHE_ALIAS = 'results'
+RESULT_CACHE_TTL = int(os.getenv('RESULT_CACHE_TTL', 7 * 24 * 3600))
+# Handler output kept for retries of a task, and the lock against concurrent
+# redelivery; the lock is renewed every TASK_LOCK_TTL/3 while the task runs, so
+# the lock of a killed worker is gone after TASK_LOCK_TTL (seconds)
+TASK_OUTPUT_TTL = int(os.getenv('TASK_OUTPUT_TTL', 3600))
+TASK_LOCK_TTL = int(os.getenv('TASK_LOCK_TTL', 60))
+TASK_LOCK_RETRY_DELAY = int(os.getenv('TASK_LOCK_RETRY_DELAY', 30))
+
 
 AUTH_PASSWORD_VALIDATORS = [
     {
@@ -99,6 +147,33 @@ USE_I18N = True
 
 USE_TZ = True
 
+MEDIA_URL = 'media/'
+MEDIA_ROOT = os.getenv('MEDIA_ROOT', os.path.join(BASE_DIR, 'media'))
+
+# Image uploads are validated and hashed while they are received (photos.uploadhandlers),
+# other uploads (admin) use Django's default handlers
+FILE_UPLOAD_HANDLERS = [
+    'photos.uploadhandlers.ValidatingUploadHandler',
+    'django.core.files.uploadhandler.MemoryFileUploadHandler',
+    'django.core.files.uploadhandler.TemporaryFileUploadHandler',
+]
+# Django's parser gives up on a body with more files than this. Kept above BATCH_MAX_COUNT
+# (photos/validators.py) so a batch that is slightly too large gets the upload views' 'count' error
+DATA_UPLOAD_MAX_NUMBER_FILES = int(os.getenv('DATA_UPLOAD_MAX_NUMBER_FILES', 200))
+
+# Uploaded originals, keyed by SHA-256; must be shared by web and worker containers
+BLOB_STORE_ROOT = os.getenv('BLOB_STORE_ROOT', os.path.join(MEDIA_ROOT, 'blobs'))
+# A request removes the blobs it created for rejected files unless a concurrent upload of the
+# same bytes pinned them; pins must outlive the longest upload request (seconds)
+BLOB_PIN_TTL = int(os.getenv('BLOB_PIN_TTL', 24 * 3600))
+
+# Resumable uploads (/api/uploads/, see photos.resumable): received parts are kept here until
+# finalized; must be on the same volume as BLOB_STORE_ROOT so finished files are moved, not copied.
+# Largest accepted chunk (bytes) and lifetime of a session that is never finalized (seconds)
+UPLOAD_SESSION_ROOT = os.getenv('UPLOAD_SESSION_ROOT', os.path.join(MEDIA_ROOT, 'uploads'))
+UPLOAD_CHUNK_MAX_SIZE = int(os.getenv('UPLOAD_CHUNK_MAX_SIZE', 8 * 1024 * 1024))
+UPLOAD_SESSION_TTL = int(os.getenv('UPLOAD_SESSION_TTL', 24 * 3600))
+
 STATIC_URL = 'static/'
 STATICFILES_DIRS = [
     os.path.join(BASE_DIR, 'static'),
@@ -113,13 +188,57 @@ CELERY_TASK_SERIALIZER = 'json'
 CELERY_RESULT_SERIALIZER = 'json'
 
 CELERY_BROKER_URL = os.getenv('CELERY_BROKER_URL', 'redis://localhost:6379/0')
+# Pooled broker connections per process; also the thread count of the executor
+# async views publish through (config.celery.broker_executor)
+CELERY_BROKER_POOL_LIMIT = int(os.getenv('CELERY_BROKER_POOL_LIMIT', 10))
 
 CELERY_RESULT_BACKEND = os.getenv('CELERY_RESULT_BACKEND', 'redis://localhost:6379/1')
 
 CELERY_STATE_DB = None
 
+# Results live in Redis only this long (seconds); later status requests are answered from ImageRecord
+CELERY_RESULT_EXPIRES = int(os.getenv('CELERY_RESULT_EXPIRES', 24 * 3600))
+
 CELERY_TIMEZONE = 'UTC'
 
+# Image processing function, see photos.handlers; it pre-renders webp variants of
+# IMAGE_VARIANT_SIZES (keep them among VARIANT_SIZES) into the /api/variants/ cache
+IMAGE_HANDLER = os.getenv('IMAGE_HANDLER', 'photos.handlers.pillow_image_handler')
+IMAGE_VARIANT_SIZES = (1024, 256)
+IMAGE_VARIANT_QUALITY = 80
+
+# On-demand resized copies served by /api/variants/ (see photos.variants):
+# allowed sizes, disk cap of the LRU cache (bytes) and browser cache lifetime (seconds)
+VARIANT_SIZES = tuple(int(size) for size in os.getenv('VARIANT_SIZES', '64,256,1024').split(','))
+VARIANT_CACHE_ROOT = os.getenv('VARIANT_CACHE_ROOT', os.path.join(MEDIA_ROOT, 'variant-cache'))
+VARIANT_CACHE_MAX_BYTES = int(os.getenv('VARIANT_CACHE_MAX_BYTES', 512 * 1024 * 1024))
+VARIANT_CACHE_MAX_AGE = int(os.getenv('VARIANT_CACHE_MAX_AGE', 365 * 24 * 3600))
+
+# Worker availability is pinged in the background and cached (seconds);
+# after an outage uploads fail fast until the next probe succeeds
+WORKER_HEALTH_TTL = float(os.getenv('WORKER_HEALTH_TTL', 10))
+WORKER_HEALTH_RESET_TIMEOUT = float(os.getenv('WORKER_HEALTH_RESET_TIMEOUT', 5))
+
+# "file" sends one image_task per uploaded file, "batch" sends the upload as
+# image_batch_task messages of UPLOAD_BATCH_CHUNK_SIZE files each
+UPLOAD_DISPATCH_MODE = os.getenv('UPLOAD_DISPATCH_MODE', 'file')
+UPLOAD_BATCH_CHUNK_SIZE = int(os.getenv('UPLOAD_BATCH_CHUNK_SIZE', 100))
+
+# ImageRecord inserts of concurrent tasks in a worker process are coalesced into
+# bulk_create flushes. "auto" does so only for threads/gevent/eventlet pools (a
+# prefork child runs one task at a time); 1 forces it on, 0 means one INSERT per record
+IMAGE_RECORD_BULK_CREATE = os.getenv('IMAGE_RECORD_BULK_CREATE', 'auto')
+IMAGE_RECORD_BATCH_SIZE = int(os.getenv('IMAGE_RECORD_BATCH_SIZE', 50))
+IMAGE_RECORD_FLUSH_INTERVAL = float(os.getenv('IMAGE_RECORD_FLUSH_INTERVAL', 0.05))
+
+# /api/images/ listing page size (default and maximum ?limit=)
+IMAGE_LIST_PAGE_SIZE = int(os.getenv('IMAGE_LIST_PAGE_SIZE', 50))
+IMAGE_LIST_MAX_PAGE_SIZE = int(os.getenv('IMAGE_LIST_MAX_PAGE_SIZE', 500))
+
+# Server-Sent Events stream of batch task states (seconds)
+BATCH_EVENTS_TIMEOUT = int(os.getenv('BATCH_EVENTS_TIMEOUT', 600))
+BATCH_EVENTS_KEEPALIVE = int(os.getenv('BATCH_EVENTS_KEEPALIVE', 15))
+
 DJANGO_LOG_FILE = os.getenv('DJANGO_LOG_FILE', os.path.join(BASE_DIR, 'logs', 'debug.log'))
 LOGGING = {
     'version': 1,
@@ -172,3 +291,20 @@ NOTIFICATION_BACKENDS = [
     "photos.notifications.slack_sender",
 ]
 
+
+# Уведомления: keep-alive пул соединений и дайджест по пакету загрузки
+NOTIFICATION_TIMEOUT = float(os.getenv('NOTIFICATION_TIMEOUT', 5))
+NOTIFICATION_POOL_SIZE = int(os.getenv('NOTIFICATION_POOL_SIZE', 10))
+NOTIFICATION_REDIS_URL = os.getenv('NOTIFICATION_REDIS_URL', 'redis://localhost:6379/3')
+NOTIFICATION_DIGEST_WINDOW = float(os.getenv('NOTIFICATION_DIGEST_WINDOW', 5))
+NOTIFICATION_MAX_LENGTH = int(os.getenv('NOTIFICATION_MAX_LENGTH', 4000))
+
+# Token bucket на бэкенд: (токенов в секунду, ёмкость). Telegram — около 1 сообщения
+# в секунду в один чат, Slack incoming webhook — 1 в секунду с короткими всплесками
+NOTIFICATION_RATE_LIMITS = {
+    "photos.notifications.telegram_sender": (float(os.getenv('TLG_RATE_LIMIT', 1)), 3),
+    "photos.notifications.slack_sender": (float(os.getenv('SLACK_RATE_LIMIT', 1)), 3),
+}
+NOTIFICATION_MAX_RETRIES = int(os.getenv('NOTIFICATION_MAX_RETRIES', 5))
+NOTIFICATION_BACKOFF_BASE = float(os.getenv('NOTIFICATION_BACKOFF_BASE', 2))
+NOTIFICATION_BACKOFF_MAX = float(os.getenv('NOTIFICATION_BACKOFF_MAX', 300))
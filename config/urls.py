@@ -3,9 +3,12 @@ from django.conf.urls.static import static
 from django.contrib import admin
 from django.urls import path, include
 
+from photos.views import MetricsView
+
 urlpatterns = [
     path('admin/', admin.site.urls),
-    path('api/', include('photos.urls'))
+    path('api/', include('photos.urls')),
+    path('metrics', MetricsView.as_view(), name='metrics'),
 
 ]
 if settings.DEBUG:
@@ -1,10 +1,18 @@
 from django.contrib import admin
 
-from photos.models import ImageRecord
+from photos.models import FailedNotification, ImageRecord
 
 
 class ImageRecordAdmin(admin.ModelAdmin):
-    pass
+    list_display = ('file_name', 'status', 'task_id', 'batch_id', 'created_at')
+    list_filter = ('status',)
+    search_fields = ('=task_id', '=batch_id', '=content_hash')
 
 
-admin.site.register(ImageRecord, ImageRecordAdmin)
\ No newline at end of file
+class FailedNotificationAdmin(admin.ModelAdmin):
+    list_display = ('backend', 'attempts', 'error', 'created_at')
+    list_filter = ('backend',)
+
+
+admin.site.register(ImageRecord, ImageRecordAdmin)
+admin.site.register(FailedNotification, FailedNotificationAdmin)
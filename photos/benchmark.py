@@ -0,0 +1,382 @@
+import io
+import os
+import json
+import time
+import random
+import tempfile
+import statistics
+import subprocess
+from contextlib import contextmanager, ExitStack
+from datetime import datetime, timezone
+
+from celery.backends.cache import CacheBackend
+from django.conf import settings
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.core.signals import request_finished, request_started
+from django.db import connection, transaction
+from django.db.backends.signals import connection_created
+from django.test import Client
+from django.test.utils import CaptureQueriesContext, override_settings
+from django.urls import reverse
+from kombu import pools
+from PIL import Image
+
+import config.celery as celery_config
+from config.celery import app, IMAGES_QUEUE, WorkerHealth
+from .status import batch_status
+from .variants import variant_cache
+
+
+LOCAL_BROKER_URL = 'memory://'
+STATUS_POLL_INTERVAL = 0.2
+
+# Metrics compared against the baseline run: (dotted path, higher is better)
+COMPARED_METRICS = (
+    ('upload.latency_ms.p50', False),
+    ('upload.latency_ms.p95', False),
+    ('upload.latency_ms.p99', False),
+    ('upload.requests_per_sec', True),
+    ('upload.queries_per_file', False),
+    ('process.latency_ms.p50', False),
+    ('process.latency_ms.p95', False),
+    ('process.latency_ms.p99', False),
+    ('process.tasks_per_sec', True),
+    ('process.files_per_sec', True),
+    ('process.queries_per_file', False),
+    ('status.task_status_ms.p95', False),
+    ('status.batch_status_ms.p95', False),
+    ('status.queries_per_poll', False),
+)
+
+
+def percentiles(durations: list[float]) -> dict:
+    """p50/p95/p99 and mean of durations given in seconds, in milliseconds."""
+    if not durations:
+        return {}
+    if len(durations) == 1:
+        p50 = p95 = p99 = durations[0]
+    else:
+        cuts = statistics.quantiles(durations, n=100, method='inclusive')
+        p50, p95, p99 = cuts[49], cuts[94], cuts[98]
+    return {
+        name: round(value * 1000, 2)
+        for name, value in (('p50', p50), ('p95', p95), ('p99', p99), ('mean', statistics.fmean(durations)))
+    }
+
+
+def make_image(rng: random.Random, size: int) -> bytes:
+    """JPEG of random noise: unique content, so no upload is answered from the result cache."""
+    image = Image.frombytes('RGB', (size, size), rng.randbytes(size * size * 3))
+    buffer = io.BytesIO()
+    image.save(buffer, 'JPEG', quality=85)
+    return buffer.getvalue()
+
+
+class PipelineBenchmark:
+    """
+    Drives uploads through UploadView, processes the queued tasks and polls
+    TaskStatusView/BatchStatusView, timing every step.
+
+    broker="local" needs no services: tasks go to an in-memory broker and are
+    executed in this process one by one, results are kept in memory and all
+    database writes are rolled back at the end. broker="redis" uses the
+    configured broker and result backend; running workers process the tasks
+    and throughput is measured until every task of every batch is done.
+    """
+
+    def __init__(self, files: int, rounds: int, image_size: int, broker: str = 'local',
+                 dispatch_mode: str | None = None, seed: int | None = None, timeout: float = 300):
+        self.files = files
+        self.rounds = rounds
+        self.image_size = image_size
+        self.broker = broker
+        self.dispatch_mode = dispatch_mode or settings.UPLOAD_DISPATCH_MODE
+        self.seed = seed if seed is not None else random.randrange(2 ** 32)
+        self.timeout = timeout
+        self.client = Client()
+
+    @property
+    def config(self) -> dict:
+        return {
+            'broker': self.broker,
+            'files': self.files,
+            'rounds': self.rounds,
+            'image_size': self.image_size,
+            'dispatch_mode': self.dispatch_mode,
+            'image_handler': settings.IMAGE_HANDLER,
+            'database': connection.vendor,
+            'seed': self.seed,
+        }
+
+    def run(self) -> dict:
+        rng = random.Random(self.seed)
+        payloads = [
+            [make_image(rng, self.image_size) for _ in range(self.files)]
+            for _ in range(self.rounds)
+        ]
+
+        with ExitStack() as stack:
+            stack.enter_context(override_settings(
+                UPLOAD_DISPATCH_MODE=self.dispatch_mode,
+                ALLOWED_HOSTS=[*settings.ALLOWED_HOSTS, 'testserver'],
+            ))
+            if self.broker == 'local':
+                stack.enter_context(local_pipeline())
+            upload, batches = self._upload(payloads)
+            process = self._process(batches, started=upload.pop('started'))
+            status = self._status(batches)
+
+        return {
+            'created_at': datetime.now(timezone.utc).isoformat(timespec='seconds'),
+            'commit': _git_commit(),
+            'config': self.config,
+            'upload': upload,
+            'process': process,
+            'status': status,
+        }
+
+    def _upload(self, payloads: list[list[bytes]]) -> tuple[dict, list[tuple[str, list[str]]]]:
+        url = reverse('upload')
+        durations, batches = [], []
+        started = time.perf_counter()
+        with CaptureQueriesContext(connection) as queries:
+            for round_number, contents in enumerate(payloads):
+                images = [
+                    SimpleUploadedFile(f"bench_{round_number}_{index}.jpg", content, 'image/jpeg')
+                    for index, content in enumerate(contents)
+                ]
+                start = time.perf_counter()
+                response = self.client.post(url, {'images': images})
+                durations.append(time.perf_counter() - start)
+                if response.status_code != 202:
+                    content = response.content[:500].decode(errors='replace')
+                    raise RuntimeError(f"Upload failed with {response.status_code}: {content}")
+                data = response.json()
+                batches.append((data['batch_id'], data['task_ids']))
+
+        total_files = self.files * self.rounds
+        return {
+            'started': started,
+            'requests': len(durations),
+            'files': total_files,
+            'latency_ms': percentiles(durations),
+            'requests_per_sec': round(len(durations) / sum(durations), 2),
+            'queries_per_file': round(len(queries) / total_files, 2),
+        }, batches
+
+    def _process(self, batches: list[tuple[str, list[str]]], started: float) -> dict:
+        total_files = sum(len(task_ids) for _, task_ids in batches)
+        if self.broker == 'local':
+            with CaptureQueriesContext(connection) as queries:
+                durations = run_queued_tasks(IMAGES_QUEUE)
+            elapsed = sum(durations)
+            return {
+                'tasks': len(durations),
+                'files': total_files,
+                'latency_ms': percentiles(durations),
+                'tasks_per_sec': round(len(durations) / elapsed, 2),
+                'files_per_sec': round(total_files / elapsed, 2),
+                'queries_per_file': round(len(queries) / total_files, 2),
+            }
+
+        # Workers run elsewhere: only the end-to-end throughput is observable here
+        deadline = started + self.timeout
+        pending = list(batches)
+        while pending:
+            if time.perf_counter() > deadline:
+                raise RuntimeError(f"{len(pending)} batches not finished after {self.timeout}s")
+            pending = [
+                (batch_id, task_ids) for batch_id, task_ids in pending
+                if batch_status(task_ids)['completed'] < len(task_ids)
+            ]
+            if pending:
+                time.sleep(STATUS_POLL_INTERVAL)
+        elapsed = time.perf_counter() - started
+        return {
+            'files': total_files,
+            'elapsed_sec': round(elapsed, 2),
+            'files_per_sec': round(total_files / elapsed, 2),
+        }
+
+    def _status(self, batches: list[tuple[str, list[str]]]) -> dict:
+        task_url, batch_url = reverse('task-status'), reverse('batch-status')
+        task_durations, batch_durations = [], []
+        with CaptureQueriesContext(connection) as queries:
+            for batch_id, task_ids in batches:
+                for task_id in task_ids:
+                    start = time.perf_counter()
+                    self.client.get(task_url, {'task_id': task_id})
+                    task_durations.append(time.perf_counter() - start)
+                start = time.perf_counter()
+                self.client.get(batch_url, {'batch_id': batch_id})
+                batch_durations.append(time.perf_counter() - start)
+
+        polls = len(task_durations) + len(batch_durations)
+        return {
+            'task_status_ms': percentiles(task_durations),
+            'batch_status_ms': percentiles(batch_durations),
+            'queries_per_poll': round(len(queries) / polls, 2),
+        }
+
+
+@contextmanager
+def local_pipeline():
+    """
+    In-process pipeline for benchmarking without Redis, workers or a disposable DB.
+
+    The broker is the kombu memory transport and results go to Celery's
+    in-memory cache backend; the app's cached producer pool and backend are
+    swapped directly, because CELERY_* environment variables take precedence
+    over configuration changes. Uploads go to a temporary directory and all
+    database writes are rolled back on exit. Variants go to the temporary
+    directory too, and the variant cache forgets its size counter for it.
+    """
+    producer_pool, backend = app.amqp._producer_pool, app.backend
+    worker_health, store_eager_result = celery_config._worker_health, app.conf.task_store_eager_result
+
+    app.amqp._producer_pool = pools.producers[app.connection_for_write(LOCAL_BROKER_URL)]
+    app._backend = CacheBackend(app=app, url='memory://')
+    app.conf.task_store_eager_result = True
+    celery_config._worker_health = WorkerHealth(lambda: True, ttl=float('inf'), reset_timeout=0)
+
+    try:
+        with tempfile.TemporaryDirectory() as media_root, override_settings(
+            MEDIA_ROOT=media_root,
+            BLOB_STORE_ROOT=os.path.join(media_root, 'blobs'),
+            VARIANT_CACHE_ROOT=os.path.join(media_root, 'variant-cache'),
+            CACHES={
+                'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'},
+                'results': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache', 'LOCATION': 'benchmark'},
+            },
+            NOTIFICATION_BACKENDS=[],
+        ), transaction.atomic():
+            try:
+                yield
+                transaction.set_rollback(True)
+            finally:
+                variant_cache.forget_size()
+    finally:
+        app.amqp._producer_pool = producer_pool
+        app._backend = backend
+        app.conf.task_store_eager_result = store_eager_result
+        celery_config._worker_health = worker_health
+
+
+def run_queued_tasks(queue: str) -> list[float]:
+    """Executes every task waiting in the local broker's queue in order; returns their durations."""
+    durations = []
+    with app.connection_for_read(LOCAL_BROKER_URL) as conn:
+        channel = conn.default_channel
+        while (message := channel.basic_get(queue, no_ack=True)) is not None:
+            task = app.tasks[message.headers['task']]
+            args, kwargs, _ = message.decode()
+            start = time.perf_counter()
+            task.apply(args, kwargs, task_id=message.headers['id'])
+            durations.append(time.perf_counter() - start)
+    return durations
+
+
+def measure_connection_churn(iterations: int, conn_max_age: int | None = None) -> dict:
+    """
+    Database connections opened by `iterations` request-sized units of work.
+
+    Each unit runs the same connection handling as a request (and as a task,
+    the Celery Django fixup does the same): close_old_connections on
+    request_started and request_finished with one query in between. On
+    PostgreSQL physical connections are counted by distinct backend pid, so
+    a connection reused from the psycopg pool is not counted twice;
+    elsewhere every connection_created signal counts.
+    """
+    configured_max_age = connection.settings_dict['CONN_MAX_AGE']
+    if conn_max_age is not None:
+        connection.close()
+        connection.settings_dict['CONN_MAX_AGE'] = conn_max_age
+
+    created, backend_pids, durations = [], set(), []
+
+    def count_connection(sender, connection, **kwargs):
+        created.append(connection.alias)
+
+    postgres = connection.vendor == 'postgresql'
+    connection_created.connect(count_connection)
+    try:
+        for _ in range(iterations):
+            start = time.perf_counter()
+            request_started.send(sender=__name__)
+            with connection.cursor() as cursor:
+                cursor.execute('SELECT pg_backend_pid()' if postgres else 'SELECT 1')
+                if postgres:
+                    backend_pids.add(cursor.fetchone()[0])
+            request_finished.send(sender=__name__)
+            durations.append(time.perf_counter() - start)
+    finally:
+        connection_created.disconnect(count_connection)
+        connection.settings_dict['CONN_MAX_AGE'] = configured_max_age
+
+    opened = len(backend_pids) if postgres else len(created)
+    return {
+        'created_at': datetime.now(timezone.utc).isoformat(timespec='seconds'),
+        'config': {
+            'database': connection.vendor,
+            'conn_max_age': configured_max_age if conn_max_age is None else conn_max_age,
+            'pool': bool(connection.settings_dict.get('OPTIONS', {}).get('pool')),
+        },
+        'iterations': iterations,
+        'connections_opened': opened,
+        'connections_per_request': round(opened / iterations, 3),
+        'latency_ms': percentiles(durations),
+    }
+
+
+def _git_commit() -> str | None:
+    try:
+        return subprocess.run(
+            ['git', 'rev-parse', '--short', 'HEAD'],
+            cwd=settings.BASE_DIR, capture_output=True, text=True, check=True,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def save_result(result: dict, directory: str) -> str:
+    os.makedirs(directory, exist_ok=True)
+    stamp = datetime.fromisoformat(result['created_at']).strftime('%Y%m%dT%H%M%S')
+    path = os.path.join(directory, f"benchmark-{stamp}.json")
+    with open(path, 'w') as file:
+        json.dump(result, file, indent=2)
+    return path
+
+
+def latest_result(directory: str) -> str | None:
+    if not os.path.isdir(directory):
+        return None
+    names = sorted(name for name in os.listdir(directory) if name.startswith('benchmark-') and name.endswith('.json'))
+    return os.path.join(directory, names[-1]) if names else None
+
+
+def _metric(result: dict, path: str):
+    value = result
+    for key in path.split('.'):
+        if not isinstance(value, dict) or key not in value:
+            return None
+        value = value[key]
+    return value
+
+
+def compare_results(baseline: dict, current: dict, threshold: float) -> list[dict]:
+    """Relative change of every metric present in both runs; regressed when worse by more than threshold."""
+    rows = []
+    for path, higher_is_better in COMPARED_METRICS:
+        before, after = _metric(baseline, path), _metric(current, path)
+        if before is None or after is None:
+            continue
+        change = (after - before) / before if before else 0.0
+        worse = -change if higher_is_better else change
+        rows.append({
+            'metric': path,
+            'baseline': before,
+            'current': after,
+            'change': round(change, 4),
+            'regressed': worse > threshold,
+        })
+    return rows
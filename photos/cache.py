@@ -0,0 +1,235 @@
+import uuid
+import logging
+import threading
+
+from django.conf import settings
+from django.core.cache import caches
+
+from .models import ImageRecord
+
+
+logger = logging.getLogger(__name__)
+
+STAT_KEYS = ('hits', 'db_hits', 'misses')
+
+
+class ResultCache:
+    """Processing results keyed by the SHA-256 of the file content.
+
+    Redis (the RESULT_CACHE_ALIAS cache, TTL-bound) answers most lookups
+    with one MGET; misses fall back to the indexed ImageRecord.content_hash
+    column, and results found there are written back to Redis. Cache errors
+    are logged and treated as misses so an unavailable cache never blocks
+    uploads.
+    """
+
+    key_prefix = 'result:'
+    stats_prefix = 'result-stats:'
+
+    @property
+    def cache(self):
+        return caches[settings.RESULT_CACHE_ALIAS]
+
+    def get_many(self, digests: list[str]) -> dict[str, dict]:
+        digests = list(dict.fromkeys(digests))
+        if not digests:
+            return {}
+
+        try:
+            cached = self.cache.get_many([self.key_prefix + digest for digest in digests])
+        except Exception as e:
+            logger.warning("Result cache unavailable: %s", e)
+            cached = {}
+        results = {key[len(self.key_prefix):]: value for key, value in cached.items()}
+
+        missing = [digest for digest in digests if digest not in results]
+        from_db = {}
+        if missing:
+            records = ImageRecord.objects.filter(
+                content_hash__in=missing, status=ImageRecord.SUCCESS,
+            ).only(*ImageRecord.RESULT_FIELDS, 'content_hash')
+            for record in records.order_by('pk'):
+                from_db[record.content_hash] = record.as_result()
+            if from_db:
+                self._set_many(from_db)
+        results.update(from_db)
+
+        self._incr_stats(
+            hits=len(digests) - len(missing),
+            db_hits=len(from_db),
+            misses=len(missing) - len(from_db),
+        )
+        return results
+
+    def set(self, digest: str, data: dict):
+        self._set_many({digest: data})
+
+    def _set_many(self, results: dict[str, dict]):
+        try:
+            self.cache.set_many(
+                {self.key_prefix + digest: data for digest, data in results.items()},
+                timeout=settings.RESULT_CACHE_TTL,
+            )
+        except Exception as e:
+            logger.warning("Result cache unavailable: %s", e)
+
+    def _incr_stats(self, **counts):
+        try:
+            for name, count in counts.items():
+                if count:
+                    key = self.stats_prefix + name
+                    self.cache.add(key, 0, timeout=None)
+                    self.cache.incr(key, count)
+        except Exception as e:
+            logger.warning("Result cache unavailable: %s", e)
+
+    def stats(self) -> dict:
+        values = self.cache.get_many([self.stats_prefix + name for name in STAT_KEYS])
+        data = {name: values.get(self.stats_prefix + name, 0) for name in STAT_KEYS}
+        lookups = sum(data.values())
+        data['hit_rate'] = round((data['hits'] + data['db_hits']) / lookups, 4) if lookups else None
+        return data
+
+
+result_cache = ResultCache()
+
+
+class TaskCheckpoints:
+    """Idempotency state of processing tasks, keyed by task id.
+
+    The handler output is saved as soon as the handler returns, so a retry
+    after a database error or a redelivered message reuses it instead of
+    running the handler again. A lock keeps a redelivered message from
+    being processed while the original is still running; it holds an owner
+    token, is renewed while the handler runs and released only by its owner. Both live in the
+    RESULT_CACHE_ALIAS cache (SET NX for the lock); cache errors are logged
+    and fail open, the unique task_id then still prevents duplicate rows.
+    """
+
+    output_prefix = 'task-output:'
+    lock_prefix = 'task-lock:'
+    lock_wait_prefix = 'task-lock-waits:'
+
+    @property
+    def cache(self):
+        return caches[settings.RESULT_CACHE_ALIAS]
+
+    def get_outputs(self, task_ids: list[str]) -> dict[str, tuple[dict, float]]:
+        try:
+            values = self.cache.get_many([self.output_prefix + task_id for task_id in task_ids])
+        except Exception as e:
+            logger.warning("Task checkpoints unavailable: %s", e)
+            return {}
+        return {key[len(self.output_prefix):]: tuple(value) for key, value in values.items()}
+
+    def get_output(self, task_id: str) -> tuple[dict, float] | None:
+        return self.get_outputs([task_id]).get(task_id)
+
+    def set_output(self, task_id: str, fields: dict, execution_time: float):
+        try:
+            self.cache.set(self.output_prefix + task_id, (fields, execution_time), timeout=settings.TASK_OUTPUT_TTL)
+        except Exception as e:
+            logger.warning("Task checkpoints unavailable: %s", e)
+
+    def delete_outputs(self, task_ids: list[str]):
+        try:
+            self.cache.delete_many([self.output_prefix + task_id for task_id in task_ids])
+        except Exception as e:
+            logger.warning("Task checkpoints unavailable: %s", e)
+
+    def acquire(self, task_id: str) -> str | None:
+        """Takes the lock of the task; returns the owner token, or None while another delivery holds it."""
+        token = uuid.uuid4().hex
+        try:
+            return token if self.cache.add(self.lock_prefix + task_id, token, timeout=settings.TASK_LOCK_TTL) else None
+        except Exception as e:
+            logger.warning("Task checkpoints unavailable: %s", e)
+            return token
+
+    def renew(self, task_id: str, token: str) -> bool:
+        """Extends the lock by TASK_LOCK_TTL if token still owns it."""
+        key = self.lock_prefix + task_id
+        try:
+            return self.cache.get(key) == token and self.cache.touch(key, settings.TASK_LOCK_TTL)
+        except Exception as e:
+            logger.warning("Task checkpoints unavailable: %s", e)
+            return False
+
+    def keep_alive(self, task_id: str, token: str) -> threading.Event:
+        """Renews the lock every third of TASK_LOCK_TTL until the returned event is set.
+
+        The TTL only has to cover a renewal interval, so the lock of a killed
+        worker frees up soon, however long a live handler runs.
+        """
+        stop = threading.Event()
+
+        def renew():
+            while not stop.wait(settings.TASK_LOCK_TTL / 3):
+                if not self.renew(task_id, token):
+                    return
+
+        threading.Thread(target=renew, name=f'task-lock-{task_id}', daemon=True).start()
+        return stop
+
+    def release(self, task_id: str, token: str):
+        """Deletes the lock only if token owns it; an expired lock may have been taken by another delivery."""
+        key = self.lock_prefix + task_id
+        try:
+            if self.cache.get(key) == token:
+                self.cache.delete(key)
+        except Exception as e:
+            logger.warning("Task checkpoints unavailable: %s", e)
+
+    def count_lock_wait(self, task_id: str) -> int:
+        """Counts a retry spent waiting for the lock; returns the waits so far."""
+        key = self.lock_wait_prefix + task_id
+        try:
+            self.cache.add(key, 0, timeout=settings.TASK_OUTPUT_TTL)
+            return self.cache.incr(key)
+        except Exception as e:
+            logger.warning("Task checkpoints unavailable: %s", e)
+            return 0
+
+    def lock_waits(self, task_id: str) -> int:
+        try:
+            return self.cache.get(self.lock_wait_prefix + task_id, 0)
+        except Exception as e:
+            logger.warning("Task checkpoints unavailable: %s", e)
+            return 0
+
+
+task_checkpoints = TaskCheckpoints()
+
+
+class BlobPins:
+    """Digests of blobs an upload found already stored and relies on, e.g. for its image_task.
+
+    Requests remove the blobs they created for rejected or failed files
+    (see photos.uploadhandlers.discard_new_blobs); a concurrent upload of
+    the same bytes gets created=False and pins the digest, and a pinned
+    blob is kept. A pin only has to outlive the requests that created the
+    blob, so it expires after BLOB_PIN_TTL. Cache errors are logged and
+    count as pinned: blobs are kept rather than deleted under a task.
+    """
+
+    key_prefix = 'blob-pin:'
+
+    @property
+    def cache(self):
+        return caches[settings.RESULT_CACHE_ALIAS]
+
+    def pin(self, digest: str):
+        try:
+            self.cache.set(self.key_prefix + digest, 1, timeout=settings.BLOB_PIN_TTL)
+        except Exception as e:
+            logger.warning("Blob pins unavailable: %s", e)
+
+    def is_pinned(self, digest: str) -> bool:
+        try:
+            return self.cache.get(self.key_prefix + digest) is not None
+        except Exception as e:
+            logger.warning("Blob pins unavailable: %s", e)
+            return True
+
+
+blob_pins = BlobPins()
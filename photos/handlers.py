@@ -1,20 +1,35 @@
+import io
 import random
 import time
 import logging
 from importlib import import_module
 
+from django.conf import settings
+from django.core.files.storage import default_storage
+from django.urls import reverse
+from PIL import Image, ExifTags, ImageOps, UnidentifiedImageError
+from PIL.TiffImagePlugin import IFDRational
+
+from .storage import blob_store
+from .validators import MAX_PIXELS
+from .variants import variant_cache
+
 logger = logging.getLogger(__name__)
 
 MOCK_PROCESSING_TIME = 3
+PDF_SIGNATURE = b'%PDF-'
+HASH_SIZE = 8
+# EXIF orientations that rotate by 90 degrees, so the displayed width is the stored height
+TRANSPOSED_ORIENTATIONS = (5, 6, 7, 8)
 
-def image_handler(file_name: str, *args, **kwargs)-> tuple[int, float]:
+def image_handler(file_name: str, *args, **kwargs)-> tuple[dict, float]:
     """Функция для процессинга изображения.
 
     Args:
-        file_name (str): Имя файла (в данной имплементации не используется).
+        file_name (str): Имя файла (в данной имплементации не используется).
 
     Returns:
-        tuple[int, float]: Рандомное число и время выполнения
+        tuple[dict, float]: Поля ImageRecord (рандомное число) и время выполнения
 
     """
 
@@ -28,11 +43,127 @@ def image_handler(file_name: str, *args, **kwargs)-> tuple[int, float]:
     execution_time = round(finish - start, 2)
     logger.info(f"Execution time: {execution_time}, image random num: {num}")
 
-    return num, execution_time
+    return {'image_random_num': num}, execution_time
+
+
+def pillow_image_handler(file_name: str, digest: str | None = None, *args, **kwargs) -> tuple[dict, float]:
+    """Декодирует изображение через Pillow и вычисляет его характеристики.
+
+    Сохраняет webp-варианты размеров IMAGE_VARIANT_SIZES в кэш вариантов,
+    откуда их отдаёт /api/variants/, считает перцептивный хэш (dHash) и извлекает EXIF.
+
+    Args:
+        file_name (str): Путь к файлу в хранилище (default_storage), если digest не передан.
+        digest (str): SHA-256 файла в blob_store; файл читается через mmap.
+
+    Returns:
+        tuple[dict, float]: Поля ImageRecord и время выполнения
+
+    """
+    start = time.perf_counter()
+
+    with _open_source(file_name, digest) as file:
+        try:
+            image = Image.open(file)
+        except UnidentifiedImageError:
+            file.seek(0)
+            if file.read(len(PDF_SIGNATURE)) != PDF_SIGNATURE:
+                raise
+            fields = {'format': 'PDF', 'metadata': {}}
+        else:
+            with image:
+                fields = _process_image(image, digest)
+
+    execution_time = round(time.perf_counter() - start, 2)
+    logger.info(f"Execution time: {execution_time}, image: {file_name}, format: {fields['format']}")
+
+    return fields, execution_time
+
+
+def _open_source(file_name: str, digest: str | None):
+    if digest:
+        return blob_store.open(digest)
+    return default_storage.open(file_name, 'rb')
+
+
+def _process_image(image: Image.Image, digest: str | None) -> dict:
+    if image.width * image.height > MAX_PIXELS:
+        raise ValueError(f"Image too large ({image.width * image.height} > {MAX_PIXELS} pixels)")
+    image_format = image.format
+    exif = _exif_data(image)
+    # The full size from the header: draft() below changes image.size to the reduced decode size
+    width, height = image.size
+    if image.getexif().get(ExifTags.Base.Orientation) in TRANSPOSED_ORIENTATIONS:
+        width, height = height, width
+
+    # JPEG can be decoded at a reduced scale when only small variants are needed
+    largest = max(settings.IMAGE_VARIANT_SIZES)
+    image.draft('RGB', (largest, largest))
+    image = ImageOps.exif_transpose(image)
+
+    variants = {}
+    for size in sorted(settings.IMAGE_VARIANT_SIZES, reverse=True):
+        variant = image.copy()
+        variant.thumbnail((size, size), Image.Resampling.LANCZOS)
+        image = variant
+        # Variants are addressed by the blob digest; a file read from default_storage gets none
+        if digest:
+            variants[str(size)] = _save_variant(variant, digest, size)
+
+    return {
+        'width': width,
+        'height': height,
+        'format': image_format,
+        'phash': difference_hash(image),
+        'metadata': {'exif': exif, 'variants': variants},
+    }
+
+
+def difference_hash(image: Image.Image, hash_size: int = HASH_SIZE) -> str:
+    """Perceptual difference hash: one bit per horizontally adjacent pixel pair."""
+    pixels = image.convert('L').resize((hash_size + 1, hash_size), Image.Resampling.LANCZOS).tobytes()
+    bits = 0
+    for row in range(hash_size):
+        offset = row * (hash_size + 1)
+        for col in range(hash_size):
+            bits = (bits << 1) | (pixels[offset + col] > pixels[offset + col + 1])
+    return f"{bits:0{hash_size * hash_size // 4}x}"
+
+
+def _exif_data(image: Image.Image) -> dict:
+    exif = {}
+    for tag, value in image.getexif().items():
+        if isinstance(value, tuple):
+            value = [_exif_value(item) for item in value]
+        elif isinstance(value, (IFDRational, int, float, str)):
+            value = _exif_value(value)
+        else:
+            continue
+        exif[ExifTags.TAGS.get(tag, str(tag))] = value
+    return exif
+
+
+def _exif_value(value):
+    # EXIF strings are often NUL-padded; PostgreSQL jsonb rejects \u0000
+    if isinstance(value, IFDRational):
+        return float(value)
+    if isinstance(value, str):
+        return value.replace('\x00', '')
+    return value
+
+
+def _save_variant(image: Image.Image, digest: str, size: int) -> str:
+    """Puts the variant into the cache /api/variants/ serves from; returns its URL."""
+    if image.mode not in ('RGB', 'RGBA'):
+        image = image.convert('RGBA' if 'A' in image.getbands() else 'RGB')
+    buffer = io.BytesIO()
+    image.save(buffer, 'WEBP', quality=settings.IMAGE_VARIANT_QUALITY)
+    variant_cache.put(digest, size, 'webp', buffer.getvalue())
+    return reverse('variant', kwargs={'digest': digest, 'size': size, 'extension': 'webp'})
 
 
 def get_handler(handler_path: str):
     """Динамически загружает класс или функцию по строковому пути."""
     module_path, class_name = handler_path.rsplit('.', 1)
     module = import_module(module_path)
-    return getattr(module, class_name)
\ No newline at end of file
+    return getattr(module, class_name)
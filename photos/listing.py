@@ -0,0 +1,98 @@
+import json
+import base64
+import binascii
+from datetime import datetime, time
+
+from django.conf import settings
+from django.db.models import Q
+from django.utils import timezone
+from django.utils.dateparse import parse_date, parse_datetime
+
+from .models import ImageRecord
+
+
+# Fields a client may request with ?fields=; metadata (EXIF) is large and only sent on request
+LIST_FIELDS = (
+    'id', 'task_id', 'batch_id', 'file_name', 'status', 'error', 'content_hash', 'image_random_num',
+    'width', 'height', 'format', 'phash', 'metadata', 'execution_time', 'created_at',
+)
+DEFAULT_LIST_FIELDS = (
+    'id', 'task_id', 'batch_id', 'file_name', 'status', 'width', 'height', 'format', 'execution_time', 'created_at',
+)
+
+
+def encode_cursor(created_at: datetime, pk: int) -> str:
+    raw = json.dumps([created_at.isoformat(), pk]).encode()
+    return base64.urlsafe_b64encode(raw).decode().rstrip('=')
+
+
+def decode_cursor(cursor: str) -> tuple[datetime, int]:
+    try:
+        raw = base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4))
+        created_at, pk = json.loads(raw)
+        return datetime.fromisoformat(created_at), int(pk)
+    except (binascii.Error, ValueError, TypeError) as e:
+        raise ValueError("Invalid cursor") from e
+
+
+def parse_bound(value: str, end: bool = False) -> datetime:
+    """ISO date or datetime; a bare date means the start (or, for end=True, the end) of that day."""
+    moment = parse_datetime(value)
+    if moment is None:
+        day = parse_date(value)
+        if day is None:
+            raise ValueError(f"Invalid date: {value}")
+        moment = datetime.combine(day, time.max if end else time.min)
+    if timezone.is_naive(moment):
+        moment = timezone.make_aware(moment)
+    return moment
+
+
+def parse_fields(value: str | None) -> list[str]:
+    if not value:
+        return list(DEFAULT_LIST_FIELDS)
+    fields = [field for field in value.split(',') if field]
+    unknown = [field for field in fields if field not in LIST_FIELDS]
+    if unknown:
+        raise ValueError(f"Unknown fields: {', '.join(unknown)}")
+    return fields
+
+
+def list_records(batch_id: str | None = None, status: str | None = None, since: datetime | None = None,
+                 until: datetime | None = None, fields: list[str] | None = None,
+                 cursor: str | None = None, limit: int | None = None) -> dict:
+    """One page of ImageRecord, newest first.
+
+    Keyset pagination on (created_at, id): the cursor holds the last row of
+    the previous page, so every page is an index range scan of `limit` rows
+    on created_at, or on (batch_id, created_at) when filtered by batch,
+    however deep the client pages. Only the requested columns are selected.
+    """
+    fields = list(fields or DEFAULT_LIST_FIELDS)
+    limit = max(1, min(limit or settings.IMAGE_LIST_PAGE_SIZE, settings.IMAGE_LIST_MAX_PAGE_SIZE))
+
+    records = ImageRecord.objects.all()
+    if batch_id:
+        records = records.filter(batch_id=batch_id)
+    if status:
+        records = records.filter(status=status)
+    if since:
+        records = records.filter(created_at__gte=since)
+    if until:
+        records = records.filter(created_at__lte=until)
+    if cursor:
+        created_at, pk = decode_cursor(cursor)
+        records = records.filter(Q(created_at__lt=created_at) | Q(created_at=created_at, pk__lt=pk))
+
+    # The sort key is always selected to build the next cursor
+    columns = list(dict.fromkeys([*fields, 'id', 'created_at']))
+    rows = list(records.order_by('-created_at', '-pk').values(*columns)[:limit + 1])
+
+    next_cursor = None
+    if len(rows) > limit:
+        rows = rows[:limit]
+        next_cursor = encode_cursor(rows[-1]['created_at'], rows[-1]['id'])
+    return {
+        'results': [{field: row[field] for field in fields} for row in rows],
+        'next_cursor': next_cursor,
+    }
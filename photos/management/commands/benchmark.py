@@ -0,0 +1,84 @@
+import os
+import json
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from photos.benchmark import PipelineBenchmark, compare_results, latest_result, save_result
+from photos.validators import BATCH_MAX_COUNT
+
+
+class Command(BaseCommand):
+    help = (
+        "Benchmarks the upload → process → status pipeline: p50/p95/p99 latency, "
+        "tasks/sec and DB queries per file. Results are saved as JSON and compared "
+        "with the previous run."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--files', type=int, default=10, help="Files per upload request")
+        parser.add_argument('--rounds', type=int, default=5, help="Number of upload requests")
+        parser.add_argument('--image-size', type=int, default=512, help="Side of the generated images, px")
+        parser.add_argument(
+            '--broker', choices=('local', 'redis'), default='local',
+            help="local: in-memory broker, tasks run in this process, DB writes rolled back; "
+                 "redis: configured broker with running workers",
+        )
+        parser.add_argument('--dispatch-mode', choices=('file', 'batch'), help="Overrides UPLOAD_DISPATCH_MODE")
+        parser.add_argument('--seed', type=int, help="Seed of the generated images")
+        parser.add_argument('--timeout', type=float, default=300, help="Max seconds to wait for workers (redis)")
+        parser.add_argument(
+            '--output', default=os.path.join(settings.BASE_DIR, 'benchmarks'),
+            help="Directory the results are stored in",
+        )
+        parser.add_argument('--baseline', help="Result file to compare with (default: latest in --output)")
+        parser.add_argument('--threshold', type=float, default=0.2, help="Relative change counted as regression")
+        parser.add_argument('--fail-on-regression', action='store_true')
+        parser.add_argument('--no-save', action='store_true', help="Do not store this run")
+
+    def handle(self, *args, **options):
+        if not 0 < options['files'] <= BATCH_MAX_COUNT:
+            raise CommandError(f"--files must be between 1 and {BATCH_MAX_COUNT}")
+        if options['rounds'] < 1:
+            raise CommandError("--rounds must be at least 1")
+
+        baseline_path = options['baseline'] or latest_result(options['output'])
+
+        benchmark = PipelineBenchmark(
+            files=options['files'],
+            rounds=options['rounds'],
+            image_size=options['image_size'],
+            broker=options['broker'],
+            dispatch_mode=options['dispatch_mode'],
+            seed=options['seed'],
+            timeout=options['timeout'],
+        )
+        try:
+            result = benchmark.run()
+        except RuntimeError as e:
+            raise CommandError(str(e))
+
+        self.stdout.write(json.dumps(result, indent=2))
+        if not options['no_save']:
+            path = save_result(result, options['output'])
+            self.stdout.write(self.style.SUCCESS(f"Saved to {path}"))
+
+        if baseline_path:
+            self.report_comparison(baseline_path, result, options)
+
+    def report_comparison(self, baseline_path: str, result: dict, options: dict):
+        with open(baseline_path) as file:
+            baseline = json.load(file)
+
+        self.stdout.write(f"\nCompared with {baseline_path} (commit {baseline.get('commit')}):")
+        if baseline.get('config', {}) | {'seed': None} != result['config'] | {'seed': None}:
+            self.stdout.write(self.style.WARNING("Configurations differ, the comparison is indicative only"))
+
+        rows = compare_results(baseline, result, options['threshold'])
+        for row in rows:
+            line = f"  {row['metric']:<30} {row['baseline']:>10} -> {row['current']:>10}  {row['change']:+.1%}"
+            self.stdout.write(self.style.ERROR(line) if row['regressed'] else line)
+
+        regressions = [row['metric'] for row in rows if row['regressed']]
+        if regressions and options['fail_on_regression']:
+            raise CommandError(f"Regressions above {options['threshold']:.0%}: {', '.join(regressions)}")
@@ -0,0 +1,25 @@
+import json
+
+from django.core.management.base import BaseCommand, CommandError
+
+from photos.benchmark import measure_connection_churn
+
+
+class Command(BaseCommand):
+    help = (
+        "Counts database connections opened per request/task with the current "
+        "connection settings (CONN_MAX_AGE, DATABASE_POOL)."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--iterations', type=int, default=500, help="Simulated requests")
+        parser.add_argument(
+            '--conn-max-age', type=int,
+            help="Overrides CONN_MAX_AGE for this run, e.g. 0 for the old connection-per-request behaviour",
+        )
+
+    def handle(self, *args, **options):
+        if options['iterations'] < 1:
+            raise CommandError("--iterations must be at least 1")
+        result = measure_connection_churn(options['iterations'], options['conn_max_age'])
+        self.stdout.write(json.dumps(result, indent=2))
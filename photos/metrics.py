@@ -0,0 +1,139 @@
+import os
+import glob
+import time
+import logging
+from datetime import datetime
+
+from celery.signals import before_task_publish, task_postrun, task_prerun
+from kombu.exceptions import ChannelError
+from prometheus_client import REGISTRY, CollectorRegistry, Counter, Histogram, generate_latest, multiprocess
+from prometheus_client.core import GaugeMetricFamily
+
+
+logger = logging.getLogger(__name__)
+
+# Seconds; covers fast DB writes and webhook calls up to slow image decodes
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+QUEUE_WAIT_BUCKETS = (0.01, 0.05, 0.1, 0.5, 1, 5, 10, 30, 60, 300, 900)
+
+TASK_QUEUE_WAIT = Histogram(
+    'photos_task_queue_wait_seconds', "Time from publishing a task (or its ETA) to its start on a worker",
+    ['task'], buckets=QUEUE_WAIT_BUCKETS,
+)
+TASKS = Counter('photos_tasks_total', "Finished task runs by final state (SUCCESS, FAILURE, RETRY)", ['task', 'state'])
+HANDLER_DURATION = Histogram(
+    'photos_image_handler_seconds', "Image handler execution time", ['handler'], buckets=LATENCY_BUCKETS,
+)
+HANDLER_SKIPPED = Counter(
+    'photos_image_handler_skipped_total',
+    "Handler runs avoided on retry/redelivery: output reused from a checkpoint or the record already written",
+    ['reason'],
+)
+DB_WRITE_DURATION = Histogram(
+    'photos_db_write_seconds', "ImageRecord insert statement time", ['mode'], buckets=LATENCY_BUCKETS,
+)
+NOTIFICATION_DURATION = Histogram(
+    'photos_notification_seconds', "Notification request time", ['backend'], buckets=LATENCY_BUCKETS,
+)
+NOTIFICATIONS = Counter(
+    'photos_notifications_total',
+    "Notification attempts by outcome (sent, failed, rate_limited, throttled, dead_letter)",
+    ['backend', 'outcome'],
+)
+VALIDATION_REJECTS = Counter('photos_validation_rejects_total', "Rejected upload files by reason", ['reason'])
+
+
+def count_rejection(error, files: int = 1):
+    """Counts files rejected with a ValidationError by its code (see photos.validators)."""
+    VALIDATION_REJECTS.labels(reason=getattr(error, 'code', None) or 'other').inc(files)
+
+
+@before_task_publish.connect
+def _stamp_enqueued_at(headers=None, **kwargs):
+    if headers is not None:
+        headers['enqueued_at'] = time.time()
+
+
+@task_prerun.connect
+def _observe_queue_wait(task=None, **kwargs):
+    request = task.request
+    enqueued_at = getattr(request, 'enqueued_at', None)
+    if enqueued_at is None or request.is_eager:
+        return
+    # A countdown/retry delay is not queue wait
+    reference = enqueued_at
+    if request.eta:
+        reference = max(reference, datetime.fromisoformat(request.eta).timestamp())
+    TASK_QUEUE_WAIT.labels(task=task.name).observe(max(0.0, time.time() - reference))
+
+
+@task_postrun.connect
+def _count_task(task=None, state=None, **kwargs):
+    TASKS.labels(task=task.name, state=state or 'UNKNOWN').inc()
+
+
+class QueueDepthCollector:
+    """Messages waiting in each Celery queue, read from the broker at scrape time."""
+
+    def describe(self):
+        return []
+
+    def collect(self):
+        from config.celery import app
+
+        family = GaugeMetricFamily('photos_queue_depth', "Messages waiting in the broker queue", labels=['queue'])
+        try:
+            with app.connection_for_read() as conn:
+                conn.ensure_connection(max_retries=1)
+                channel = conn.default_channel
+                for queue in app.conf.task_queues:
+                    try:
+                        _, count, _ = channel.queue_declare(queue.name, passive=True)
+                    except ChannelError:
+                        count = 0  # never declared: no messages were sent yet
+                    family.add_metric([queue.name], count)
+        except Exception as e:
+            logger.warning(f"Queue depth unavailable: {e}")
+        yield family
+
+
+_queue_registry = CollectorRegistry(auto_describe=False)
+_queue_registry.register(QueueDepthCollector())
+
+
+class ContainerFilesCollector:
+    """
+    Merges the multiprocess files of all containers under one root.
+
+    Each container writes to its own PROMETHEUS_MULTIPROC_DIR below
+    PROMETHEUS_MULTIPROC_ROOT: PIDs are only unique within a container, and
+    prometheus_client names the files by PID, so containers sharing one
+    directory would write into each other's files.
+    """
+
+    def __init__(self, root: str):
+        self.root = root
+
+    def collect(self):
+        files = glob.glob(os.path.join(self.root, '*', '*.db'))
+        return multiprocess.MultiProcessCollector.merge(files, accumulate=True)
+
+
+def generate_metrics() -> bytes:
+    """
+    Exposition of all metrics in the Prometheus text format.
+
+    With PROMETHEUS_MULTIPROC_ROOT set (compose sets it for the web server)
+    the samples of every container below it are aggregated; with only
+    PROMETHEUS_MULTIPROC_DIR those of the processes of this container;
+    otherwise only this process's metrics are exported.
+    """
+    if 'PROMETHEUS_MULTIPROC_ROOT' in os.environ:
+        registry = CollectorRegistry()
+        registry.register(ContainerFilesCollector(os.environ['PROMETHEUS_MULTIPROC_ROOT']))
+    elif 'PROMETHEUS_MULTIPROC_DIR' in os.environ:
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+    else:
+        registry = REGISTRY
+    return generate_latest(registry) + generate_latest(_queue_registry)
@@ -0,0 +1,43 @@
+# Generated by Django 5.2 on 2026-10-18 19:20
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('photos', '0003_alter_imagerecord_file_name'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='imagerecord',
+            name='format',
+            field=models.CharField(blank=True, default='', max_length=16),
+        ),
+        migrations.AddField(
+            model_name='imagerecord',
+            name='height',
+            field=models.PositiveIntegerField(null=True),
+        ),
+        migrations.AddField(
+            model_name='imagerecord',
+            name='metadata',
+            field=models.JSONField(blank=True, default=dict),
+        ),
+        migrations.AddField(
+            model_name='imagerecord',
+            name='phash',
+            field=models.CharField(blank=True, default='', max_length=16),
+        ),
+        migrations.AddField(
+            model_name='imagerecord',
+            name='width',
+            field=models.PositiveIntegerField(null=True),
+        ),
+        migrations.AlterField(
+            model_name='imagerecord',
+            name='image_random_num',
+            field=models.IntegerField(default=None, null=True),
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 5.2 on 2026-10-18 19:38
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('photos', '0006_failednotification'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='imagerecord',
+            name='task_id',
+            field=models.CharField(blank=True, db_index=True, default='', max_length=255),
+        ),
+    ]
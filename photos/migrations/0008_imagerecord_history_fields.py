@@ -0,0 +1,61 @@
+# Generated by Django 5.2 on 2026-10-18 19:41
+
+import django.utils.timezone
+from django.db import migrations, models
+
+
+def empty_task_ids_to_null(apps, schema_editor):
+    ImageRecord = apps.get_model('photos', 'ImageRecord')
+    ImageRecord.objects.filter(task_id='').update(task_id=None)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('photos', '0007_imagerecord_task_id'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='imagerecord',
+            name='batch_id',
+            field=models.CharField(blank=True, default='', max_length=36),
+        ),
+        migrations.AddField(
+            model_name='imagerecord',
+            name='created_at',
+            field=models.DateTimeField(auto_now_add=True, db_index=True, default=django.utils.timezone.now),
+            preserve_default=False,
+        ),
+        migrations.AddField(
+            model_name='imagerecord',
+            name='error',
+            field=models.TextField(blank=True, default=''),
+        ),
+        migrations.AddField(
+            model_name='imagerecord',
+            name='execution_time',
+            field=models.FloatField(null=True),
+        ),
+        migrations.AddField(
+            model_name='imagerecord',
+            name='status',
+            field=models.CharField(choices=[('SUCCESS', 'Success'), ('FAILURE', 'Failure')], default='SUCCESS', max_length=16),
+        ),
+        # Records written before task ids were stored have '', which would collide under the unique constraint
+        migrations.AlterField(
+            model_name='imagerecord',
+            name='task_id',
+            field=models.CharField(blank=True, db_index=True, max_length=255, null=True),
+        ),
+        migrations.RunPython(empty_task_ids_to_null, migrations.RunPython.noop),
+        migrations.AlterField(
+            model_name='imagerecord',
+            name='task_id',
+            field=models.CharField(blank=True, max_length=255, null=True, unique=True),
+        ),
+        migrations.AddIndex(
+            model_name='imagerecord',
+            index=models.Index(fields=['batch_id', 'created_at'], name='photos_imag_batch_created_idx'),
+        ),
+    ]
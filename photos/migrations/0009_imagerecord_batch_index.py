@@ -0,0 +1,18 @@
+# Generated by Django 5.2 on 2026-10-18 20:26
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('photos', '0008_imagerecord_history_fields'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='imagerecord',
+            name='batch_index',
+            field=models.PositiveIntegerField(blank=True, null=True),
+        ),
+    ]
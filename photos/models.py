@@ -2,11 +2,52 @@ from django.db import models
 
 
 class ImageRecord(models.Model):
+    SUCCESS = 'SUCCESS'
+    FAILURE = 'FAILURE'
+    STATUS_CHOICES = ((SUCCESS, 'Success'), (FAILURE, 'Failure'))
+
+    # Fields of the compact task result, see as_result()
+    RESULT_FIELDS = ('id', 'file_name', 'image_random_num', 'width', 'height', 'format', 'execution_time')
+
     file_name = models.TextField()
-    image_random_num = models.IntegerField(default=None)
+    # Celery task id (the sub-id for batch tasks); NULL for records written outside a task
+    task_id = models.CharField(max_length=255, unique=True, null=True, blank=True)
+    batch_id = models.CharField(max_length=36, blank=True, default='')
+    # Position of the file's task in its batch, so the batch keeps its order once the GroupResult expires
+    batch_index = models.PositiveIntegerField(null=True, blank=True)
+    status = models.CharField(max_length=16, choices=STATUS_CHOICES, default=SUCCESS)
+    error = models.TextField(blank=True, default='')
+    content_hash = models.CharField(max_length=64, blank=True, default='', db_index=True)
+    image_random_num = models.IntegerField(default=None, null=True)
+    width = models.PositiveIntegerField(null=True)
+    height = models.PositiveIntegerField(null=True)
+    format = models.CharField(max_length=16, blank=True, default='')
+    phash = models.CharField(max_length=16, blank=True, default='')
+    metadata = models.JSONField(default=dict, blank=True)
+    execution_time = models.FloatField(null=True)
+    created_at = models.DateTimeField(auto_now_add=True, db_index=True)
+
+    class Meta:
+        indexes = [
+            # History of one upload batch in processing order
+            models.Index(fields=['batch_id', 'created_at'], name='photos_imag_batch_created_idx'),
+        ]
 
     def __str__(self):
         return str(self.pk)
 
+    def as_result(self) -> dict:
+        """Компактный результат задачи: id записи и поля, которые показывает клиент."""
+        return {field: getattr(self, field) for field in self.RESULT_FIELDS}
 
 
+class FailedNotification(models.Model):
+    """Dead-letter: уведомление, которое не удалось отправить после всех попыток."""
+    backend = models.CharField(max_length=255)
+    message = models.TextField()
+    error = models.TextField(blank=True, default='')
+    attempts = models.PositiveIntegerField(default=0)
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    def __str__(self):
+        return f"{self.backend}: {self.error}"
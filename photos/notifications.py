@@ -1,10 +1,63 @@
 import os
+import time
+import logging
 from abc import ABC, abstractmethod
+
+import redis
 import requests
 from django.conf import settings
+from requests.adapters import HTTPAdapter
+
+
+logger = logging.getLogger(__name__)
+
+
+class RateLimitError(Exception):
+    """Провайдер ответил 429; retry_after — сколько секунд он просит подождать."""
+
+    def __init__(self, message: str, retry_after: float | None = None):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
+def _retry_after(response: requests.Response) -> float | None:
+    # Slack sends the Retry-After header, Telegram puts it into the JSON body
+    header = response.headers.get('Retry-After')
+    if header:
+        try:
+            return float(header)
+        except ValueError:
+            return None
+    try:
+        return float(response.json()['parameters']['retry_after'])
+    except (ValueError, KeyError, TypeError):
+        return None
 
 
 class NotificationSender(ABC):
+    """Базовый отправщик: keep-alive сессия с пулом соединений на процесс."""
+
+    def __init__(self):
+        self._session = None
+        self._pid = None
+
+    @property
+    def session(self) -> requests.Session:
+        # Pools must not be shared with a forked child (Celery prefork)
+        if self._session is None or self._pid != os.getpid():
+            session = requests.Session()
+            adapter = HTTPAdapter(pool_connections=1, pool_maxsize=settings.NOTIFICATION_POOL_SIZE)
+            session.mount('https://', adapter)
+            session.mount('http://', adapter)
+            self._session, self._pid = session, os.getpid()
+        return self._session
+
+    def post(self, url: str, payload: dict) -> requests.Response:
+        response = self.session.post(url, json=payload, timeout=settings.NOTIFICATION_TIMEOUT)
+        if response.status_code == 429:
+            raise RateLimitError(f"{type(self).__name__} rate limited", _retry_after(response))
+        return response
+
     @abstractmethod
     def send(self, message: str) -> bool:
         """Отправляет сообщение. В классе-наследнике возвращает True при успехе."""
@@ -12,29 +65,138 @@ class NotificationSender(ABC):
 
 
 class TelegramSender(NotificationSender):
-    def __init__(self, token: str, chat_id: str):
+    def __init__(self, token: str, chat_id: str, api_url: str = "https://api.telegram.org"):
+        super().__init__()
         self.token = token
         self.chat_id = chat_id
+        self.api_url = api_url
 
     def send(self, message: str) -> bool:
-        url = f"https://api.telegram.org/bot{self.token}/sendMessage"
+        url = f"{self.api_url}/bot{self.token}/sendMessage"
         payload = {
             "chat_id": self.chat_id,
             "text": message
         }
-        response = requests.post(url, json=payload)
+        response = self.post(url, payload)
         return response.status_code == 200
 
 class SlackSender(NotificationSender):
     def __init__(self, webhook_url: str):
+        super().__init__()
         self.webhook_url = webhook_url
 
     def send(self, message: str) -> bool:
-        response = requests.post(self.webhook_url, json={"text": message})
+        response = self.post(self.webhook_url, {"text": message})
 
         return response.status_code == 200
 
 
+class NotificationDigest:
+    """
+    Копит сообщения пакета в Redis и отдаёт их одним дайджестом.
+
+    add() returns True for the first message of a window; the caller then
+    schedules one flush after `window` seconds. pop() takes all collected
+    messages and resets the window atomically, so a message added later
+    opens a new window instead of being lost.
+    """
+
+    key_prefix = 'notifications:'
+
+    def __init__(self, url: str, window: float):
+        self.client = redis.Redis.from_url(url)
+        self.window = window
+
+    def add(self, batch_key: str, message: str) -> bool:
+        key = self.key_prefix + batch_key
+        with self.client.pipeline() as pipe:
+            pipe.rpush(key, message)
+            # Safety net if the flush task is lost
+            pipe.expire(key, int(self.window * 10) + 60)
+            pipe.set(f"{key}:scheduled", 1, nx=True, ex=int(self.window) + 1)
+            _, _, scheduled = pipe.execute()
+        return bool(scheduled)
+
+    def pop(self, batch_key: str) -> list[str]:
+        key = self.key_prefix + batch_key
+        with self.client.pipeline() as pipe:
+            pipe.lrange(key, 0, -1)
+            pipe.delete(key, f"{key}:scheduled")
+            messages, _ = pipe.execute()
+        return [message.decode() for message in messages]
+
+
+def build_digest(messages: list[str], max_length: int | None = None) -> str:
+    """Собирает сообщения в один текст, не длиннее max_length символов."""
+    max_length = max_length or settings.NOTIFICATION_MAX_LENGTH
+    if len(messages) == 1:
+        return messages[0][:max_length]
+
+    lines = [f"{len(messages)} images processed:"]
+    length = len(lines[0])
+    for index, message in enumerate(messages):
+        tail = f"... and {len(messages) - index} more"
+        if length + len(message) + 1 > max_length - len(tail) - 1:
+            lines.append(tail)
+            break
+        lines.append(message)
+        length += len(message) + 1
+    return "\n".join(lines)
+
+
+class TokenBucket:
+    """
+    Token bucket в Redis, общий для всех воркеров.
+
+    Each backend has its own bucket refilled at `rate` tokens per second up
+    to `capacity`. acquire() takes a token and returns 0, or returns how many
+    seconds to wait for the next one without taking it. Refill and take run
+    in one Lua script, so concurrent workers never overspend a bucket. If
+    Redis is unavailable the limiter fails open.
+    """
+
+    key_prefix = 'rate-limit:'
+
+    script = """
+    local rate = tonumber(ARGV[1])
+    local capacity = tonumber(ARGV[2])
+    local now = tonumber(ARGV[3])
+    local state = redis.call('HMGET', KEYS[1], 'tokens', 'ts')
+    local tokens = tonumber(state[1]) or capacity
+    local ts = tonumber(state[2]) or now
+    tokens = math.min(capacity, tokens + math.max(0, now - ts) * rate)
+    local wait = 0
+    if tokens >= 1 then
+        tokens = tokens - 1
+    else
+        wait = (1 - tokens) / rate
+    end
+    redis.call('HSET', KEYS[1], 'tokens', tokens, 'ts', now)
+    redis.call('EXPIRE', KEYS[1], math.ceil(capacity / rate) + 1)
+    return tostring(wait)
+    """
+
+    def __init__(self, url: str, limits: dict[str, tuple[float, int]]):
+        self.client = redis.Redis.from_url(url)
+        self.limits = limits
+        self._acquire = self.client.register_script(self.script)
+
+    def acquire(self, backend: str) -> float:
+        if backend not in self.limits:
+            return 0.0
+        rate, capacity = self.limits[backend]
+        try:
+            return float(self._acquire(keys=[self.key_prefix + backend], args=[rate, capacity, time.time()]))
+        except redis.RedisError as e:
+            logger.warning(f"Rate limiter unavailable: {e}")
+            return 0.0
+
+
+def backoff(attempt: int) -> float:
+    """Экспоненциальная задержка перед повтором: base * 2^attempt, не больше NOTIFICATION_BACKOFF_MAX."""
+    return min(settings.NOTIFICATION_BACKOFF_MAX, settings.NOTIFICATION_BACKOFF_BASE * 2 ** attempt)
+
+
 telegram_sender = TelegramSender(
     token=settings.TLG_BOT_TOKEN,
     chat_id=settings.TLG_CHAT_ID
@@ -42,4 +204,11 @@ telegram_sender = TelegramSender(
 slack_sender = SlackSender(
     webhook_url=settings.SLACK_WEBHOOK_URL
 )
-
+notification_digest = NotificationDigest(
+    url=settings.NOTIFICATION_REDIS_URL,
+    window=settings.NOTIFICATION_DIGEST_WINDOW,
+)
+rate_limiter = TokenBucket(
+    url=settings.NOTIFICATION_REDIS_URL,
+    limits=settings.NOTIFICATION_RATE_LIMITS,
+)
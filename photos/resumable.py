@@ -0,0 +1,305 @@
+import os
+import json
+import time
+import uuid
+import fcntl
+import shutil
+import logging
+import tempfile
+from types import SimpleNamespace
+from contextlib import contextmanager
+
+from django.conf import settings
+from django.core.exceptions import ValidationError
+from django.core.files import File
+
+from .cache import result_cache
+from .metrics import count_rejection
+from .status import new_batch_id, save_batch
+from .storage import blob_store
+from .tasks import enqueue_images
+from .validators import BATCH_MAX_COUNT, FileValidationResult, ImageValidator, SIGNATURE_LENGTH
+
+
+logger = logging.getLogger(__name__)
+
+# File states; a complete file that could not be enqueued stays "uploaded" until finalize retries it
+UPLOADING = 'uploading'
+UPLOADED = 'uploaded'
+ENQUEUED = 'enqueued'
+CACHED = 'cached'
+REJECTED = 'rejected'
+DONE_STATES = (ENQUEUED, CACHED, REJECTED)
+
+
+class UnknownUpload(LookupError):
+    pass
+
+
+class OffsetMismatch(Exception):
+    """A chunk does not start where the stored part ends; the client resumes from offset."""
+
+    def __init__(self, message: str, offset: int):
+        super().__init__(message)
+        self.offset = offset
+
+
+class UploadSession:
+    """
+    A resumable upload of a batch: init → PUT chunks with offsets → finalize.
+
+    Everything lives in <UPLOAD_SESSION_ROOT>/<upload_id>/ on the shared
+    media volume, so any web worker can take the next request of a session:
+    session.json (the declared files, written once), <index>.part (the bytes
+    received so far; its size is the acknowledged offset) and <index>.json
+    (the file state, replaced atomically). Requests for one file are
+    serialized by an flock on <index>.lock.
+
+    A file is validated, moved into the blob store and enqueued by the
+    request that writes its last byte, while the rest of the batch may
+    still be uploading; finalize saves the batch for batch-status.
+    """
+
+    def __init__(self, upload_id: str):
+        self.upload_id = upload_id
+        self.directory = os.path.join(settings.UPLOAD_SESSION_ROOT, upload_id)
+
+    @classmethod
+    def create(cls, files: list[dict]) -> tuple['UploadSession', list[FileValidationResult]]:
+        """Starts a session for [{"name": ..., "size": ...}]; files failing the cheap checks are rejected upfront."""
+        if not files:
+            raise ValidationError("No files provided")
+        if len(files) > BATCH_MAX_COUNT:
+            raise ValidationError(
+                "Too many images (%(count)d > %(max)d)",
+                params={'count': len(files), 'max': BATCH_MAX_COUNT}, code='count',
+            )
+        try:
+            declared = [{'name': str(file['name']), 'size': int(file['size'])} for file in files]
+        except (KeyError, TypeError, ValueError):
+            raise ValidationError("Every file needs a name and a size")
+
+        cleanup_expired_sessions()
+        session = cls(str(uuid.uuid4()))
+        os.makedirs(session.directory)
+        session._write_json('session.json', {
+            'batch_id': new_batch_id(),
+            'created_at': time.time(),
+            'files': declared,
+        })
+
+        validator = ImageValidator()
+        results = []
+        for index, file in enumerate(declared):
+            result = FileValidationResult(file['name'])
+            try:
+                validator.validate_metadata(SimpleNamespace(**file))
+            except ValidationError as e:
+                result.error = e
+                count_rejection(e)
+                session._set_state(index, REJECTED, code=result.code, error=result.message)
+            else:
+                open(session._part_path(index), 'wb').close()
+                session._set_state(index, UPLOADING)
+            results.append(result)
+        logger.info("Upload session %s started for %s files", session.upload_id, len(declared))
+        return session, results
+
+    @property
+    def meta(self) -> dict:
+        try:
+            with open(os.path.join(self.directory, 'session.json')) as file:
+                return json.load(file)
+        except FileNotFoundError:
+            raise UnknownUpload(f"Unknown upload {self.upload_id}")
+
+    @property
+    def batch_id(self) -> str:
+        return self.meta['batch_id']
+
+    def status(self) -> dict:
+        meta = self.meta
+        files = []
+        for index, declared in enumerate(meta['files']):
+            state = self._state(index)
+            files.append({**declared, **self._file_status(index, state)})
+        return {'upload_id': self.upload_id, 'batch_id': meta['batch_id'], 'files': files}
+
+    def write_chunk(self, index: int, offset: int, stream, length: int) -> dict:
+        """Appends length bytes from stream at offset; completes the file when its last byte arrives."""
+        declared = self._declared(index)
+        with self._locked(index):
+            state = self._state(index)
+            if state['state'] != UPLOADING:
+                # A retried chunk of a finished file is acknowledged with its state
+                return self._complete(index, declared, state)
+
+            path = self._part_path(index)
+            current = os.path.getsize(path)
+            if offset != current:
+                raise OffsetMismatch(f"Expected offset {current}, got {offset}", current)
+            if offset + length > declared['size']:
+                raise ValidationError(
+                    "Chunk ends at %(end)d, past the declared size %(size)d",
+                    params={'end': offset + length, 'size': declared['size']},
+                )
+
+            with open(path, 'ab') as part:
+                remaining = length
+                while remaining:
+                    chunk = stream.read(min(remaining, 64 * 1024))
+                    if not chunk:
+                        break  # client went away; it resumes from the bytes written
+                    part.write(chunk)
+                    remaining -= len(chunk)
+                received = part.tell()
+
+            # Mislabeled content is rejected as soon as the signature has arrived
+            if current < SIGNATURE_LENGTH <= received:
+                with open(path, 'rb') as part:
+                    header = part.read(SIGNATURE_LENGTH)
+                try:
+                    ImageValidator().validate_signature(SimpleNamespace(**declared), header)
+                except ValidationError as e:
+                    return self._reject(index, e)
+
+            if received < declared['size']:
+                return self._file_status(index, state)
+            return self._complete(index, declared, state)
+
+    def complete(self, index: int) -> dict:
+        with self._locked(index):
+            return self._complete(index, self._declared(index), self._state(index))
+
+    def _complete(self, index: int, declared: dict, state: dict) -> dict:
+        """Validates a fully received file, moves it into the blob store and enqueues it."""
+        if state['state'] == UPLOADING:
+            path = self._part_path(index)
+            with open(path, 'rb') as part:
+                try:
+                    ImageValidator().validate_content(File(part, name=declared['name']))
+                except ValidationError as e:
+                    return self._reject(index, e)
+            digest, created = blob_store.adopt(path)
+            if not created:
+                logger.info("Repeat upload of %s (%s)", declared['name'], digest)
+            state = self._set_state(index, UPLOADED, digest=digest)
+
+        if state['state'] == UPLOADED:
+            digest = state['digest']
+            cached = result_cache.get_many([digest])
+            if digest in cached:
+                state = self._set_state(index, CACHED, digest=digest, result=cached[digest])
+            else:
+                # A broker error leaves the file "uploaded"; the next chunk retry or finalize enqueues it.
+                # The declared index orders the batch like finalize's task_ids.
+                [task_id] = enqueue_images([(declared['name'], digest)], self.batch_id, first_index=index)
+                state = self._set_state(index, ENQUEUED, digest=digest, task_id=task_id)
+        return self._file_status(index, state)
+
+    def finalize(self) -> dict:
+        """Completes the batch once every file is received: saves it for batch-status and removes the session."""
+        status = self.status()
+        incomplete = [file['index'] for file in status['files'] if file['offset'] < file['size']
+                      and file['state'] not in DONE_STATES]
+        if incomplete:
+            raise ValidationError(
+                "Files not fully uploaded: %(files)s", params={'files': ', '.join(map(str, incomplete))}
+            )
+
+        files = [file if file['state'] in DONE_STATES else self.complete(file['index']) for file in status['files']]
+        task_ids = [file['task_id'] for file in files if file['state'] == ENQUEUED]
+        batch_id = status['batch_id'] if task_ids else None
+        if task_ids:
+            save_batch(task_ids, batch_id)
+        shutil.rmtree(self.directory, ignore_errors=True)
+        logger.info("Upload session %s finalized: %s tasks", self.upload_id, len(task_ids))
+
+        declared = {file['index']: file['name'] for file in status['files']}
+        return {
+            'batch_id': batch_id,
+            'task_ids': task_ids,
+            'valid_images': [declared[file['index']] for file in files if file['state'] == ENQUEUED],
+            'digests': [file['digest'] for file in files if file['state'] == ENQUEUED],
+            'cached': [
+                {'file_name': declared[file['index']], 'digest': file['digest'], 'result': file['result']}
+                for file in files if file['state'] == CACHED
+            ],
+            'rejected': [
+                {'file_name': declared[file['index']], 'valid': False, 'code': file['code'], 'error': file['error']}
+                for file in files if file['state'] == REJECTED
+            ],
+        }
+
+    def _declared(self, index: int) -> dict:
+        files = self.meta['files']
+        if not 0 <= index < len(files):
+            raise UnknownUpload(f"Unknown file {index} of upload {self.upload_id}")
+        return files[index]
+
+    def _reject(self, index: int, error: ValidationError) -> dict:
+        result = FileValidationResult(self._declared(index)['name'], error=error)
+        logger.warning("Invalid image %s: %s", result.name, result.message)
+        count_rejection(error)
+        state = self._set_state(index, REJECTED, code=result.code, error=result.message)
+        try:
+            os.remove(self._part_path(index))
+        except FileNotFoundError:
+            pass
+        return self._file_status(index, state)
+
+    @contextmanager
+    def _locked(self, index: int):
+        """Serializes the requests touching one file, across threads and processes."""
+        with open(os.path.join(self.directory, f"{index}.lock"), 'a') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            yield
+
+    def _file_status(self, index: int, state: dict) -> dict:
+        return {'index': index, 'offset': self._offset(index, state), **state}
+
+    def _part_path(self, index: int) -> str:
+        return os.path.join(self.directory, f"{index}.part")
+
+    def _offset(self, index: int, state: dict) -> int:
+        if state['state'] in (UPLOADED, ENQUEUED, CACHED):
+            return self._declared(index)['size']
+        try:
+            return os.path.getsize(self._part_path(index))
+        except FileNotFoundError:
+            return 0
+
+    def _state(self, index: int) -> dict:
+        try:
+            with open(os.path.join(self.directory, f"{index}.json")) as file:
+                return json.load(file)
+        except FileNotFoundError:
+            self.meta  # raises UnknownUpload for a removed session
+            raise UnknownUpload(f"Unknown file {index} of upload {self.upload_id}")
+
+    def _set_state(self, index: int, state: str, **fields) -> dict:
+        data = {'state': state, **fields}
+        self._write_json(f"{index}.json", data)
+        return data
+
+    def _write_json(self, name: str, data: dict):
+        fd, tmp_path = tempfile.mkstemp(dir=self.directory, suffix='.tmp')
+        with os.fdopen(fd, 'w') as file:
+            json.dump(data, file, default=str)
+        os.replace(tmp_path, os.path.join(self.directory, name))
+
+
+def cleanup_expired_sessions():
+    """Removes sessions not finalized within UPLOAD_SESSION_TTL seconds."""
+    root = settings.UPLOAD_SESSION_ROOT
+    if not os.path.isdir(root):
+        return
+    deadline = time.time() - settings.UPLOAD_SESSION_TTL
+    for name in os.listdir(root):
+        path = os.path.join(root, name)
+        try:
+            if os.path.getmtime(os.path.join(path, 'session.json')) < deadline:
+                shutil.rmtree(path, ignore_errors=True)
+                logger.info("Upload session %s expired", name)
+        except (FileNotFoundError, NotADirectoryError):
+            continue
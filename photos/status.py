@@ -0,0 +1,215 @@
+import json
+import time
+import uuid
+import logging
+
+from asgiref.sync import sync_to_async
+from celery import states
+from celery.backends.base import BaseKeyValueStoreBackend
+from celery.backends.redis import RedisBackend
+from celery.result import AsyncResult, GroupResult
+from django.conf import settings
+from django.db.models import F
+from redis import asyncio as aioredis
+
+from config.celery import app
+from .models import ImageRecord
+
+
+logger = logging.getLogger(__name__)
+
+# One character per state keeps the client cursor at one byte per task
+STATE_CODES = {
+    states.PENDING: 'P',
+    states.RECEIVED: 'V',
+    states.STARTED: 'T',
+    states.RETRY: 'R',
+    states.SUCCESS: 'S',
+    states.FAILURE: 'F',
+    states.REVOKED: 'X',
+}
+UNKNOWN_STATE_CODE = '?'
+
+
+def new_batch_id() -> str:
+    return str(uuid.uuid4())
+
+
+def save_batch(task_ids: list[str], batch_id: str) -> str:
+    """Stores the task ids of an upload batch under the batch id."""
+    GroupResult(batch_id, [AsyncResult(task_id, app=app) for task_id in task_ids], app=app).save()
+    return batch_id
+
+
+def restore_batch(batch_id: str) -> list[str] | None:
+    """Returns the task ids of a stored batch or None if it is unknown.
+
+    Once the GroupResult has expired the ids are read from ImageRecord in
+    the order of their batch_index, the position the task was enqueued
+    at, so a client's cursor stays valid; only processed files are known
+    there.
+    """
+    group = GroupResult.restore(batch_id, app=app)
+    if group is not None:
+        return [result.id for result in group.results]
+    task_ids = list(
+        ImageRecord.objects.filter(batch_id=batch_id).exclude(task_id=None)
+        .order_by(F('batch_index').asc(nulls_last=True), 'created_at', 'pk').values_list('task_id', flat=True)
+    )
+    return task_ids or None
+
+
+def fetch_task_meta(task_ids: list[str]) -> dict[str, dict]:
+    """Reads the result meta of all tasks.
+
+    Key-value backends (Redis) are read with a single MGET; other backends
+    fall back to one AsyncResult lookup per task.
+    """
+    backend = app.backend
+    if not isinstance(backend, BaseKeyValueStoreBackend):
+        metas = {
+            task_id: {'status': result.status, 'result': result.result}
+            for task_id, result in ((task_id, AsyncResult(task_id, app=app)) for task_id in task_ids)
+        }
+        metas.update(fetch_record_results([
+            task_id for task_id, meta in metas.items() if meta['status'] == states.PENDING
+        ]))
+        return metas
+
+    values = backend.mget([backend.get_key_for_task(task_id) for task_id in task_ids])
+    if hasattr(values, 'items'):
+        values = [values.get(backend.get_key_for_task(task_id)) for task_id in task_ids]
+
+    metas, missing = {}, []
+    for task_id, value in zip(task_ids, values):
+        if value is None:
+            metas[task_id] = {'status': states.PENDING, 'result': None}
+            missing.append(task_id)
+        else:
+            metas[task_id] = backend.decode_result(value)
+    metas.update(fetch_record_results(missing))
+    return metas
+
+
+def fetch_record_results(task_ids: list[str]) -> dict[str, dict]:
+    """Rebuilds the meta of finished tasks from ImageRecord.
+
+    Backend entries expire after CELERY_RESULT_EXPIRES; a task without one is
+    either not finished yet or expired, and only the latter has a record.
+    """
+    if not task_ids:
+        return {}
+    records = ImageRecord.objects.filter(task_id__in=task_ids).only(
+        *ImageRecord.RESULT_FIELDS, 'task_id', 'status', 'error'
+    )
+    return {
+        record.task_id: (
+            {'status': states.SUCCESS, 'result': record.as_result()}
+            if record.status == ImageRecord.SUCCESS
+            else {'status': states.FAILURE, 'result': record.error}
+        )
+        for record in records
+    }
+
+
+def task_status_data(meta: dict) -> dict:
+    """Builds the same per-task payload TaskStatusView returns."""
+    status = meta['status']
+    data = {
+        'status': status,
+        'result': meta['result'] if status == states.SUCCESS else None,
+    }
+    if status == states.FAILURE:
+        data['error'] = str(meta['result'])
+    return data
+
+
+def encode_cursor(task_ids: list[str], metas: dict[str, dict]) -> str:
+    return ''.join(
+        STATE_CODES.get(metas[task_id]['status'], UNKNOWN_STATE_CODE) for task_id in task_ids
+    )
+
+
+def batch_status(task_ids: list[str], cursor: str = '') -> dict:
+    """Resolves a batch of tasks and returns only those changed since the cursor.
+
+    The cursor is the string of state codes returned by the previous call,
+    one character per task in the order of task_ids.
+    """
+    metas = fetch_task_meta(task_ids)
+    new_cursor = encode_cursor(task_ids, metas)
+
+    tasks = {}
+    for index, task_id in enumerate(task_ids):
+        previous = cursor[index] if index < len(cursor) else None
+        if previous != new_cursor[index]:
+            tasks[task_id] = task_status_data(metas[task_id])
+
+    completed = sum(1 for meta in metas.values() if meta['status'] in states.READY_STATES)
+    return {
+        'cursor': new_cursor,
+        'total': len(task_ids),
+        'completed': completed,
+        'tasks': tasks,
+    }
+
+
+def supports_streaming() -> bool:
+    """Streaming relies on the PUBLISH the Redis result backend issues on every state change."""
+    return isinstance(app.backend, RedisBackend)
+
+
+def async_result_client() -> aioredis.Redis:
+    return aioredis.Redis.from_url(app.conf.result_backend)
+
+
+def format_event(event: str, data: dict) -> str:
+    return f"event: {event}\ndata: {json.dumps(data, default=str)}\n\n"
+
+
+async def stream_batch_events(task_ids: list[str]):
+    """Yields Server-Sent Events for every state transition of the batch tasks.
+
+    Subscribes to the result backend channels before taking the initial
+    snapshot, so no transition between the two can be missed. The stream
+    ends with a "done" event once all tasks are ready or on timeout.
+    """
+    backend = app.backend
+    channels = {backend.get_key_for_task(task_id).decode(): task_id for task_id in task_ids}
+    client = async_result_client()
+    pubsub = client.pubsub()
+    try:
+        await pubsub.subscribe(*channels)
+
+        metas = await sync_to_async(fetch_task_meta)(task_ids)
+        statuses = {}
+        for task_id in task_ids:
+            statuses[task_id] = metas[task_id]['status']
+            yield format_event('status', {'task_id': task_id, **task_status_data(metas[task_id])})
+
+        deadline = time.monotonic() + settings.BATCH_EVENTS_TIMEOUT
+        while any(status not in states.READY_STATES for status in statuses.values()):
+            if time.monotonic() >= deadline:
+                break
+            message = await pubsub.get_message(
+                ignore_subscribe_messages=True, timeout=settings.BATCH_EVENTS_KEEPALIVE
+            )
+            if message is None:
+                yield ": keepalive\n\n"
+                continue
+
+            channel = message['channel']
+            task_id = channels.get(channel.decode() if isinstance(channel, bytes) else channel)
+            if task_id is None:
+                continue
+            meta = backend.decode_result(message['data'])
+            if meta['status'] != statuses[task_id]:
+                statuses[task_id] = meta['status']
+                yield format_event('status', {'task_id': task_id, **task_status_data(meta)})
+
+        completed = sum(1 for status in statuses.values() if status in states.READY_STATES)
+        yield format_event('done', {'total': len(task_ids), 'completed': completed})
+
+    finally:
+        await pubsub.aclose()
+        await client.aclose()
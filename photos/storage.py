@@ -0,0 +1,147 @@
+import io
+import os
+import mmap
+import hashlib
+import logging
+import tempfile
+from contextlib import contextmanager
+
+from django.conf import settings
+
+from .cache import blob_pins
+
+
+logger = logging.getLogger(__name__)
+
+
+class BlobStore:
+    """Content-addressed local file store.
+
+    Files are keyed by their SHA-256 hex digest and sharded into
+    <root>/<digest[:2]>/<digest[2:4]>/<digest>. Writes go to a temporary file
+    inside the store and are moved into place with an atomic rename, so a
+    blob path either does not exist or holds the complete file.
+    """
+
+    def __init__(self, root: str | None = None):
+        self._root = root
+
+    @property
+    def root(self) -> str:
+        return self._root or settings.BLOB_STORE_ROOT
+
+    def path(self, digest: str) -> str:
+        return os.path.join(self.root, digest[:2], digest[2:4], digest)
+
+    def exists(self, digest: str) -> bool:
+        return os.path.exists(self.path(digest))
+
+    def writer(self) -> 'BlobWriter':
+        return BlobWriter(self)
+
+    def save(self, file) -> tuple[str, bool]:
+        """Streams a Django File into the store.
+
+        Returns:
+            tuple[str, bool]: The digest and whether the blob is new
+        """
+        writer = self.writer()
+        try:
+            for chunk in file.chunks():
+                writer.write(chunk)
+            return writer.commit()
+        except BaseException:
+            writer.abort()
+            raise
+
+    def adopt(self, path: str) -> tuple[str, bool]:
+        """Moves a complete file from the same filesystem into the store (hashing it, without a copy).
+
+        Returns:
+            tuple[str, bool]: The digest and whether the blob is new
+        """
+        sha256 = hashlib.sha256()
+        with open(path, 'rb') as file:
+            while chunk := file.read(1024 * 1024):
+                sha256.update(chunk)
+        return self._commit(path, sha256.hexdigest())
+
+    def delete(self, digest: str) -> bool:
+        """Removes a blob unless another upload pinned it (see photos.cache.BlobPins); returns whether it did.
+
+        The blob is first moved aside and the pin checked afterwards: an
+        upload that pinned it before the move keeps it (it is moved back),
+        one that looks after the move finds no blob and stores its own copy.
+        """
+        tmp_dir = os.path.join(self.root, 'tmp')
+        os.makedirs(tmp_dir, exist_ok=True)
+        fd, removed_path = tempfile.mkstemp(dir=tmp_dir, suffix='.removed')
+        os.close(fd)
+        try:
+            os.replace(self.path(digest), removed_path)
+        except FileNotFoundError:
+            os.remove(removed_path)
+            return False
+        if blob_pins.is_pinned(digest):
+            os.replace(removed_path, self.path(digest))
+            logger.info("Blob %s kept, used by another upload", digest)
+            return False
+        os.remove(removed_path)
+        logger.info("Blob %s removed", digest)
+        return True
+
+    def _commit(self, tmp_path: str, digest: str) -> tuple[str, bool]:
+        path = self.path(digest)
+        if os.path.exists(path):
+            # Pinned before it is relied on, then checked again: a delete that moved it aside in between
+            # either sees the pin or leaves this upload to store its own copy
+            blob_pins.pin(digest)
+            if os.path.exists(path):
+                os.remove(tmp_path)
+                logger.info("Blob %s already stored", digest)
+                return digest, False
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        os.replace(tmp_path, path)
+        return digest, True
+
+    @contextmanager
+    def open(self, digest: str):
+        """Yields a read-only memory map of the blob (file-like: read, seek, tell)."""
+        with open(self.path(digest), 'rb') as file:
+            if os.fstat(file.fileno()).st_size == 0:
+                yield io.BytesIO()
+                return
+            with mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as buffer:
+                yield buffer
+
+
+class BlobWriter:
+    """Incremental write of one blob: hashes chunks as they are written to a temp file."""
+
+    def __init__(self, store: BlobStore):
+        self.store = store
+        self.size = 0
+        self._sha256 = hashlib.sha256()
+        tmp_dir = os.path.join(store.root, 'tmp')
+        os.makedirs(tmp_dir, exist_ok=True)
+        fd, self._tmp_path = tempfile.mkstemp(dir=tmp_dir)
+        self._tmp = os.fdopen(fd, 'wb')
+
+    def write(self, chunk: bytes):
+        self._sha256.update(chunk)
+        self._tmp.write(chunk)
+        self.size += len(chunk)
+
+    def commit(self) -> tuple[str, bool]:
+        self._tmp.flush()
+        os.fsync(self._tmp.fileno())
+        self._tmp.close()
+        return self.store._commit(self._tmp_path, self._sha256.hexdigest())
+
+    def abort(self):
+        self._tmp.close()
+        if os.path.exists(self._tmp_path):
+            os.remove(self._tmp_path)
+
+
+blob_store = BlobStore()
@@ -0,0 +1,243 @@
+import json
+import asyncio
+import logging
+
+from asgiref.sync import sync_to_async
+from django.core import signals
+from django.core.exceptions import DisallowedHost, TooManyFilesSent, ValidationError
+from django.core.handlers.asgi import ASGIRequest
+from django.core.handlers.exception import response_for_exception
+from django.http import HttpResponse, JsonResponse
+from django.http.multipartparser import MultiPartParser
+from django.http.request import UnreadablePostError
+from django.middleware.clickjacking import XFrameOptionsMiddleware
+from django.middleware.security import SecurityMiddleware
+
+from config.celery import check_celery_available, run_in_broker_executor
+from .cache import result_cache
+from .metrics import count_rejection
+from .status import new_batch_id, save_batch
+from .tasks import aenqueue_images
+from .uploadhandlers import PipelinedUploadHandler, discard_new_blobs
+from .validators import BATCH_MAX_COUNT, FileValidationResult, ImageValidator, too_many_images
+from .views import (
+    check_csrf_header, files_limit_error, store_image, upload_data, upload_error_data, upload_error_response,
+)
+
+
+logger = logging.getLogger(__name__)
+
+STREAM_PATH = '/api/upload/stream/'
+STREAM_HEADERS = {
+    'Content-Type': 'application/x-ndjson',
+    'Cache-Control': 'no-cache',
+    'X-Accel-Buffering': 'no',
+}
+# Middleware of settings.MIDDLEWARE that only add response headers; the app applies them itself
+HEADER_MIDDLEWARE = (SecurityMiddleware, XFrameOptionsMiddleware)
+
+
+class ReceiveStream:
+    """
+    File-like request body read straight from ASGI receive by a parser in a worker thread.
+
+    Every read waits for the next http.request message only when nothing is
+    buffered, and returns what has arrived so far, so the parser sees each
+    part as soon as its bytes come off the network and the client is never
+    read ahead of the parser.
+    """
+
+    def __init__(self, receive, loop: asyncio.AbstractEventLoop):
+        self._receive = receive
+        self._loop = loop
+        self._buffer = b''
+        self._more_body = True
+        self._closed = False
+
+    def read(self, size: int = -1) -> bytes:
+        while self._more_body and (not self._buffer or size < 0):
+            self._receive_message()
+        return self._take(len(self._buffer) if size < 0 else size)
+
+    def readline(self, size: int = -1) -> bytes:
+        while self._more_body and b'\n' not in self._buffer:
+            self._receive_message()
+        end = self._buffer.find(b'\n') + 1 or len(self._buffer)
+        return self._take(end if size < 0 else min(end, size))
+
+    def close(self):
+        """Fails the next read of a parser still running, e.g. after the response ended with an error."""
+        self._closed = True
+
+    def _receive_message(self):
+        if self._closed:
+            raise UnreadablePostError("Request closed during upload")
+        message = asyncio.run_coroutine_threadsafe(self._receive(), self._loop).result()
+        if message['type'] == 'http.disconnect':
+            raise UnreadablePostError("Client disconnected during upload")
+        self._buffer += message.get('body', b'')
+        self._more_body = message.get('more_body', False)
+
+    def _take(self, size: int) -> bytes:
+        data, self._buffer = self._buffer[:size], self._buffer[size:]
+        return data
+
+
+def ndjson(data: dict) -> bytes:
+    return (json.dumps(data, default=str) + "\n").encode()
+
+
+async def stream_upload(request):
+    """
+    Yields an NDJSON line for every file of a multipart body as soon as its part is received.
+
+    The body is parsed in a worker thread; PipelinedUploadHandler validates
+    and stores each file while it is received and hands it over when its
+    part ends. Here the file gets its header check, a result cache lookup
+    and its image_task, while the next part is still being uploaded.
+    Lines: "queued" (task_id), "cached" (result), "rejected" (code, error),
+    then "complete" with the /api/upload/ response or "error".
+    """
+    loop = asyncio.get_running_loop()
+    events = asyncio.Queue()
+
+    def put(item):
+        loop.call_soon_threadsafe(events.put_nowait, item)
+
+    def parse():
+        handler = PipelinedUploadHandler(request, put)
+        try:
+            request._post, request._files = MultiPartParser(request.META, request, [handler], request.encoding).parse()
+        except TooManyFilesSent:
+            handler.discard()
+            raise files_limit_error() from None
+        except BaseException:
+            handler.discard()
+            raise
+        finally:
+            put(None)
+
+    parsing = asyncio.ensure_future(sync_to_async(parse, thread_sensitive=False)())
+    validator = ImageValidator()
+    batch_id = new_batch_id()
+    results, files, cached_files, task_ids = [], [], [], []
+    kept = set()
+    try:
+        while (item := await events.get()) is not None:
+            if isinstance(item, FileValidationResult):
+                result = item
+            else:
+                result = FileValidationResult(item.name, item)
+                try:
+                    # Rejected files count towards the batch size, as in ImageBatchValidator
+                    if len(results) >= BATCH_MAX_COUNT:
+                        raise too_many_images(len(results) + 1, BATCH_MAX_COUNT)
+                    await sync_to_async(validator.validate_content, thread_sensitive=False)(item)
+                except ValidationError as e:
+                    result.error = e
+                    logger.warning("Invalid image %s: %s", result.name, result.message)
+                    count_rejection(e)
+                except ValueError:
+                    if not item.closed:
+                        raise
+                    break  # a failed parser closes the files it handed over; its error is raised below
+            results.append(result)
+            if not result.valid:
+                yield ndjson({'event': 'rejected', **result.as_dict()})
+                continue
+
+            digest = store_image(item)
+            kept.add(digest)
+            cached = await sync_to_async(result_cache.get_many)([digest])
+            if digest in cached:
+                cached_files.append({'file_name': item.name, 'digest': digest, 'result': cached[digest]})
+                yield ndjson({'event': 'cached', **cached_files[-1]})
+                continue
+
+            [task_id] = await aenqueue_images([(item.name, digest)], batch_id, first_index=len(results) - 1)
+            files.append((item.name, digest))
+            task_ids.append(task_id)
+            yield ndjson({'event': 'queued', 'file_name': item.name, 'digest': digest, 'task_id': task_id})
+
+        await parsing
+        if not results:
+            raise ValidationError("No files provided")
+        error = None
+    except Exception as e:
+        error = e
+    finally:
+        if task_ids:
+            await run_in_broker_executor(save_batch, task_ids, batch_id)
+        # After an error the parser may still store files; they are removed once it is done
+        parsing.add_done_callback(lambda _: discard_new_blobs(request, kept))
+
+    if error is not None:
+        data, status = upload_error_data(error)
+        yield ndjson({'event': 'error', 'status': status, **data})
+    else:
+        data = upload_data(batch_id if task_ids else None, task_ids, files, cached_files, results)
+        yield ndjson({'event': 'complete', **data})
+
+
+async def send_start(send, request, response):
+    for middleware in HEADER_MIDDLEWARE:
+        response = middleware(lambda request: response).process_response(request, response)
+    headers = [(name.encode('latin1'), value.encode('latin1')) for name, value in response.items()]
+    await send({'type': 'http.response.start', 'status': response.status_code, 'headers': headers})
+
+
+async def send_response(send, request, response):
+    await send_start(send, request, response)
+    await send({'type': 'http.response.body', 'body': response.content})
+
+
+async def streaming_upload_app(scope, receive, send):
+    """
+    ASGI app for POST /api/upload/stream/, mounted by config.asgi in front of Django.
+
+    Django's ASGIHandler receives the whole body before it calls a view, so
+    this endpoint reads receive itself: files are enqueued while the rest
+    of the batch is still being uploaded. It bypasses the middleware stack,
+    so it does their part itself: the host is checked against ALLOWED_HOSTS,
+    the headers of HEADER_MIDDLEWARE are added, and the CSRF token is
+    checked from the X-CSRFToken header as in AsyncUploadView.
+    """
+    await signals.request_started.asend(sender=streaming_upload_app, scope=scope)
+    try:
+        request = ASGIRequest(scope, ReceiveStream(receive, asyncio.get_running_loop()))
+        try:
+            await respond(request, send)
+        finally:
+            request.close()
+    finally:
+        await signals.request_finished.asend(sender=streaming_upload_app)
+
+
+async def respond(request, send):
+    try:
+        request.get_host()
+    except DisallowedHost as e:
+        await send_response(send, request, await sync_to_async(response_for_exception)(request, e))
+        return
+    if request.method != 'POST':
+        await send_response(send, request, JsonResponse({"error": "Method not allowed"}, status=405))
+        return
+    forbidden = check_csrf_header(request)
+    if forbidden is not None:
+        await send_response(send, request, forbidden)
+        return
+    if request.content_type != 'multipart/form-data' or not request.META.get('CONTENT_LENGTH'):
+        await send_response(send, request, JsonResponse(
+            {"error": "Expected a multipart/form-data body with Content-Length"}, status=400,
+        ))
+        return
+    try:
+        await run_in_broker_executor(check_celery_available)
+    except Exception as e:
+        await send_response(send, request, upload_error_response(e))
+        return
+
+    await send_start(send, request, HttpResponse(headers=STREAM_HEADERS))
+    async for line in stream_upload(request):
+        await send({'type': 'http.response.body', 'body': line, 'more_body': True})
+    await send({'type': 'http.response.body', 'body': b''})
@@ -1,63 +1,320 @@
 import os
+import asyncio
 from importlib import import_module
 
 from django.conf import settings
 from django.db import OperationalError
-from django.forms.models import model_to_dict
-from celery import shared_task, group
+from celery import shared_task, uuid
+from celery.exceptions import Ignore
+
+from config.celery import run_in_broker_executor
 from urllib3.exceptions import NameResolutionError
 
-from .handlers import image_handler, get_handler
-from .models import ImageRecord
+from .cache import result_cache, task_checkpoints
+from .handlers import get_handler
+from .metrics import HANDLER_DURATION, HANDLER_SKIPPED, NOTIFICATION_DURATION, NOTIFICATIONS
+from .models import FailedNotification, ImageRecord
+from .notifications import RateLimitError, backoff, build_digest, notification_digest, rate_limiter
+from .writers import image_record_writer
 import logging
 
 
 logger = logging.getLogger(__name__)
 
-@shared_task(bind=True, max_retries=3, default_retry_delay=5)
-def image_task(self, file_name: str) -> dict | None:
+
+def enqueue_images(files: list[tuple[str, str]], batch_id: str | None = None, first_index: int = 0) -> list[str]:
+    """Schedules processing of (file_name, digest) pairs and returns one task id per file.
+
+    Every file carries its position in the batch (first_index onwards),
+    which its ImageRecord keeps for restore_batch. In "batch" dispatch mode the files are sent as chunks of
+    UPLOAD_BATCH_CHUNK_SIZE per image_batch_task message; the returned ids
+    are pre-assigned sub-ids the batch task stores per-file results under.
+    """
+    if settings.UPLOAD_DISPATCH_MODE != 'batch':
+        task_ids = []
+        for index, (file_name, digest) in enumerate(files, first_index):
+            logger.info("Processing file: %s", file_name)
+            task_ids.append(image_task.delay(file_name, digest, batch_id, index).id)
+        return task_ids
+
+    files = [(uuid(), file_name, digest) for file_name, digest in files]
+    for start, chunk in _chunks(files):
+        logger.info("Processing %s files in one batch task", len(chunk))
+        image_batch_task.delay(chunk, batch_id, first_index + start)
+    return [sub_id for sub_id, _, _ in files]
+
+
+async def aenqueue_images(files: list[tuple[str, str]], batch_id: str | None = None, first_index: int = 0) -> list[str]:
+    """Async enqueue_images: the messages are published concurrently in the broker executor."""
+    if settings.UPLOAD_DISPATCH_MODE != 'batch':
+        logger.info("Processing %s files", len(files))
+        results = await asyncio.gather(*(
+            run_in_broker_executor(image_task.delay, file_name, digest, batch_id, index)
+            for index, (file_name, digest) in enumerate(files, first_index)
+        ))
+        return [result.id for result in results]
+
+    files = [(uuid(), file_name, digest) for file_name, digest in files]
+    chunks = _chunks(files)
+    logger.info("Processing %s files in %s batch tasks", len(files), len(chunks))
+    await asyncio.gather(*(
+        run_in_broker_executor(image_batch_task.delay, chunk, batch_id, first_index + start) for start, chunk in chunks
+    ))
+    return [sub_id for sub_id, _, _ in files]
+
+
+def _chunks(files: list) -> list[tuple[int, list]]:
+    """Splits files into (offset of the first file, files) chunks of UPLOAD_BATCH_CHUNK_SIZE."""
+    chunk_size = settings.UPLOAD_BATCH_CHUNK_SIZE
+    return [(start, files[start:start + chunk_size]) for start in range(0, len(files), chunk_size)]
+
+
+def _record_result(task_id: str, record, execution_time: float, batch_id: str | None = None) -> dict:
+    data = record.as_result()
+    if record.content_hash:
+        result_cache.set(record.content_hash, data)
+
+    msg = f"Task {task_id}: {data}"
+    logger.info(msg, extra=data)
+
+    summary = f"{record.format} {record.width}x{record.height}, " if record.width else ""
+    _notify(batch_id or task_id, f"{record.file_name}: {summary}{execution_time}s")
+
+    return data
+
+
+def _record_failure(task_id: str, file_name: str, digest: str | None, batch_id: str | None, error: Exception,
+                    batch_index: int | None = None):
+    """Сохраняет ошибку обработки, чтобы статус задачи пережил истечение результата в бэкенде."""
     try:
-        num, execution_time = image_handler(file_name)
-        record = ImageRecord.objects.create(file_name=file_name, image_random_num=num)
-        data = model_to_dict(record)
-        data["execution_time"] = execution_time
+        ImageRecord.objects.get_or_create(task_id=task_id, defaults={
+            'file_name': file_name,
+            'content_hash': digest or '',
+            'batch_id': batch_id or '',
+            'batch_index': batch_index,
+            'status': ImageRecord.FAILURE,
+            'error': f"{type(error).__name__}: {error}",
+        })
+    except Exception as e:
+        logger.error(f"Failure record error: {e}")
 
-        msg = f"Task {self.request.id}: {data}"
-        logger.info(msg, extra=data)
 
-        # Send notifications to all backends
-        alert_group = group(
-            send_alert_task.s(backend, msg) for backend in settings.NOTIFICATION_BACKENDS
-        )
-        alert_group.delay()  # Запускаем все таски параллельно
+def _notify(key: str, message: str):
+    """Добавляет сообщение в дайджест; первое сообщение окна планирует отправку."""
+    if not settings.NOTIFICATION_BACKENDS:
+        return
+    try:
+        if notification_digest.add(key, message):
+            send_digest_task.apply_async((key,), countdown=notification_digest.window)
+    except Exception as e:
+        logger.error(f"Notification error: {e}")
+
+
+def _finished_records(task_ids: list[str]) -> dict[str, ImageRecord]:
+    """Successful records of tasks that already ran (a redelivered or retried message)."""
+    records = ImageRecord.objects.filter(task_id__in=task_ids, status=ImageRecord.SUCCESS)
+    return {record.task_id: record for record in records.only(*ImageRecord.RESULT_FIELDS, 'task_id')}
+
+
+def _run_handler(task_id: str, file_name: str, digest: str | None, checkpoint: tuple | None = None):
+    """Handler output for the task: the checkpoint of an earlier attempt, else a fresh run that is checkpointed."""
+    if checkpoint is not None:
+        HANDLER_SKIPPED.labels(reason='checkpoint').inc()
+        logger.info("Task %s: reusing handler output of an earlier attempt", task_id)
+        return checkpoint
+    with HANDLER_DURATION.labels(handler=settings.IMAGE_HANDLER).time():
+        fields, execution_time = get_handler(settings.IMAGE_HANDLER)(file_name, digest)
+    task_checkpoints.set_output(task_id, fields, execution_time)
+    return fields, execution_time
 
-        return data
+
+def _acquire_lock(task, lock_id: str) -> str:
+    """Takes the task lock and returns its token; while another delivery of the message holds it, retries later.
+
+    These retries are unlimited and not counted against max_retries. A
+    killed worker stops renewing its lock, so it expires within
+    TASK_LOCK_TTL; a lock still held after waiting that long belongs to a
+    live delivery, which stores the result under the same task id.
+    """
+    token = task_checkpoints.acquire(lock_id)
+    if token is not None:
+        return token
+    waits = task_checkpoints.count_lock_wait(lock_id)
+    if (waits - 1) * settings.TASK_LOCK_RETRY_DELAY > settings.TASK_LOCK_TTL:
+        logger.info("Task %s is being processed by another worker", lock_id)
+        raise Ignore()
+    raise task.retry(countdown=settings.TASK_LOCK_RETRY_DELAY, max_retries=None)
+
+
+def _retry(task, lock_id: str, token: str, **kwargs):
+    """Releases the task lock before retrying: the retry may start before this attempt returns (always when eager).
+
+    Retries spent waiting for the lock do not use up the max_retries budget.
+    """
+    task_checkpoints.release(lock_id, token)
+    max_retries = task.max_retries + task_checkpoints.lock_waits(lock_id)
+    return task.retry(max_retries=max_retries, **kwargs)
+
+
+@shared_task(bind=True, max_retries=3, default_retry_delay=5)
+def image_task(self, file_name: str, digest: str | None = None, batch_id: str | None = None,
+               batch_index: int | None = None) -> dict | None:
+    """Обрабатывает один файл; идемпотентна по task id.
+
+    A message that already produced a record returns that record, a retry
+    reuses the checkpointed handler output, and the record is upserted on
+    task_id, so retries and broker redelivery never run the handler twice
+    or insert a second row.
+    """
+    task_id = self.request.id
+    token = _acquire_lock(self, task_id)
+    stop_renewal = task_checkpoints.keep_alive(task_id, token)
+    try:
+        record = _finished_records([task_id]).get(task_id)
+        if record is not None:
+            HANDLER_SKIPPED.labels(reason='recorded').inc()
+            logger.info("Task %s already processed", task_id)
+            return record.as_result()
+
+        fields, execution_time = _run_handler(task_id, file_name, digest, task_checkpoints.get_output(task_id))
+        record = image_record_writer.write(
+            task_id=task_id, file_name=file_name, content_hash=digest or '', batch_id=batch_id or '',
+            batch_index=batch_index, execution_time=execution_time, **fields
+        )
+        task_checkpoints.delete_outputs([task_id])
+        return _record_result(task_id, record, execution_time, batch_id)
 
     except OperationalError as exc:
-        self.retry(exc=exc)  # Will propagate to result backend
+        _retry(self, task_id, token, exc=exc)  # Will propagate to result backend
     except NameResolutionError as exc:
         # Immediate failure for DNS issues
-        raise self.retry(exc=exc, countdown=60)  # Long delay
+        raise _retry(self, task_id, token, exc=exc, countdown=60)  # Long delay
     except Exception as e:
         logger.error(f"{type(e).__name__}: {e}")
+        _record_failure(task_id, file_name, digest, batch_id, e, batch_index)
+        raise  # stored as FAILURE, like a failed file of image_batch_task
+    finally:
+        stop_renewal.set()
+        task_checkpoints.release(task_id, token)
 
 
-@shared_task
-def send_alert_task(backend: str, message: str):
-    """Универсальная таска для отправки алертов."""
+@shared_task(bind=True, max_retries=3, default_retry_delay=5)
+def image_batch_task(self, files: list[list[str]], batch_id: str | None = None,
+                     batch_index: int | None = None) -> dict | None:
+    """Processes a chunk of files in one task.
+
+    files is a list of (sub_id, file_name, digest), the first of them at
+    batch_index in the upload batch; the result of every file is
+    stored in the result backend under its sub_id, so per-file status
+    lookups work the same as for image_task. Idempotent per sub_id the same
+    way as image_task: on a retry only files without a record are handled,
+    reusing checkpointed handler output.
+    """
+    token = _acquire_lock(self, self.request.id)
+    stop_renewal = task_checkpoints.keep_alive(self.request.id, token)
+    # Sub-ids whose result is stored in the backend: True for a success, False for a failure
+    resolved = {}
+    positions = {
+        sub_id: None if batch_index is None else batch_index + offset for offset, (sub_id, _, _) in enumerate(files)
+    }
     try:
-        handler = get_handler(backend)
-        success = handler.send(message)
+        finished = _finished_records([sub_id for sub_id, _, _ in files])
+        for sub_id, record in finished.items():
+            HANDLER_SKIPPED.labels(reason='recorded').inc()
+            self.backend.mark_as_done(sub_id, record.as_result())
+            resolved[sub_id] = True
+
+        pending = [(sub_id, file_name, digest) for sub_id, file_name, digest in files if sub_id not in finished]
+        checkpoints = task_checkpoints.get_outputs([sub_id for sub_id, _, _ in pending])
+        handled = []
+        for sub_id, file_name, digest in pending:
+            try:
+                fields, execution_time = _run_handler(sub_id, file_name, digest, checkpoints.get(sub_id))
+                handled.append((
+                    sub_id,
+                    {
+                        'task_id': sub_id, 'file_name': file_name, 'content_hash': digest or '',
+                        'batch_id': batch_id or '', 'batch_index': positions[sub_id],
+                        'execution_time': execution_time, **fields,
+                    },
+                    execution_time,
+                ))
+            except Exception as e:
+                logger.error(f"{type(e).__name__}: {e}")
+                self.backend.mark_as_failure(sub_id, e)
+                _record_failure(sub_id, file_name, digest, batch_id, e, positions[sub_id])
+                resolved[sub_id] = False
+
+        records = image_record_writer.write_many([fields for _, fields, _ in handled])
+        task_checkpoints.delete_outputs([sub_id for sub_id, _, _ in handled])
+        for (sub_id, _, execution_time), record in zip(handled, records):
+            self.backend.mark_as_done(sub_id, _record_result(sub_id, record, execution_time, batch_id or self.request.id))
+            resolved[sub_id] = True
+
+        processed = len(records) + len(finished)
+        return {'processed': processed, 'failed': len(files) - processed}
 
-        if not success:
-            raise Exception(f"{backend} alert failed")
+    except OperationalError as exc:
+        _retry(self, self.request.id, token, exc=exc)
     except Exception as e:
-        logger.error(f"Alert error: {e}")
-        raise
+        logger.error(f"{type(e).__name__}: {e}")
+        # Files left without a result would stay PENDING and keep their batch from completing
+        for sub_id, file_name, digest in files:
+            if sub_id not in resolved:
+                self.backend.mark_as_failure(sub_id, e)
+                _record_failure(sub_id, file_name, digest, batch_id, e, positions[sub_id])
+        processed = sum(resolved.values())
+        return {'processed': processed, 'failed': len(files) - processed}
+    finally:
+        stop_renewal.set()
+        task_checkpoints.release(self.request.id, token)
+
 
+@shared_task(bind=True)
+def send_alert_task(self, backend: str, message: str, attempt: int = 0) -> bool:
+    """Универсальная таска для отправки алертов.
 
+    Waits for a token of the backend's bucket, retries failures with
+    exponential backoff (or the provider's Retry-After) and stores the alert
+    as a FailedNotification after NOTIFICATION_MAX_RETRIES attempts.
+    Rate-limit waits are not counted as attempts.
+    """
+    wait = rate_limiter.acquire(backend)
+    if wait > 0:
+        NOTIFICATIONS.labels(backend=backend, outcome='throttled').inc()
+        raise self.retry(countdown=wait, max_retries=None)
 
+    retry_after, outcome = None, 'failed'
+    try:
+        with NOTIFICATION_DURATION.labels(backend=backend).time():
+            sent = get_handler(backend).send(message)
+        if sent:
+            NOTIFICATIONS.labels(backend=backend, outcome='sent').inc()
+            return True
+        error = f"{backend} alert failed"
+    except RateLimitError as e:
+        error, retry_after, outcome = str(e), e.retry_after, 'rate_limited'
+    except Exception as e:
+        error = f"{type(e).__name__}: {e}"
+    NOTIFICATIONS.labels(backend=backend, outcome=outcome).inc()
 
+    if attempt >= settings.NOTIFICATION_MAX_RETRIES:
+        NOTIFICATIONS.labels(backend=backend, outcome='dead_letter').inc()
+        logger.error(f"Alert error: {error}, giving up after {attempt + 1} attempts")
+        FailedNotification.objects.create(backend=backend, message=message, error=error, attempts=attempt + 1)
+        return False
 
+    countdown = retry_after if retry_after is not None else backoff(attempt)
+    logger.warning(f"Alert error: {error}, retry in {countdown}s")
+    raise self.retry(kwargs={'attempt': attempt + 1}, countdown=countdown, max_retries=None)
 
 
+@shared_task
+def send_digest_task(key: str) -> int:
+    """Собирает накопленные за окно сообщения пакета в дайджест и ставит его в очередь каждого бэкенда."""
+    messages = notification_digest.pop(key)
+    if messages:
+        digest = build_digest(messages)
+        for backend in settings.NOTIFICATION_BACKENDS:
+            send_alert_task.delay(backend, digest)
+    return len(messages)
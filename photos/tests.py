@@ -1,15 +1,52 @@
+import io
+import os
 import json
-from unittest.mock import patch, MagicMock
-from django.test import TestCase, RequestFactory
+import hashlib
+import asyncio
+import tempfile
+import shutil
+import subprocess
+import sys
+import threading
+import time
+from datetime import datetime, timezone as dt_timezone
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from unittest.mock import ANY, patch, MagicMock, AsyncMock
+from django.test import TestCase, RequestFactory, AsyncRequestFactory, override_settings
+from django.test.client import BOUNDARY, MULTIPART_CONTENT, encode_multipart
+from django.conf import settings
+from django.core.cache import caches
+from django.core.handlers.asgi import ASGIRequest
+from django.core.signals import request_finished, request_started
+from django.core.management import call_command
+from django.core.files.base import ContentFile
+from django.core.files.storage import default_storage
 from django.core.files.uploadedfile import SimpleUploadedFile
 from django.core.exceptions import ValidationError
+from django.db import OperationalError, close_old_connections
 from celery.result import AsyncResult
+from PIL import Image
+from prometheus_client import REGISTRY
 from django.http import JsonResponse
 
-from .views import UploadView, TaskStatusView
-from .tasks import image_task
-from .validators import ImageValidator, ImageBatchValidator
-from config.celery import check_celery_available
+from .views import (
+    UploadView, AsyncUploadView, UploadSessionView, UploadSessionDetailView, UploadChunkView, UploadFinalizeView,
+    TaskStatusView, BatchStatusView, BatchEventsView, ImageListView, MetricsView, VariantView,
+)
+from .streaming import STREAM_PATH, streaming_upload_app
+from .status import batch_status, fetch_task_meta, restore_batch, stream_batch_events
+from .handlers import difference_hash, pillow_image_handler
+from .benchmark import compare_results, percentiles
+from .cache import result_cache, task_checkpoints
+from .metrics import QueueDepthCollector, _observe_queue_wait, _stamp_enqueued_at, generate_metrics
+from .models import FailedNotification, ImageRecord
+from .storage import blob_store
+from .variants import VariantCache
+from .tasks import aenqueue_images, image_task, image_batch_task, send_alert_task, send_digest_task
+from .notifications import RateLimitError, SlackSender, TelegramSender, TokenBucket, build_digest
+from .writers import ImageRecordWriter, image_record_writer
+from .validators import BATCH_MAX_COUNT, FileValidationResult, ImageValidator, ImageBatchValidator
+from config.celery import app, check_celery_available, WorkerHealth
 
 VALID_FILE_NAME = "valid_image.jpg"
 INVALID_FILE_NAME = "invalid_file.txt"
@@ -17,29 +54,66 @@ LARGE_FILE_NAME = "large_image.jpg"
 LONG_NAME_FILE = "x" * 256 + ".jpg"
 
 
+def make_image_bytes(size=(64, 48), color=(200, 30, 30), image_format='JPEG', exif=None) -> bytes:
+    buffer = io.BytesIO()
+    image = Image.new('RGB', size, color)
+    if exif is not None:
+        image.save(buffer, image_format, exif=exif)
+    else:
+        image.save(buffer, image_format)
+    return buffer.getvalue()
+
+
+JPEG_CONTENT = make_image_bytes()
+CSRF_TOKEN = 'a' * 32
+
+
+class IsolatedStorageMixin:
+    def setUp(self):
+        super().setUp()
+        media_root = tempfile.TemporaryDirectory()
+        self.addCleanup(media_root.cleanup)
+        settings_override = override_settings(
+            MEDIA_ROOT=media_root.name,
+            BLOB_STORE_ROOT=os.path.join(media_root.name, 'blobs'),
+            VARIANT_CACHE_ROOT=os.path.join(media_root.name, 'variant-cache'),
+            UPLOAD_SESSION_ROOT=os.path.join(media_root.name, 'uploads'),
+            IMAGE_VARIANT_SIZES=(32, 16),
+            CACHES={
+                'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache', 'LOCATION': 'default'},
+                'results': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache', 'LOCATION': 'results'},
+            },
+        )
+        settings_override.enable()
+        self.addCleanup(settings_override.disable)
+        caches['results'].clear()
+
+
 class ResponseDataMixin:
     @staticmethod
     def get_response_data(response) -> dict:
         return json.loads(response.content.decode('utf-8'))
 
 
-class UploadViewTest(ResponseDataMixin, TestCase):
+class UploadViewTest(IsolatedStorageMixin, ResponseDataMixin, TestCase):
     def setUp(self):
+        super().setUp()
         self.factory = RequestFactory()
         self.view = UploadView.as_view()
         self.valid_file = SimpleUploadedFile(
-            VALID_FILE_NAME, b"file_content", "image/jpeg"
+            VALID_FILE_NAME, JPEG_CONTENT, "image/jpeg"
         )
         self.invalid_file = SimpleUploadedFile(
             INVALID_FILE_NAME, b"file_content", "text/plain"
         )
         self.large_file = SimpleUploadedFile(
-            LARGE_FILE_NAME, b"x" * (6 * 1024 * 1024), "image/jpeg"  # 6MB
+            LARGE_FILE_NAME, JPEG_CONTENT + b"x" * (6 * 1024 * 1024), "image/jpeg"  # 6MB
         )
 
+    @patch('photos.views.save_batch')
     @patch.object(image_task, 'delay')
     @patch('photos.views.check_celery_available')
-    def test_valid_upload(self, mock_celery_check, mock_delay):
+    def test_valid_upload(self, mock_celery_check, mock_delay, mock_save_batch):
         mock_celery_check.return_value = True
         mock_delay.return_value = AsyncResult('mock-task-id')
 
@@ -48,9 +122,57 @@ class UploadViewTest(ResponseDataMixin, TestCase):
         data = self.get_response_data(response)
 
         self.assertEqual(response.status_code, 202)
+        self.assertIsNotNone(data['batch_id'])
         self.assertEqual(len(data['task_ids']), 1)
         self.assertEqual(len(data['valid_images']), 1)
-        mock_delay.assert_called_once_with(VALID_FILE_NAME)
+        digest = hashlib.sha256(JPEG_CONTENT).hexdigest()
+        self.assertEqual(data['digests'], [digest])
+        mock_delay.assert_called_once_with(VALID_FILE_NAME, digest, data['batch_id'], 0)
+        mock_save_batch.assert_called_once_with(['mock-task-id'], data['batch_id'])
+
+    @patch('photos.views.save_batch', MagicMock())
+    @patch.object(image_task, 'delay', MagicMock(return_value=AsyncResult('mock-task-id')))
+    @patch('photos.views.check_celery_available', MagicMock(return_value=True))
+    def test_rejected_file_blob_removed(self):
+        broken = b'\xff\xd8\xff\xe0' + b'x' * 100  # JPEG signature, no image
+        files = [self.valid_file, SimpleUploadedFile("broken.jpg", broken, "image/jpeg")]
+
+        data = self.get_response_data(self.view(self.factory.post('/update/', {'images': files})))
+
+        self.assertEqual(data['rejected'][0]['file_name'], "broken.jpg")
+        self.assertTrue(blob_store.exists(hashlib.sha256(JPEG_CONTENT).hexdigest()))
+        self.assertFalse(blob_store.exists(hashlib.sha256(broken).hexdigest()))
+
+    @patch('photos.views.check_celery_available')
+    def test_unavailable_upload_removes_only_new_blobs(self, mock_celery_check):
+        mock_celery_check.side_effect = ConnectionError("Celery server unavailable")
+        existing, _ = blob_store.save(ContentFile(JPEG_CONTENT))
+        other = make_image_bytes(color=(0, 0, 200))
+        request = self.factory.post('/update/', {'images': [
+            self.valid_file, SimpleUploadedFile("other.jpg", other, "image/jpeg"),
+        ]})
+        request.POST  # parsed by CsrfViewMiddleware before the view runs
+
+        response = self.view(request)
+
+        self.assertEqual(response.status_code, 503)
+        self.assertFalse(blob_store.exists(hashlib.sha256(other).hexdigest()))
+        # Stored before this request, possibly for another upload
+        self.assertTrue(blob_store.exists(existing))
+
+    @patch('photos.views.check_celery_available')
+    def test_blob_shared_with_concurrent_upload_kept(self, mock_celery_check):
+        mock_celery_check.side_effect = ConnectionError("Celery server unavailable")
+        request = self.factory.post('/update/', {'images': [self.valid_file]})
+        request.POST  # this request creates the blob
+        # Another request uploads the same bytes meanwhile and relies on the stored blob
+        digest, created = blob_store.save(ContentFile(JPEG_CONTENT))
+        self.assertFalse(created)
+
+        self.assertEqual(self.view(request).status_code, 503)
+
+        self.assertTrue(blob_store.exists(digest))
+        self.assertEqual(os.listdir(os.path.join(blob_store.root, 'tmp')), [])
 
     @patch('photos.views.check_celery_available')
     def test_no_files_upload(self, mock_celery_check):
@@ -85,9 +207,10 @@ class UploadViewTest(ResponseDataMixin, TestCase):
         self.assertEqual(response.status_code, 400)
         self.assertIn('exceeds maximum', data['error'])
 
+    @patch('photos.views.save_batch')
     @patch.object(image_task, 'delay')
     @patch('photos.views.check_celery_available')
-    def test_mixed_files_upload(self, mock_celery_check, mock_delay):
+    def test_mixed_files_upload(self, mock_celery_check, mock_delay, mock_save_batch):
         mock_celery_check.return_value = True
         mock_delay.return_value = AsyncResult('mock-task-id')
 
@@ -100,6 +223,7 @@ class UploadViewTest(ResponseDataMixin, TestCase):
         self.assertEqual(response.status_code, 202)
         self.assertEqual(len(data['task_ids']), 1)
         self.assertEqual(len(data['valid_images']), 1)
+        self.assertEqual(sorted(result['code'] for result in data['rejected']), ['extension', 'size'])
 
     @patch('photos.views.check_celery_available')
     def test_celery_unavailable(self, mock_celery_check):
@@ -113,6 +237,932 @@ class UploadViewTest(ResponseDataMixin, TestCase):
         self.assertIn('Service unavailable', data['error'])
 
 
+class AsyncUploadViewTest(IsolatedStorageMixin, ResponseDataMixin, TestCase):
+    def setUp(self):
+        super().setUp()
+        self.factory = AsyncRequestFactory()
+        self.view = AsyncUploadView.as_view()
+
+    def post(self, data, csrf_token=CSRF_TOKEN):
+        request = self.factory.post('/upload/async/', data, headers={'X-CSRFToken': csrf_token})
+        request.COOKIES[settings.CSRF_COOKIE_NAME] = CSRF_TOKEN
+        return request
+
+    @patch('photos.views.check_celery_available')
+    async def test_csrf_checked_without_parsing_body(self, mock_celery_check):
+        upload = SimpleUploadedFile(VALID_FILE_NAME, JPEG_CONTENT, "image/jpeg")
+        request = self.post({'images': [upload]}, csrf_token='x' * 32)
+
+        response = await self.view(request)
+
+        self.assertEqual(response.status_code, 403)
+        mock_celery_check.assert_not_called()
+        self.assertFalse(hasattr(request, '_files'))
+
+    @override_settings(DATA_UPLOAD_MAX_NUMBER_FILES=2)
+    @patch('photos.views.check_celery_available', MagicMock(return_value=True))
+    async def test_parser_file_limit_rejected_as_count(self):
+        files = [SimpleUploadedFile(f"img{i}.jpg", make_image_bytes(color=(i, 0, 0)), "image/jpeg") for i in range(3)]
+
+        response = await self.view(self.post({'images': files}))
+
+        self.assertEqual(response.status_code, 400)
+        self.assertIn('Too many images (3 > 100)', self.get_response_data(response)['error'])
+
+    @patch('photos.views.save_batch')
+    @patch.object(image_task, 'delay')
+    @patch('photos.views.check_celery_available')
+    async def test_publishes_in_broker_executor(self, mock_celery_check, mock_delay, mock_save_batch):
+        threads = []
+
+        def delay(*args):
+            threads.append(threading.current_thread().name)
+            return AsyncResult(f"task-{args[0]}")
+        mock_delay.side_effect = delay
+        files = [SimpleUploadedFile(f"img{i}.jpg", make_image_bytes(color=(i, 0, 0)), "image/jpeg") for i in range(3)]
+        files.append(SimpleUploadedFile(INVALID_FILE_NAME, b"file_content", "text/plain"))
+
+        response = await self.view(self.post({'images': files}))
+        data = self.get_response_data(response)
+
+        self.assertEqual(response.status_code, 202)
+        self.assertEqual(data['task_ids'], ['task-img0.jpg', 'task-img1.jpg', 'task-img2.jpg'])
+        self.assertEqual(data['rejected'][0]['code'], 'extension')
+        self.assertTrue(all(name.startswith('broker') for name in threads))
+        mock_save_batch.assert_called_once_with(data['task_ids'], data['batch_id'])
+
+    @patch('photos.views.check_celery_available', side_effect=ConnectionError("Celery down"))
+    async def test_celery_unavailable(self, mock_celery_check):
+        upload = SimpleUploadedFile(VALID_FILE_NAME, JPEG_CONTENT, "image/jpeg")
+
+        response = await self.view(self.post({'images': [upload]}))
+
+        self.assertEqual(response.status_code, 503)
+
+    @override_settings(UPLOAD_DISPATCH_MODE='batch', UPLOAD_BATCH_CHUNK_SIZE=2)
+    @patch.object(image_batch_task, 'delay')
+    def test_batch_mode_chunks(self, mock_batch_delay):
+        task_ids = asyncio.run(aenqueue_images([('a.jpg', 'a'), ('b.jpg', 'b'), ('c.jpg', 'c')], 'batch-1'))
+
+        chunks = sorted((call.args[0] for call in mock_batch_delay.call_args_list), key=len, reverse=True)
+        self.assertEqual([len(chunk) for chunk in chunks], [2, 1])
+        self.assertEqual(sorted(task_ids), sorted(sub_id for chunk in chunks for sub_id, _, _ in chunk))
+
+
+@patch('photos.streaming.check_celery_available', MagicMock(return_value=True))
+class StreamingUploadAppTest(IsolatedStorageMixin, TestCase):
+    def setUp(self):
+        super().setUp()
+        # As the test client does: the raw app must not close the test transaction's connection
+        for signal in (request_started, request_finished):
+            signal.disconnect(close_old_connections)
+            self.addCleanup(signal.connect, close_old_connections)
+
+    async def upload(self, body: bytes, chunks=None, csrf_token=CSRF_TOKEN, method='POST',
+                     host='testserver') -> tuple[int, list[dict]]:
+        """Calls the ASGI app with body sent in chunks; a chunk may be an awaitable to wait for first.
+
+        The response headers are kept in self.response_headers.
+        """
+        headers = [
+            (b'host', host.encode()),
+            (b'content-type', MULTIPART_CONTENT.encode()),
+            (b'content-length', str(len(body)).encode()),
+            (b'cookie', f'{settings.CSRF_COOKIE_NAME}={CSRF_TOKEN}'.encode()),
+        ]
+        if csrf_token:
+            headers.append((b'x-csrftoken', csrf_token.encode()))
+        scope = {
+            'type': 'http', 'method': method, 'path': STREAM_PATH, 'query_string': b'', 'headers': headers,
+            'server': ('testserver', 80), 'client': ('127.0.0.1', 12345),
+        }
+        messages = list(chunks or [body])
+        sent = []
+
+        async def receive():
+            while messages and not isinstance(messages[0], bytes):
+                await messages.pop(0)
+            if not messages:
+                return {'type': 'http.disconnect'}
+            chunk = messages.pop(0)
+            return {'type': 'http.request', 'body': chunk, 'more_body': bool(messages)}
+
+        async def send(message):
+            sent.append(message)
+
+        await streaming_upload_app(scope, receive, send)
+        self.response_headers = {name.decode(): value.decode() for name, value in sent[0]['headers']}
+        content = b''.join(message.get('body', b'') for message in sent[1:])
+        if sent[0]['status'] != 200:
+            return sent[0]['status'], []
+        return sent[0]['status'], [json.loads(line) for line in content.splitlines()]
+
+    @patch('photos.streaming.save_batch')
+    @patch.object(image_task, 'delay')
+    async def test_file_enqueued_while_next_one_is_received(self, mock_delay, mock_save_batch):
+        loop = asyncio.get_running_loop()
+        enqueued = asyncio.Event()
+
+        def delay(name, *args):
+            loop.call_soon_threadsafe(enqueued.set)
+            return AsyncResult(f"task-{name}")
+
+        mock_delay.side_effect = delay
+        files = [
+            SimpleUploadedFile("img0.jpg", make_image_bytes(color=(1, 0, 0)), "image/jpeg"),
+            SimpleUploadedFile("img1.jpg", make_image_bytes(size=(640, 480), color=(2, 0, 0)), "image/jpeg"),
+            SimpleUploadedFile(INVALID_FILE_NAME, b"file_content", "text/plain"),
+        ]
+        body = encode_multipart(BOUNDARY, {'images': files})
+        # The parser reads the first KB of the next part before it completes a file;
+        # the rest of img1.jpg is sent only once img0.jpg is enqueued
+        second_part = body.index(f'--{BOUNDARY}'.encode(), 1)
+        split = second_part + 2048
+        self.assertLess(split, body.index(f'--{BOUNDARY}'.encode(), second_part + 1))
+
+        status, lines = await asyncio.wait_for(
+            self.upload(body, [body[:split], enqueued.wait(), body[split:]]), timeout=10,
+        )
+
+        self.assertEqual(status, 200)
+        self.assertEqual([line['event'] for line in lines], ['queued', 'queued', 'rejected', 'complete'])
+        self.assertEqual(lines[0]['task_id'], 'task-img0.jpg')
+        self.assertEqual(lines[2]['code'], 'extension')
+        summary = lines[-1]
+        self.assertEqual(summary['task_ids'], ['task-img0.jpg', 'task-img1.jpg'])
+        self.assertEqual(summary['valid_images'], ['img0.jpg', 'img1.jpg'])
+        mock_save_batch.assert_called_once_with(summary['task_ids'], summary['batch_id'])
+
+    @patch('photos.streaming.BATCH_MAX_COUNT', 2)
+    @patch('photos.streaming.save_batch', MagicMock())
+    @patch.object(image_task, 'delay')
+    async def test_rejected_files_count_towards_batch_size(self, mock_delay):
+        mock_delay.side_effect = lambda name, *args: AsyncResult(f"task-{name}")
+        files = [
+            SimpleUploadedFile(INVALID_FILE_NAME, b"file_content", "text/plain"),
+            SimpleUploadedFile("img0.jpg", make_image_bytes(color=(1, 0, 0)), "image/jpeg"),
+            SimpleUploadedFile("img1.jpg", make_image_bytes(color=(2, 0, 0)), "image/jpeg"),
+        ]
+
+        status, lines = await self.upload(encode_multipart(BOUNDARY, {'images': files}))
+
+        self.assertEqual([line['event'] for line in lines], ['rejected', 'queued', 'rejected', 'complete'])
+        self.assertEqual(lines[2]['code'], 'count')
+        self.assertEqual(lines[-1]['task_ids'], ['task-img0.jpg'])
+        await asyncio.sleep(0)  # blobs are removed in a callback once the parser is done
+        self.assertFalse(blob_store.exists(hashlib.sha256(files[2].file.getvalue()).hexdigest()))
+
+    @patch('photos.streaming.save_batch', MagicMock())
+    @patch.object(image_task, 'delay')
+    async def test_files_past_batch_size_rejected_at_default_limits(self, mock_delay):
+        mock_delay.side_effect = lambda name, *args: AsyncResult(f"task-{name}")
+        content = make_image_bytes(size=(8, 8))
+        files = [SimpleUploadedFile(f"img{i}.jpg", content, "image/jpeg") for i in range(BATCH_MAX_COUNT + 1)]
+
+        with self.assertNoLogs('photos', level='ERROR'):
+            status, lines = await self.upload(encode_multipart(BOUNDARY, {'images': files}))
+
+        self.assertEqual(status, 200)
+        self.assertEqual([line['event'] for line in lines], ['queued'] * BATCH_MAX_COUNT + ['rejected', 'complete'])
+        self.assertEqual(lines[-2]['code'], 'count')
+        self.assertEqual(len(lines[-1]['task_ids']), BATCH_MAX_COUNT)
+
+    @override_settings(DATA_UPLOAD_MAX_NUMBER_FILES=2)
+    @patch('photos.streaming.save_batch', MagicMock())
+    @patch.object(image_task, 'delay')
+    async def test_parser_file_limit_rejected_as_count(self, mock_delay):
+        mock_delay.side_effect = lambda name, *args: AsyncResult(f"task-{name}")
+        files = [SimpleUploadedFile(f"img{i}.jpg", make_image_bytes(color=(i, 0, 0)), "image/jpeg") for i in range(3)]
+
+        with self.assertNoLogs('photos', level='ERROR'):
+            status, lines = await self.upload(encode_multipart(BOUNDARY, {'images': files}))
+
+        self.assertEqual(lines[-1]['event'], 'error')
+        self.assertEqual(lines[-1]['status'], 400)
+        self.assertIn('Too many images', lines[-1]['error'])
+
+    @patch('photos.streaming.check_celery_available')
+    async def test_disallowed_host_rejected(self, mock_check):
+        files = [SimpleUploadedFile(VALID_FILE_NAME, JPEG_CONTENT, "image/jpeg")]
+
+        status, _ = await self.upload(encode_multipart(BOUNDARY, {'images': files}), host='evil.example')
+
+        self.assertEqual(status, 400)
+        mock_check.assert_not_called()
+
+    @patch('photos.streaming.save_batch', MagicMock())
+    @patch.object(image_task, 'delay', MagicMock(return_value=AsyncResult('task-1')))
+    async def test_security_headers_and_request_closed(self):
+        files = [SimpleUploadedFile(VALID_FILE_NAME, JPEG_CONTENT, "image/jpeg")]
+
+        with patch.object(ASGIRequest, 'close', autospec=True, side_effect=ASGIRequest.close) as mock_close:
+            status, _ = await self.upload(encode_multipart(BOUNDARY, {'images': files}))
+
+        self.assertEqual(status, 200)
+        self.assertEqual(self.response_headers['X-Content-Type-Options'], 'nosniff')
+        self.assertEqual(self.response_headers['X-Frame-Options'], 'DENY')
+        self.assertEqual(self.response_headers['Content-Type'], 'application/x-ndjson')
+        mock_close.assert_called_once()
+
+    @patch('photos.streaming.save_batch')
+    @patch.object(image_task, 'delay')
+    async def test_broker_error_ends_stream(self, mock_delay, mock_save_batch):
+        mock_delay.side_effect = [AsyncResult('task-1'), ConnectionError("Broker down")]
+        files = [SimpleUploadedFile(f"img{i}.jpg", make_image_bytes(color=(i, 0, 0)), "image/jpeg") for i in range(2)]
+
+        status, lines = await self.upload(encode_multipart(BOUNDARY, {'images': files}))
+
+        self.assertEqual([line['event'] for line in lines], ['queued', 'error'])
+        self.assertEqual(lines[-1]['status'], 503)
+        # Files enqueued before the error stay trackable as a batch
+        mock_save_batch.assert_called_once_with(['task-1'], ANY)
+
+    @patch('photos.streaming.check_celery_available')
+    async def test_csrf_token_required(self, mock_check):
+        files = [SimpleUploadedFile(VALID_FILE_NAME, JPEG_CONTENT, "image/jpeg")]
+
+        status, _ = await self.upload(encode_multipart(BOUNDARY, {'images': files}), csrf_token=None)
+
+        self.assertEqual(status, 403)
+        mock_check.assert_not_called()
+
+    async def test_requires_post(self):
+        status, _ = await self.upload(b'', method='PUT')
+
+        self.assertEqual(status, 405)
+
+
+@patch('photos.views.check_celery_available', MagicMock(return_value=True))
+class ResumableUploadTest(IsolatedStorageMixin, ResponseDataMixin, TestCase):
+    def setUp(self):
+        super().setUp()
+        self.factory = RequestFactory()
+
+    def start(self, files) -> dict:
+        request = self.factory.post('/uploads/', {'files': files}, content_type='application/json')
+        response = UploadSessionView.as_view()(request)
+        self.assertEqual(response.status_code, 201)
+        return self.get_response_data(response)
+
+    def put(self, upload_id, index, offset, chunk):
+        request = self.factory.put(
+            f'/uploads/{upload_id}/files/{index}/', chunk,
+            content_type='application/octet-stream', headers={'Upload-Offset': str(offset)},
+        )
+        return UploadChunkView.as_view()(request, upload_id=upload_id, index=index)
+
+    def finalize(self, upload_id):
+        return UploadFinalizeView.as_view()(self.factory.post(f'/uploads/{upload_id}/finalize/'), upload_id=upload_id)
+
+    @patch('photos.resumable.save_batch')
+    @patch.object(image_task, 'delay')
+    def test_resume_and_enqueue_per_file(self, mock_delay, mock_save_batch):
+        mock_delay.side_effect = lambda name, *args: AsyncResult(f"task-{name}")
+        other = make_image_bytes(color=(0, 0, 200))
+        session = self.start([
+            {'name': 'a.jpg', 'size': len(JPEG_CONTENT)}, {'name': 'b.jpg', 'size': len(other)},
+        ])
+        upload_id, half = session['upload_id'], len(JPEG_CONTENT) // 2
+
+        self.assertEqual(self.put(upload_id, 0, 0, JPEG_CONTENT[:half]).status_code, 200)
+        # A retried chunk is refused with the offset to resume from
+        response = self.put(upload_id, 0, 0, JPEG_CONTENT[:half])
+        self.assertEqual(response.status_code, 409)
+        self.assertEqual(self.get_response_data(response)['offset'], half)
+        status = self.get_response_data(UploadSessionDetailView.as_view()(self.factory.get('/'), upload_id=upload_id))
+        self.assertEqual([file['offset'] for file in status['files']], [half, 0])
+
+        data = self.get_response_data(self.put(upload_id, 0, half, JPEG_CONTENT[half:]))
+        # The first file is enqueued before the second one arrives
+        self.assertEqual(data['state'], 'enqueued')
+        digest = hashlib.sha256(JPEG_CONTENT).hexdigest()
+        mock_delay.assert_called_once_with('a.jpg', digest, session['batch_id'], 0)
+        self.assertTrue(blob_store.exists(digest))
+
+        self.put(upload_id, 1, 0, other)
+        response = self.finalize(upload_id)
+        data = self.get_response_data(response)
+
+        self.assertEqual(response.status_code, 202)
+        self.assertEqual(data['task_ids'], ['task-a.jpg', 'task-b.jpg'])
+        self.assertEqual(data['valid_images'], ['a.jpg', 'b.jpg'])
+        mock_save_batch.assert_called_once_with(data['task_ids'], session['batch_id'])
+        self.assertEqual(self.finalize(upload_id).status_code, 404)
+
+    @patch.object(image_task, 'delay')
+    def test_rejections(self, mock_delay):
+        content = b"not an image at all"
+        session = self.start([
+            {'name': INVALID_FILE_NAME, 'size': 10}, {'name': 'fake.jpg', 'size': len(content)},
+        ])
+        self.assertEqual(session['rejected'][0]['code'], 'extension')
+
+        data = self.get_response_data(self.put(session['upload_id'], 1, 0, content))
+        self.assertEqual((data['state'], data['code']), ('rejected', 'signature'))
+
+        response = self.finalize(session['upload_id'])
+        data = self.get_response_data(response)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual([file['code'] for file in data['rejected']], ['extension', 'signature'])
+        mock_delay.assert_not_called()
+
+    def test_finalize_requires_complete_files(self):
+        session = self.start([{'name': VALID_FILE_NAME, 'size': len(JPEG_CONTENT)}])
+        self.put(session['upload_id'], 0, 0, JPEG_CONTENT[:100])
+
+        self.assertEqual(self.finalize(session['upload_id']).status_code, 400)
+        self.assertEqual(self.put(session['upload_id'], 0, 100, JPEG_CONTENT).status_code, 400)
+
+    @patch('photos.resumable.save_batch')
+    @patch.object(image_task, 'delay')
+    def test_broker_error_is_retried_on_finalize(self, mock_delay, mock_save_batch):
+        mock_delay.side_effect = [ConnectionError("Broker down"), AsyncResult('task-1')]
+        session = self.start([{'name': VALID_FILE_NAME, 'size': len(JPEG_CONTENT)}])
+
+        self.assertEqual(self.put(session['upload_id'], 0, 0, JPEG_CONTENT).status_code, 503)
+        response = self.finalize(session['upload_id'])
+
+        self.assertEqual(response.status_code, 202)
+        self.assertEqual(self.get_response_data(response)['task_ids'], ['task-1'])
+
+
+class ResultCacheTest(IsolatedStorageMixin, ResponseDataMixin, TestCase):
+    def test_miss_then_hit(self):
+        self.assertEqual(result_cache.get_many(['abc']), {})
+
+        result_cache.set('abc', {'id': 1})
+
+        self.assertEqual(result_cache.get_many(['abc']), {'abc': {'id': 1}})
+        self.assertEqual(result_cache.stats(), {'hits': 1, 'db_hits': 0, 'misses': 1, 'hit_rate': 0.5})
+
+    def test_database_fallback_is_written_back(self):
+        record = ImageRecord.objects.create(file_name='a.jpg', content_hash='abc', width=10, height=5)
+
+        self.assertEqual(result_cache.get_many(['abc'])['abc']['id'], record.pk)
+        with self.assertNumQueries(0):
+            self.assertEqual(result_cache.get_many(['abc'])['abc']['width'], 10)
+        self.assertEqual(result_cache.stats()['db_hits'], 1)
+
+    def test_failed_records_not_used(self):
+        ImageRecord.objects.create(file_name='a.jpg', content_hash='abc', status=ImageRecord.FAILURE, error='boom')
+
+        self.assertEqual(result_cache.get_many(['abc']), {})
+
+    def test_cache_errors_fail_open(self):
+        with patch.object(result_cache.cache, 'get_many', side_effect=OSError('redis down')):
+            self.assertEqual(result_cache.get_many(['abc']), {})
+
+    @patch('photos.views.save_batch')
+    @patch.object(image_task, 'delay')
+    @patch('photos.views.check_celery_available')
+    def test_upload_answers_processed_files_without_enqueuing(self, mock_celery_check, mock_delay, mock_save_batch):
+        content = make_image_bytes()
+        result_cache.set(hashlib.sha256(content).hexdigest(), {'id': 5, 'file_name': 'old.jpg'})
+        upload = SimpleUploadedFile('again.jpg', content, 'image/jpeg')
+
+        response = UploadView.as_view()(RequestFactory().post('/upload/', {'images': [upload]}))
+        data = self.get_response_data(response)
+
+        self.assertEqual(response.status_code, 200)
+        mock_delay.assert_not_called()
+        mock_save_batch.assert_not_called()
+        self.assertIsNone(data['batch_id'])
+        self.assertEqual(data['task_ids'], [])
+        self.assertEqual(data['cached'][0]['file_name'], 'again.jpg')
+        self.assertEqual(data['cached'][0]['result']['id'], 5)
+
+
+class ValidatingUploadHandlerTest(IsolatedStorageMixin, ResponseDataMixin, TestCase):
+    def post(self, files):
+        request = RequestFactory().post('/upload/', {'images': files})
+        return request, request.FILES.getlist('images')
+
+    def stored_blobs(self):
+        return [
+            name for _, _, names in os.walk(blob_store.root) for name in names
+        ]
+
+    def test_valid_file_is_hashed_and_stored_while_received(self):
+        request, images = self.post([SimpleUploadedFile('a.jpg', JPEG_CONTENT, 'image/jpeg')])
+
+        self.assertEqual(len(images), 1)
+        self.assertEqual(images[0].digest, hashlib.sha256(JPEG_CONTENT).hexdigest())
+        self.assertTrue(blob_store.exists(images[0].digest))
+        self.assertEqual(images[0].read(), JPEG_CONTENT)
+        self.assertEqual(request.upload_rejections, [])
+
+    def test_mislabeled_content_rejected_on_first_chunk(self):
+        request, images = self.post([SimpleUploadedFile('a.jpg', b'<html>not an image</html>', 'image/jpeg')])
+
+        self.assertEqual(images, [])
+        self.assertIn("does not match extension 'jpg'", request.upload_rejections[0].message)
+        self.assertEqual(self.stored_blobs(), [])
+
+    def test_oversize_aborted_and_nothing_stored(self):
+        request, images = self.post([
+            SimpleUploadedFile('big.jpg', JPEG_CONTENT + b'x' * (6 * 1024 * 1024), 'image/jpeg'),
+            SimpleUploadedFile('ok.jpg', JPEG_CONTENT, 'image/jpeg'),
+        ])
+
+        self.assertEqual([image.name for image in images], ['ok.jpg'])
+        self.assertIn('exceeds maximum', request.upload_rejections[0].message)
+        self.assertEqual(self.stored_blobs(), [images[0].digest])
+
+    def test_extension_rejected_before_receiving(self):
+        with patch.object(blob_store, 'writer') as mock_writer:
+            request, images = self.post([SimpleUploadedFile('a.txt', b'file_content', 'text/plain')])
+
+        mock_writer.assert_not_called()
+        self.assertIn('Unsupported extension', request.upload_rejections[0].message)
+
+    @patch('photos.views.save_batch')
+    @patch.object(image_task, 'delay')
+    @patch('photos.views.check_celery_available')
+    def test_upload_view_does_not_store_twice(self, mock_celery_check, mock_delay, mock_save_batch):
+        mock_delay.return_value = AsyncResult('mock-task-id')
+        request = RequestFactory().post('/upload/', {'images': [SimpleUploadedFile('a.jpg', JPEG_CONTENT, 'image/jpeg')]})
+
+        with patch.object(blob_store, 'save') as mock_save:
+            response = UploadView.as_view()(request)
+
+        self.assertEqual(response.status_code, 202)
+        mock_save.assert_not_called()
+
+
+class BatchDispatchTest(IsolatedStorageMixin, ResponseDataMixin, TestCase):
+    def setUp(self):
+        super().setUp()
+        self.factory = RequestFactory()
+        self.view = UploadView.as_view()
+
+    @override_settings(UPLOAD_DISPATCH_MODE='batch', UPLOAD_BATCH_CHUNK_SIZE=2)
+    @patch('photos.views.save_batch')
+    @patch.object(image_batch_task, 'delay')
+    @patch.object(image_task, 'delay')
+    @patch('photos.views.check_celery_available')
+    def test_chunked_dispatch(self, mock_celery_check, mock_delay, mock_batch_delay, mock_save_batch):
+        files = [SimpleUploadedFile(f"img{i}.jpg", JPEG_CONTENT, "image/jpeg") for i in range(3)]
+
+        response = self.view(self.factory.post('/upload/', {'images': files}))
+        data = self.get_response_data(response)
+
+        self.assertEqual(response.status_code, 202)
+        mock_delay.assert_not_called()
+        self.assertEqual(mock_batch_delay.call_count, 2)
+        chunks = [call.args[0] for call in mock_batch_delay.call_args_list]
+        self.assertEqual([len(chunk) for chunk in chunks], [2, 1])
+        self.assertEqual(data['task_ids'], [sub_id for chunk in chunks for sub_id, _, _ in chunk])
+        mock_save_batch.assert_called_once_with(data['task_ids'], data['batch_id'])
+        self.assertTrue(all(call.args[1] == data['batch_id'] for call in mock_batch_delay.call_args_list))
+        # Position of the first file of each chunk in the batch
+        self.assertEqual([call.args[2] for call in mock_batch_delay.call_args_list], [0, 2])
+
+    @patch('photos.tasks._notify')
+    @patch('photos.tasks.get_handler')
+    def test_batch_task_stores_per_file_results(self, mock_get_handler, mock_notify):
+        mock_get_handler.return_value.side_effect = [({'image_random_num': 7}, 0.1), ValueError('broken file')]
+
+        with patch.object(app.backend, 'mark_as_done') as mock_done, \
+                patch.object(app.backend, 'mark_as_failure') as mock_failure:
+            result = image_batch_task.apply(
+                args=([['sub-1', 'a.jpg', 'digest-a'], ['sub-2', 'b.jpg', 'digest-b']], 'batch-1', 4)
+            ).get()
+
+        self.assertEqual(result, {'processed': 1, 'failed': 1})
+        done = {call.args[0]: call.args[1] for call in mock_done.call_args_list}
+        self.assertNotIn('sub-2', done)
+        data = done['sub-1']
+        self.assertEqual(data['image_random_num'], 7)
+        self.assertTrue(ImageRecord.objects.filter(pk=data['id'], file_name='a.jpg', batch_index=4).exists())
+        self.assertEqual(mock_failure.call_args.args[0], 'sub-2')
+        mock_notify.assert_called_once()
+        failed = ImageRecord.objects.get(task_id='sub-2')
+        self.assertEqual((failed.status, failed.batch_id, failed.batch_index), (ImageRecord.FAILURE, 'batch-1', 5))
+        self.assertIn('broken file', failed.error)
+
+    @patch('photos.tasks.get_handler')
+    def test_batch_task_write_error_fails_every_file(self, mock_get_handler):
+        mock_get_handler.return_value.side_effect = [({'image_random_num': 7}, 0.1), ValueError('broken file')]
+
+        with patch.object(image_record_writer, 'write_many', side_effect=RuntimeError('write failed')), \
+                patch.object(app.backend, 'mark_as_done') as mock_done, \
+                patch.object(app.backend, 'mark_as_failure') as mock_failure:
+            result = image_batch_task.apply(
+                args=([['sub-1', 'a.jpg', 'digest-a'], ['sub-2', 'b.jpg', 'digest-b']], 'batch-1', 0)
+            ).get()
+
+        self.assertEqual(result, {'processed': 0, 'failed': 2})
+        self.assertFalse({'sub-1', 'sub-2'} & {call.args[0] for call in mock_done.call_args_list})
+        self.assertEqual(sorted(call.args[0] for call in mock_failure.call_args_list), ['sub-1', 'sub-2'])
+        failed = ImageRecord.objects.get(task_id='sub-1')
+        self.assertEqual((failed.status, failed.batch_index), (ImageRecord.FAILURE, 0))
+        self.assertIn('write failed', failed.error)
+        self.assertIn('broken file', ImageRecord.objects.get(task_id='sub-2').error)
+
+    @patch('photos.tasks._notify')
+    @patch('photos.tasks.get_handler')
+    def test_image_task_returns_compact_result(self, mock_get_handler, mock_notify):
+        fields = {'width': 4, 'height': 3, 'format': 'JPEG', 'metadata': {'exif': {'Make': 'x'}}}
+        mock_get_handler.return_value.return_value = (fields, 0.1)
+
+        result = image_task.apply(args=('a.jpg', 'digest-a'), task_id='task-a').get()
+
+        self.assertEqual(set(result), set(ImageRecord.RESULT_FIELDS))
+        record = ImageRecord.objects.get(pk=result['id'])
+        self.assertEqual((record.task_id, record.execution_time, record.status), ('task-a', 0.1, ImageRecord.SUCCESS))
+
+    @patch('photos.tasks.get_handler')
+    def test_image_task_failure_recorded(self, mock_get_handler):
+        mock_get_handler.return_value.side_effect = ValueError('broken file')
+
+        result = image_task.apply(args=('a.jpg', 'digest-a', 'batch-1'), task_id='task-a')
+
+        self.assertEqual(result.state, 'FAILURE')
+        self.assertIsInstance(result.result, ValueError)
+
+        record = ImageRecord.objects.get(task_id='task-a')
+        self.assertEqual((record.status, record.batch_id, record.file_name), (ImageRecord.FAILURE, 'batch-1', 'a.jpg'))
+
+
+class IdempotentTaskTest(IsolatedStorageMixin, TestCase):
+    @patch('photos.tasks._notify')
+    @patch('photos.tasks.get_handler')
+    def test_retry_after_db_error_reuses_handler_output(self, mock_get_handler, mock_notify):
+        mock_get_handler.return_value.return_value = ({'image_random_num': 7}, 0.1)
+        write, attempts = image_record_writer.write, []
+
+        def flaky_write(**fields):
+            attempts.append(fields)
+            if len(attempts) == 1:
+                raise OperationalError('db down')
+            return write(**fields)
+
+        with patch.object(image_record_writer, 'write', side_effect=flaky_write):
+            image_task.apply(args=('a.jpg', 'digest-a'), task_id='task-a')
+
+        mock_get_handler.return_value.assert_called_once()
+        self.assertEqual(ImageRecord.objects.get(task_id='task-a').image_random_num, 7)
+        self.assertIsNone(task_checkpoints.get_output('task-a'))
+
+    @patch('photos.tasks._notify')
+    @patch('photos.tasks.get_handler')
+    def test_redelivered_message_returns_existing_record(self, mock_get_handler, mock_notify):
+        mock_get_handler.return_value.return_value = ({'image_random_num': 7}, 0.1)
+
+        first = image_task.apply(args=('a.jpg', 'digest-a'), task_id='task-a').get()
+        second = image_task.apply(args=('a.jpg', 'digest-a'), task_id='task-a').get()
+
+        self.assertEqual(first, second)
+        mock_get_handler.return_value.assert_called_once()
+        self.assertEqual(ImageRecord.objects.filter(task_id='task-a').count(), 1)
+
+    @patch('photos.tasks.get_handler')
+    def test_locked_task_retried_later(self, mock_get_handler):
+        task_checkpoints.acquire('task-a')
+
+        with patch.object(image_task, 'retry', side_effect=RuntimeError('retry')) as mock_retry:
+            with self.assertRaises(RuntimeError):
+                image_task.apply(args=('a.jpg', 'digest-a'), task_id='task-a', throw=True)
+
+        mock_get_handler.assert_not_called()
+        self.assertIsNone(task_checkpoints.acquire('task-a'))  # the holder's lock is kept
+        self.assertEqual(mock_retry.call_args.kwargs, {'countdown': 30, 'max_retries': None})
+
+    @patch('photos.tasks.get_handler')
+    def test_lock_held_past_ttl_is_left_to_its_holder(self, mock_get_handler):
+        task_checkpoints.acquire('task-a')
+
+        result = image_task.apply(args=('a.jpg', 'digest-a'), task_id='task-a')
+
+        # Eager retries run at once: the waits run out and the message is dropped, not failed
+        self.assertEqual(result.state, 'IGNORED')
+        mock_get_handler.assert_not_called()
+        self.assertFalse(ImageRecord.objects.filter(task_id='task-a').exists())
+
+    @patch('photos.tasks._notify')
+    @patch('photos.tasks.get_handler')
+    def test_lock_waits_do_not_use_up_db_retries(self, mock_get_handler, mock_notify):
+        mock_get_handler.return_value.return_value = ({'image_random_num': 7}, 0.1)
+        for _ in range(3):
+            task_checkpoints.count_lock_wait('task-a')
+        write, attempts = image_record_writer.write, []
+
+        def flaky_write(**fields):
+            attempts.append(fields)
+            if len(attempts) == 1:
+                raise OperationalError('db down')
+            return write(**fields)
+
+        with patch.object(image_record_writer, 'write', side_effect=flaky_write):
+            image_task.apply(args=('a.jpg', 'digest-a'), task_id='task-a', retries=3)
+
+        self.assertEqual(ImageRecord.objects.get(task_id='task-a').image_random_num, 7)
+
+    def test_lock_released_only_by_owner(self):
+        token = task_checkpoints.acquire('task-a')
+
+        task_checkpoints.release('task-a', 'stale-token')
+        self.assertIsNone(task_checkpoints.acquire('task-a'))
+        task_checkpoints.release('task-a', token)
+        self.assertIsNotNone(task_checkpoints.acquire('task-a'))
+
+    @override_settings(TASK_LOCK_TTL=0.3)
+    def test_lock_renewed_while_running(self):
+        token = task_checkpoints.acquire('task-a')
+        stop = task_checkpoints.keep_alive('task-a', token)
+        self.addCleanup(stop.set)
+
+        time.sleep(0.7)
+
+        self.assertIsNone(task_checkpoints.acquire('task-a'))
+
+    @patch('photos.tasks._notify')
+    @patch('photos.tasks.get_handler')
+    def test_batch_retry_handles_only_unfinished_files(self, mock_get_handler, mock_notify):
+        ImageRecord.objects.create(task_id='sub-1', file_name='a.jpg', image_random_num=1)
+        task_checkpoints.set_output('sub-2', {'image_random_num': 2}, 0.1)
+
+        with patch.object(app.backend, 'mark_as_done') as mock_done:
+            result = image_batch_task.apply(args=([['sub-1', 'a.jpg', 'a'], ['sub-2', 'b.jpg', 'b']],)).get()
+
+        mock_get_handler.return_value.assert_not_called()
+        self.assertEqual(result, {'processed': 2, 'failed': 0})
+        self.assertLessEqual({'sub-1', 'sub-2'}, {call.args[0] for call in mock_done.call_args_list})
+        self.assertEqual(ImageRecord.objects.get(task_id='sub-2').image_random_num, 2)
+
+    def test_writer_upserts_on_task_id(self):
+        for bulk in (True, False):
+            writer = ImageRecordWriter(bulk=bulk, batch_size=1, flush_interval=0)
+            writer.write(task_id=f'task-{bulk}', file_name='a.jpg', image_random_num=1)
+            record = writer.write(task_id=f'task-{bulk}', file_name='a.jpg', image_random_num=2)
+
+            stored = ImageRecord.objects.get(task_id=f'task-{bulk}')
+            self.assertEqual((stored.pk, stored.image_random_num), (record.pk, 2))
+
+
+class InlineThread:
+    def __init__(self, target, **kwargs):
+        self.target = target
+
+    def start(self):
+        self.target()
+
+
+class TaskRoutingTest(TestCase):
+    def route(self, task):
+        return app.amqp.router.route({}, task.name)['queue'].name
+
+    def test_processing_and_notifications_use_separate_queues(self):
+        self.assertEqual(self.route(image_task), 'images')
+        self.assertEqual(self.route(image_batch_task), 'images')
+        self.assertEqual(self.route(send_digest_task), 'notifications')
+        self.assertEqual(self.route(send_alert_task), 'notifications')
+
+    def test_processing_tasks_ack_late(self):
+        for task in (image_task, image_batch_task):
+            self.assertTrue(task.acks_late)
+            self.assertTrue(task.reject_on_worker_lost)
+        self.assertFalse(send_alert_task.acks_late)
+
+
+class WorkerHealthTest(TestCase):
+    def test_first_check_probes_synchronously(self):
+        probe = MagicMock(return_value=True)
+        health = WorkerHealth(probe, ttl=60, reset_timeout=5)
+
+        self.assertTrue(health.check())
+        self.assertTrue(health.check())
+        probe.assert_called_once()
+
+    def test_outage_fails_fast(self):
+        probe = MagicMock(side_effect=ConnectionError("Celery server unavailable"))
+        health = WorkerHealth(probe, ttl=60, reset_timeout=60)
+
+        for _ in range(3):
+            with self.assertRaises(ConnectionError):
+                health.check()
+        probe.assert_called_once()
+
+    @patch('config.celery.threading.Thread', InlineThread)
+    def test_stale_state_refreshed_in_background(self):
+        probe = MagicMock(side_effect=[True, ConnectionError("down"), True])
+        health = WorkerHealth(probe, ttl=0, reset_timeout=0)
+
+        self.assertTrue(health.check())
+        # Stale state is served while the refresh runs
+        self.assertTrue(health.check())
+        with self.assertRaises(ConnectionError):
+            health.check()
+        self.assertEqual(probe.call_count, 3)
+
+
+class BlobStoreTest(IsolatedStorageMixin, TestCase):
+    def test_save_is_content_addressed(self):
+        content = make_image_bytes()
+        digest, created = blob_store.save(ContentFile(content))
+
+        self.assertTrue(created)
+        self.assertEqual(digest, hashlib.sha256(content).hexdigest())
+        self.assertEqual(
+            blob_store.path(digest),
+            os.path.join(blob_store.root, digest[:2], digest[2:4], digest),
+        )
+        with blob_store.open(digest) as buffer:
+            self.assertEqual(buffer.read(), content)
+
+    def test_repeat_upload_detected(self):
+        first, created_first = blob_store.save(ContentFile(b'same bytes'))
+        second, created_second = blob_store.save(ContentFile(b'same bytes'))
+
+        self.assertEqual(first, second)
+        self.assertTrue(created_first)
+        self.assertFalse(created_second)
+        self.assertEqual(os.listdir(os.path.join(blob_store.root, 'tmp')), [])
+
+
+@override_settings(VARIANT_SIZES=(16, 64))
+class VariantViewTest(IsolatedStorageMixin, ResponseDataMixin, TestCase):
+    def setUp(self):
+        super().setUp()
+        self.factory = RequestFactory()
+        self.view = VariantView.as_view()
+        self.digest, _ = blob_store.save(ContentFile(make_image_bytes(size=(200, 100))))
+
+    def get(self, size=16, extension='webp', digest=None, **headers):
+        request = self.factory.get('/variants/', headers=headers)
+        return self.view(request, digest=digest or self.digest, size=size, extension=extension)
+
+    def test_rendered_once_then_served_from_disk(self):
+        response = self.get()
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response['Content-Type'], 'image/webp')
+        self.assertIn('immutable', response['Cache-Control'])
+        self.assertIn('max-age=', response['Cache-Control'])
+        with Image.open(io.BytesIO(b''.join(response.streaming_content))) as variant:
+            self.assertEqual(variant.size, (16, 8))
+
+        with patch('photos.variants.render_variant') as mock_render:
+            response = self.get()
+            self.assertEqual(response.status_code, 200)
+            response.close()
+        mock_render.assert_not_called()
+
+    def test_conditional_get_not_modified(self):
+        etag = self.get()['ETag']
+
+        with patch('photos.variants.render_variant') as mock_render, \
+                patch('photos.views.variant_cache.get') as mock_get:
+            response = self.get(If_None_Match=etag)
+
+        self.assertEqual(response.status_code, 304)
+        mock_render.assert_not_called()
+        mock_get.assert_not_called()
+
+    def test_invalid_requests(self):
+        self.assertEqual(self.get(size=17).status_code, 400)
+        self.assertEqual(self.get(extension='gif').status_code, 400)
+        self.assertEqual(self.get(digest='0' * 64).status_code, 404)
+
+        digest, _ = blob_store.save(ContentFile(b'%PDF-1.7\n%...'))
+        self.assertEqual(self.get(digest=digest).status_code, 415)
+
+    def test_least_recently_used_evicted(self):
+        digests = [
+            blob_store.save(ContentFile(make_image_bytes(size=(64, 64), color=color)))[0]
+            for color in ((255, 0, 0), (0, 255, 0), (0, 0, 255))
+        ]
+        cache = VariantCache()
+        old, recent = cache.get(digests[0], 64, 'png'), cache.get(digests[1], 64, 'png')
+        os.utime(old, (1, 1))
+        os.utime(recent, (2, 2))
+        cache.get(digests[1], 64, 'png')  # a hit marks the variant as used now
+
+        cache._max_bytes = int(os.path.getsize(old) * 2.5)  # room for two of the three variants
+        newest = cache.get(digests[2], 64, 'png')
+
+        self.assertFalse(os.path.exists(old))
+        self.assertTrue(os.path.exists(recent))
+        self.assertTrue(os.path.exists(newest))
+
+    def test_size_shared_between_processes(self):
+        digests = [
+            blob_store.save(ContentFile(make_image_bytes(size=(64, 64), color=color)))[0]
+            for color in ((255, 0, 0), (0, 255, 0), (0, 0, 255))
+        ]
+        web, worker = VariantCache(), VariantCache()  # one per process
+        old = web.get(digests[0], 64, 'png')
+        os.utime(old, (1, 1))
+        other = worker.get(digests[1], 64, 'png')
+
+        web._max_bytes = int(os.path.getsize(old) * 2.5)
+        newest = web.get(digests[2], 64, 'png')
+
+        self.assertFalse(os.path.exists(old))
+        self.assertTrue(os.path.exists(other))
+        self.assertEqual(
+            caches['results'].get(web.size_prefix + web.root), os.path.getsize(other) + os.path.getsize(newest)
+        )
+
+    def test_variant_evicted_before_open_rendered(self):
+        with patch('photos.views.variant_cache.get', return_value=os.path.join(settings.VARIANT_CACHE_ROOT, 'evicted.webp')):
+            response = self.get()
+
+        self.assertEqual(response.status_code, 200)
+        with Image.open(io.BytesIO(b''.join(response.streaming_content))) as variant:
+            self.assertEqual(variant.size, (16, 8))
+
+    def test_eviction_skips_files_being_written(self):
+        cache = VariantCache(max_bytes=0)
+        os.makedirs(os.path.join(cache.root, 'ab'))
+        in_flight = os.path.join(cache.root, 'ab', 'tmpvariant.tmp')
+        with open(in_flight, 'wb') as file:
+            file.write(b'partial')
+        os.utime(in_flight, (1, 1))
+
+        cache.get(self.digest, 16, 'webp')
+
+        self.assertTrue(os.path.exists(in_flight))
+
+
+class PillowImageHandlerTest(IsolatedStorageMixin, TestCase):
+    def test_jpeg_from_blob_store(self):
+        digest, _ = blob_store.save(ContentFile(make_image_bytes(size=(40, 30))))
+
+        fields, _ = pillow_image_handler('upload.jpg', digest)
+
+        self.assertEqual((fields['width'], fields['height']), (40, 30))
+        self.assertEqual(fields['metadata']['variants']['16'], f'/api/variants/{digest}/16.webp')
+
+    @override_settings(VARIANT_SIZES=(16, 32))
+    def test_variants_served_without_rendering(self):
+        digest, _ = blob_store.save(ContentFile(make_image_bytes(size=(64, 48))))
+        fields, _ = pillow_image_handler('upload.jpg', digest)
+
+        with patch('photos.variants.render_variant') as mock_render:
+            response = VariantView.as_view()(RequestFactory().get('/'), digest=digest, size=16, extension='webp')
+            content = b''.join(response.streaming_content)
+
+        mock_render.assert_not_called()
+        with Image.open(io.BytesIO(content)) as variant:
+            self.assertEqual((variant.format, max(variant.size)), ('WEBP', 16))
+
+    def test_jpeg(self):
+        exif = Image.Exif()
+        exif[0x010F] = 'TestCam'  # Make
+        name = default_storage.save('photo.jpg', ContentFile(make_image_bytes(size=(64, 48), exif=exif)))
+
+        fields, execution_time = pillow_image_handler(name)
+
+        self.assertEqual((fields['width'], fields['height'], fields['format']), (64, 48, 'JPEG'))
+        self.assertEqual(len(fields['phash']), 16)
+        self.assertEqual(fields['metadata']['exif']['Make'], 'TestCam')
+        # Not a blob, so there is no /api/variants/ address for its variants
+        self.assertEqual(fields['metadata']['variants'], {})
+        self.assertGreaterEqual(execution_time, 0)
+
+    def test_nul_characters_stripped_from_exif(self):
+        exif = Image.Exif()
+        exif[0x010F] = 'TestCam\x00\x00'  # Make, NUL-padded as many cameras write it
+        digest, _ = blob_store.save(ContentFile(make_image_bytes(exif=exif)))
+
+        fields, _ = pillow_image_handler('upload.jpg', digest)
+
+        self.assertEqual(fields['metadata']['exif']['Make'], 'TestCam')
+        self.assertNotIn('\\u0000', json.dumps(fields['metadata']))
+
+    def test_full_size_recorded_despite_reduced_decode(self):
+        rotated = Image.Exif()
+        rotated[0x0112] = 6  # Orientation: rotate 90 CW
+        for exif, expected in ((None, (400, 300)), (rotated, (300, 400))):
+            digest, _ = blob_store.save(ContentFile(make_image_bytes(size=(400, 300), exif=exif)))
+
+            fields, _ = pillow_image_handler('upload.jpg', digest)
+
+            self.assertEqual((fields['width'], fields['height']), expected)
+
+    def test_pdf(self):
+        name = default_storage.save('doc.pdf', ContentFile(b'%PDF-1.7\n...'))
+
+        fields, _ = pillow_image_handler(name)
+
+        self.assertEqual(fields['format'], 'PDF')
+
+    def test_not_an_image(self):
+        name = default_storage.save('fake.jpg', ContentFile(b'file_content'))
+
+        with self.assertRaises(Exception):
+            pillow_image_handler(name)
+
+    def test_difference_hash_is_perceptual(self):
+        gradient = Image.linear_gradient('L').resize((64, 64)).transpose(Image.Transpose.ROTATE_90)
+        smaller = gradient.resize((32, 32))
+        mirrored = gradient.transpose(Image.Transpose.FLIP_LEFT_RIGHT)
+
+        self.assertEqual(difference_hash(gradient), difference_hash(smaller))
+        self.assertNotEqual(difference_hash(gradient), difference_hash(mirrored))
+
+
 class TaskStatusViewTest(ResponseDataMixin, TestCase):
     def setUp(self):
         self.factory = RequestFactory()
@@ -162,6 +1212,20 @@ class TaskStatusViewTest(ResponseDataMixin, TestCase):
         self.assertEqual(response.status_code, 200)
         self.assertEqual(data['status'], 'FAILURE')
 
+    @patch('photos.views.AsyncResult')
+    def test_expired_result_read_from_record(self, mock_async):
+        mock_async.return_value.status = 'PENDING'
+        record = ImageRecord.objects.create(task_id='123', file_name='test.jpg', image_random_num=42)
+
+        response = self.view(self.factory.get('task-status/?task_id=123'))
+        data = self.get_response_data(response)
+
+        self.assertEqual(data['status'], 'SUCCESS')
+        self.assertEqual(data['result'], {
+            'id': record.pk, 'file_name': 'test.jpg', 'image_random_num': 42,
+            'width': None, 'height': None, 'format': '', 'execution_time': None,
+        })
+
     def test_missing_task_id(self):
         request = self.factory.get('/task-status/')
         response = self.view(request, *[], **{})
@@ -171,17 +1235,362 @@ class TaskStatusViewTest(ResponseDataMixin, TestCase):
         self.assertIn('Error', data)
 
 
+class BatchStatusViewTest(ResponseDataMixin, TestCase):
+    def setUp(self):
+        self.factory = RequestFactory()
+        self.view = BatchStatusView.as_view()
+
+    @patch('photos.views.batch_status')
+    def test_task_ids(self, mock_batch_status):
+        mock_batch_status.return_value = {'cursor': 'SP', 'total': 2, 'completed': 1, 'tasks': {}}
+
+        request = self.factory.get('/batch-status/?task_ids=a,b&cursor=PP')
+        response = self.view(request)
+
+        self.assertEqual(response.status_code, 200)
+        mock_batch_status.assert_called_once_with(['a', 'b'], 'PP')
+
+    @patch('photos.views.batch_status')
+    @patch('photos.views.restore_batch')
+    def test_batch_id(self, mock_restore, mock_batch_status):
+        mock_restore.return_value = ['a', 'b', 'c']
+        mock_batch_status.return_value = {'cursor': 'PPP', 'total': 3, 'completed': 0, 'tasks': {}}
+
+        request = self.factory.get('/batch-status/?batch_id=batch-1')
+        response = self.view(request)
+        data = self.get_response_data(response)
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(data['total'], 3)
+        mock_restore.assert_called_once_with('batch-1')
+        mock_batch_status.assert_called_once_with(['a', 'b', 'c'], '')
+
+    @patch('photos.views.restore_batch', return_value=None)
+    def test_unknown_batch(self, mock_restore):
+        request = self.factory.get('/batch-status/?batch_id=missing')
+        response = self.view(request)
+
+        self.assertEqual(response.status_code, 404)
+
+    def test_missing_ids(self):
+        request = self.factory.get('/batch-status/')
+        response = self.view(request)
+        data = self.get_response_data(response)
+
+        self.assertEqual(response.status_code, 400)
+        self.assertIn('No task ids', data['error'])
+
+    def test_too_many_ids(self):
+        task_ids = ','.join(f'task-{i}' for i in range(101))
+        request = self.factory.get(f'/batch-status/?task_ids={task_ids}')
+        response = self.view(request)
+
+        self.assertEqual(response.status_code, 400)
+
+
+class BatchStatusTest(TestCase):
+    def test_single_mget_for_batch(self):
+        backend = app.backend
+        stored = {
+            backend.get_key_for_task('a'): backend.encode({'status': 'SUCCESS', 'result': {'id': 1}}),
+            backend.get_key_for_task('b'): None,
+        }
+        with patch.object(backend, 'mget', side_effect=lambda keys: [stored[key] for key in keys]) as mock_mget:
+            metas = fetch_task_meta(['a', 'b'])
+
+        mock_mget.assert_called_once()
+        self.assertEqual(metas['a']['status'], 'SUCCESS')
+        self.assertEqual(metas['a']['result'], {'id': 1})
+        self.assertEqual(metas['b']['status'], 'PENDING')
+
+    def test_expired_results_read_from_records(self):
+        backend = app.backend
+        record = ImageRecord.objects.create(task_id='expired', file_name='a.jpg', width=4, height=3, format='JPEG')
+
+        with patch.object(backend, 'mget', return_value=[None, None]):
+            metas = fetch_task_meta(['expired', 'queued'])
+
+        self.assertEqual(metas['expired'], {'status': 'SUCCESS', 'result': record.as_result()})
+        self.assertEqual(metas['queued']['status'], 'PENDING')
+
+    def test_failed_record_read_as_failure(self):
+        ImageRecord.objects.create(task_id='broken', file_name='a.jpg', status=ImageRecord.FAILURE, error='boom')
+
+        with patch.object(app.backend, 'mget', return_value=[None]):
+            metas = fetch_task_meta(['broken'])
+
+        self.assertEqual(metas['broken'], {'status': 'FAILURE', 'result': 'boom'})
+
+    @patch('photos.status.GroupResult.restore', return_value=None)
+    def test_expired_batch_restored_from_records(self, mock_restore):
+        # Processed out of order: the enqueue position, not the write order, keeps the client's cursor valid
+        ImageRecord.objects.create(task_id='second', batch_id='batch', batch_index=1, file_name='b.jpg')
+        ImageRecord.objects.create(task_id='first', batch_id='batch', batch_index=0, file_name='a.jpg')
+        ImageRecord.objects.create(task_id='other', batch_id='other', batch_index=0, file_name='c.jpg')
+
+        self.assertEqual(restore_batch('batch'), ['first', 'second'])
+        self.assertIsNone(restore_batch('unknown'))
+
+    @patch('photos.status.fetch_task_meta')
+    def test_only_changed_since_cursor(self, mock_fetch):
+        mock_fetch.return_value = {
+            'a': {'status': 'SUCCESS', 'result': {'id': 1}},
+            'b': {'status': 'PENDING', 'result': None},
+            'c': {'status': 'FAILURE', 'result': Exception('boom')},
+        }
+
+        data = batch_status(['a', 'b', 'c'], cursor='PPP')
+
+        self.assertEqual(data['cursor'], 'SPF')
+        self.assertEqual(data['completed'], 2)
+        self.assertEqual(set(data['tasks']), {'a', 'c'})
+        self.assertEqual(data['tasks']['a']['result'], {'id': 1})
+        self.assertEqual(data['tasks']['c']['error'], 'boom')
+
+    @patch('photos.status.fetch_task_meta')
+    def test_no_cursor_returns_all(self, mock_fetch):
+        mock_fetch.return_value = {
+            'a': {'status': 'PENDING', 'result': None},
+            'b': {'status': 'PENDING', 'result': None},
+        }
+
+        data = batch_status(['a', 'b'])
+
+        self.assertEqual(set(data['tasks']), {'a', 'b'})
+        self.assertIsNone(data['tasks']['a']['result'])
+
+
+class FakePubSub:
+    def __init__(self, messages):
+        self.messages = list(messages)
+        self.channels = []
+
+    async def subscribe(self, *channels):
+        self.channels.extend(channels)
+
+    async def get_message(self, ignore_subscribe_messages=False, timeout=None):
+        return self.messages.pop(0) if self.messages else None
+
+    async def aclose(self):
+        pass
+
+
+class BatchEventsTest(TestCase):
+    def collect(self, task_ids, messages, metas):
+        pubsub = FakePubSub(messages)
+        client = MagicMock()
+        client.pubsub.return_value = pubsub
+        client.aclose = AsyncMock()
+
+        async def run():
+            return [event async for event in stream_batch_events(task_ids)]
+
+        with patch('photos.status.async_result_client', return_value=client), \
+                patch('photos.status.fetch_task_meta', return_value=metas):
+            return asyncio.run(run()), pubsub
+
+    def published(self, task_id, meta):
+        backend = app.backend
+        return {'channel': backend.get_key_for_task(task_id), 'data': backend.encode(meta)}
+
+    def test_pushes_transitions_until_done(self):
+        metas = {
+            'a': {'status': 'PENDING', 'result': None},
+            'b': {'status': 'SUCCESS', 'result': {'id': 2}},
+        }
+        messages = [
+            None,
+            self.published('a', {'status': 'SUCCESS', 'result': {'id': 1}}),
+        ]
+        events, pubsub = self.collect(['a', 'b'], messages, metas)
+
+        self.assertEqual(len(pubsub.channels), 2)
+        self.assertEqual(events[0].splitlines()[0], 'event: status')
+        self.assertEqual(events[2], ': keepalive\n\n')
+        last_status = json.loads(events[3].splitlines()[1][len('data: '):])
+        self.assertEqual(last_status, {'task_id': 'a', 'status': 'SUCCESS', 'result': {'id': 1}})
+        self.assertTrue(events[-1].startswith('event: done'))
+        self.assertIn('"completed": 2', events[-1])
+
+    @override_settings(BATCH_EVENTS_TIMEOUT=0)
+    def test_timeout_ends_stream(self):
+        metas = {'a': {'status': 'PENDING', 'result': None}}
+        events, _ = self.collect(['a'], [], metas)
+
+        self.assertEqual(len(events), 2)
+        self.assertIn('"completed": 0', events[-1])
+
+
+class BatchEventsViewTest(ResponseDataMixin, TestCase):
+    def setUp(self):
+        self.factory = AsyncRequestFactory()
+        self.view = BatchEventsView.as_view()
+
+    def test_missing_batch_id(self):
+        response = asyncio.run(self.view(self.factory.get('/batch-events/')))
+        self.assertEqual(response.status_code, 400)
+
+    @patch('photos.views.restore_batch', return_value=None)
+    def test_unknown_batch(self, mock_restore):
+        response = asyncio.run(self.view(self.factory.get('/batch-events/?batch_id=missing')))
+        self.assertEqual(response.status_code, 404)
+
+    @patch('photos.views.stream_batch_events')
+    @patch('photos.views.restore_batch', return_value=['a'])
+    def test_stream_response(self, mock_restore, mock_stream):
+        async def events(task_ids):
+            yield 'event: done\ndata: {}\n\n'
+        mock_stream.side_effect = events
+
+        response = asyncio.run(self.view(self.factory.get('/batch-events/?batch_id=batch-1')))
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response['Content-Type'], 'text/event-stream')
+        mock_stream.assert_called_once_with(['a'])
+
+
+class ImageListViewTest(ResponseDataMixin, TestCase):
+    def setUp(self):
+        self.factory = RequestFactory()
+        self.view = ImageListView.as_view()
+
+    def get(self, **params):
+        response = self.view(self.factory.get('/images/', params))
+        return response, self.get_response_data(response)
+
+    def create(self, count, batch_id='', created_at=None):
+        records = ImageRecord.objects.bulk_create(
+            ImageRecord(file_name=f"{batch_id}{i}.jpg", batch_id=batch_id) for i in range(count)
+        )
+        if created_at:
+            ImageRecord.objects.filter(pk__in=[record.pk for record in records]).update(created_at=created_at)
+        return records
+
+    def test_pages_follow_cursor_without_overlap(self):
+        records = self.create(5)
+
+        seen, cursor = [], None
+        while True:
+            with self.assertNumQueries(1):
+                response, data = self.get(limit=2, **({'cursor': cursor} if cursor else {}))
+            self.assertEqual(response.status_code, 200)
+            seen += [row['id'] for row in data['results']]
+            cursor = data['next_cursor']
+            if cursor is None:
+                break
+
+        # Same created_at for the whole bulk insert: ties are broken by id
+        self.assertEqual(seen, sorted((record.pk for record in records), reverse=True))
+
+    def test_filters_and_fields(self):
+        self.create(2, batch_id='old', created_at=datetime(2024, 1, 1, tzinfo=dt_timezone.utc))
+        self.create(3, batch_id='new', created_at=datetime(2024, 2, 1, tzinfo=dt_timezone.utc))
+
+        _, data = self.get(batch_id='new', fields='id,file_name')
+        self.assertEqual(len(data['results']), 3)
+        self.assertEqual(set(data['results'][0]), {'id', 'file_name'})
+
+        _, data = self.get(since='2024-01-15')
+        self.assertEqual({row['batch_id'] for row in data['results']}, {'new'})
+        _, data = self.get(until='2024-01-01')
+        self.assertEqual({row['batch_id'] for row in data['results']}, {'old'})
+
+    def test_only_requested_columns_selected(self):
+        self.create(1)
+
+        with self.assertNumQueries(1) as context:
+            self.get(fields='file_name')
+
+        sql = context.captured_queries[0]['sql']
+        self.assertIn('"file_name"', sql)
+        self.assertNotIn('"metadata"', sql)
+
+    def test_invalid_parameters(self):
+        for params in ({'fields': 'password'}, {'cursor': 'garbage'}, {'since': 'yesterday'}, {'limit': 'x'}):
+            response, data = self.get(**params)
+            self.assertEqual(response.status_code, 400, params)
+            self.assertIn('error', data)
+
+
+class ImageRecordWriterTest(TestCase):
+    def test_single_write_gets_pk(self):
+        writer = ImageRecordWriter(bulk=True, batch_size=10, flush_interval=0)
+
+        record = writer.write(file_name='a.jpg', image_random_num=1)
+
+        self.assertIsNotNone(record.pk)
+        self.assertEqual(ImageRecord.objects.get(pk=record.pk).file_name, 'a.jpg')
+
+    def test_per_row_fallback(self):
+        writer = ImageRecordWriter(bulk=False)
+
+        with patch.object(ImageRecord.objects, 'bulk_create') as mock_bulk_create:
+            record = writer.write(file_name='a.jpg', image_random_num=1)
+
+        mock_bulk_create.assert_not_called()
+        self.assertIsNotNone(record.pk)
+
+    def test_concurrent_writes_coalesce(self):
+        writer = ImageRecordWriter(bulk=True, batch_size=5, flush_interval=5)
+        flushed = []
+
+        def bulk_create(records, batch_size=None, **kwargs):
+            flushed.append(len(records))
+            for pk, record in enumerate(records, start=1):
+                record.pk = pk
+            return records
+
+        results = []
+        with patch.object(ImageRecord.objects, 'bulk_create', side_effect=bulk_create):
+            threads = [
+                threading.Thread(target=lambda i=i: results.append(writer.write(file_name=f'{i}.jpg', image_random_num=i)))
+                for i in range(5)
+            ]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join(timeout=5)
+
+        self.assertEqual(flushed, [5])
+        self.assertEqual(sorted(record.pk for record in results), [1, 2, 3, 4, 5])
+
+    def test_auto_mode_follows_worker_pool(self):
+        prefork, threads = ImageRecordWriter(bulk=None), ImageRecordWriter(bulk=None)
+
+        prefork.configure_for_pool('prefork', 4)
+        threads.configure_for_pool('threads', 8)
+
+        self.assertEqual((prefork.bulk, prefork.concurrency), (False, 1))
+        self.assertEqual((threads.bulk, threads.concurrency), (True, 8))
+
+    def test_no_wait_when_one_task_runs_at_a_time(self):
+        writer = ImageRecordWriter(bulk=True, batch_size=50, flush_interval=5, concurrency=1)
+
+        started = time.monotonic()
+        record = writer.write(file_name='a.jpg', image_random_num=1)
+
+        self.assertLess(time.monotonic() - started, 1)
+        self.assertIsNotNone(record.pk)
+
+    def test_flush_error_reaches_every_writer(self):
+        writer = ImageRecordWriter(bulk=True, batch_size=1, flush_interval=0)
+
+        with patch.object(ImageRecord.objects, 'bulk_create', side_effect=OperationalError('db down')):
+            with self.assertRaises(OperationalError):
+                writer.write(file_name='a.jpg', image_random_num=1)
+
+
 class ImageValidatorTest(TestCase):
     def setUp(self):
         self.validator = ImageValidator()
         self.valid_file = SimpleUploadedFile(
-            VALID_FILE_NAME, b"content", "image/jpeg"
+            VALID_FILE_NAME, JPEG_CONTENT, "image/jpeg"
         )
         self.invalid_ext_file = SimpleUploadedFile(
             INVALID_FILE_NAME, b"content", "text/plain"
         )
         self.large_file = SimpleUploadedFile(
-            LARGE_FILE_NAME, b"x" * (6 * 1024 * 1024), "image/jpeg"
+            LARGE_FILE_NAME, JPEG_CONTENT + b"x" * (6 * 1024 * 1024), "image/jpeg"
         )
         self.long_name_file = MagicMock()
         self.long_name_file.name = LONG_NAME_FILE
@@ -208,22 +1617,64 @@ class ImageValidatorTest(TestCase):
             self.validator(self.long_name_file)
         self.assertIn("Name too long", str(ctx.exception))
 
+    def test_mislabeled_content(self):
+        png_as_jpg = SimpleUploadedFile("image.jpg", make_image_bytes(image_format='PNG'), "image/jpeg")
+        with self.assertRaises(ValidationError) as ctx:
+            self.validator(png_as_jpg)
+        self.assertIn("does not match extension", str(ctx.exception))
+
+    def test_corrupted_image(self):
+        corrupted = SimpleUploadedFile("image.png", b"\x89PNG\r\n\x1a\n" + b"\x00" * 64, "image/png")
+        with self.assertRaises(ValidationError) as ctx:
+            self.validator(corrupted)
+        self.assertIn("Unreadable image data", str(ctx.exception))
+
+    def test_pixel_limit(self):
+        validator = ImageValidator(max_pixels=1000)
+        with self.assertRaises(ValidationError) as ctx:
+            validator(self.valid_file)
+        self.assertIn("Image too large (3072 > 1000 pixels)", str(ctx.exception))
+
+    def test_pdf_signature(self):
+        pdf = SimpleUploadedFile("doc.pdf", b"%PDF-1.7\n%...", "application/pdf")
+        self.assertTrue(self.validator(pdf))
+
+    def test_reads_only_header(self):
+        noise = Image.effect_noise((1000, 1000), 64).convert('RGB')
+        buffer = io.BytesIO()
+        noise.save(buffer, 'JPEG', quality=95)
+        upload = SimpleUploadedFile("noise.jpg", buffer.getvalue(), "image/jpeg")
+        bytes_read = []
+        read = upload.file.read
+
+        def counting_read(size=-1):
+            data = read(size)
+            bytes_read.append(len(data))
+            return data
+        upload.file.read = counting_read
+
+        self.validator(upload)
+
+        self.assertGreater(upload.size, 100 * 1024)
+        self.assertLess(sum(bytes_read), 16 * 1024)
+        self.assertEqual(upload.tell(), 0)
+
 
 class ImageBatchValidatorTest(TestCase):
     def setUp(self):
         self.validator = ImageBatchValidator()
         self.valid_files = [
-            SimpleUploadedFile(f"img{i}.jpg", b"content", "image/jpeg")
+            SimpleUploadedFile(f"img{i}.jpg", JPEG_CONTENT, "image/jpeg")
             for i in range(5)
         ]
         self.too_many_files = [
-            SimpleUploadedFile(f"img{i}.jpg", b"content", "image/jpeg")
+            SimpleUploadedFile(f"img{i}.jpg", JPEG_CONTENT, "image/jpeg")
             for i in range(101)
         ]
         self.mixed_files = [
-            SimpleUploadedFile("img1.jpg", b"content", "image/jpeg"),
+            SimpleUploadedFile("img1.jpg", JPEG_CONTENT, "image/jpeg"),
             SimpleUploadedFile("invalid.txt", b"content", "text/plain"),
-            SimpleUploadedFile("img2.jpg", b"content", "image/jpeg")
+            SimpleUploadedFile("img2.jpg", JPEG_CONTENT, "image/jpeg")
         ]
 
     def test_valid_batch(self):
@@ -248,4 +1699,376 @@ class ImageBatchValidatorTest(TestCase):
         ]
         with self.assertRaises(ValidationError) as ctx:
             self.validator(invalid_files)
-        self.assertIn("No valid images provided", str(ctx.exception))
\ No newline at end of file
+        self.assertIn("No valid images provided", str(ctx.exception))
+
+    def test_structured_results_keep_order(self):
+        rejected = [FileValidationResult('skipped.gif', error=ValidationError('bad', code='extension'))]
+
+        results = self.validator.validate(self.mixed_files, rejected=rejected)
+
+        self.assertEqual([result.name for result in results], ['skipped.gif', 'img1.jpg', 'invalid.txt', 'img2.jpg'])
+        self.assertEqual([result.valid for result in results], [False, True, False, True])
+        self.assertEqual(results[2].as_dict(), {
+            'file_name': 'invalid.txt', 'valid': False, 'code': 'extension',
+            'error': "Unsupported extension 'txt'. Allowed: jpg, jpeg, png, pdf, webp",
+        })
+
+    def test_content_read_only_after_cheap_checks_pass(self):
+        files = [
+            SimpleUploadedFile("big.jpg", JPEG_CONTENT + b"x" * (6 * 1024 * 1024), "image/jpeg"),
+            SimpleUploadedFile("invalid.txt", b"content", "text/plain"),
+            SimpleUploadedFile("img.jpg", JPEG_CONTENT, "image/jpeg"),
+        ]
+        with patch.object(ImageValidator, 'validate_content') as mock_content, \
+                patch('photos.validators.ThreadPoolExecutor') as mock_pool:
+            results = self.validator.validate(files)
+
+        self.assertEqual([call.args[0].name for call in mock_content.call_args_list], ['img.jpg'])
+        mock_pool.assert_not_called()
+        self.assertEqual([result.code for result in results], ['size', 'extension', None])
+
+    def test_count_checked_before_files(self):
+        with patch.object(ImageValidator, 'validate_metadata') as mock_metadata:
+            with self.assertRaises(ValidationError):
+                self.validator(self.too_many_files)
+        mock_metadata.assert_not_called()
+
+
+class StubWebhookHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers['Content-Length']))
+        self.server.requests.append((self.path, json.loads(body), self.client_address))
+        status = 200 if self.server.status is None else self.server.status
+        self.send_response(status)
+        for name, value in self.server.headers.items():
+            self.send_header(name, value)
+        self.send_header('Content-Length', str(len(self.server.body)))
+        self.end_headers()
+        self.wfile.write(self.server.body)
+
+    def log_message(self, *args):
+        pass
+
+
+@override_settings(NOTIFICATION_TIMEOUT=5, NOTIFICATION_POOL_SIZE=4)
+class NotificationSenderTest(TestCase):
+    def setUp(self):
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), StubWebhookHandler)
+        self.server.requests = []
+        self.server.status = None
+        self.server.headers = {}
+        self.server.body = b'ok'
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        self.url = f"http://127.0.0.1:{self.server.server_port}"
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def test_slack_sender_reuses_connection(self):
+        sender = SlackSender(webhook_url=f"{self.url}/hook")
+
+        self.assertTrue(sender.send("first"))
+        self.assertTrue(sender.send("second"))
+
+        self.assertEqual([body for _, body, _ in self.server.requests], [{"text": "first"}, {"text": "second"}])
+        # Same client port: the second request went over the kept-alive connection
+        self.assertEqual(self.server.requests[0][2], self.server.requests[1][2])
+
+    def test_telegram_sender_posts_to_api_url(self):
+        sender = TelegramSender(token="token", chat_id="42", api_url=self.url)
+
+        self.assertTrue(sender.send("hello"))
+
+        path, body, _ = self.server.requests[0]
+        self.assertEqual(path, "/bottoken/sendMessage")
+        self.assertEqual(body, {"chat_id": "42", "text": "hello"})
+
+    def test_failed_response(self):
+        self.server.status = 500
+
+        self.assertFalse(SlackSender(webhook_url=self.url).send("message"))
+
+    def test_slack_rate_limit_retry_after_header(self):
+        self.server.status = 429
+        self.server.headers = {'Retry-After': '7'}
+
+        with self.assertRaises(RateLimitError) as cm:
+            SlackSender(webhook_url=self.url).send("message")
+        self.assertEqual(cm.exception.retry_after, 7)
+
+    def test_telegram_rate_limit_retry_after_body(self):
+        self.server.status = 429
+        self.server.body = json.dumps({'ok': False, 'parameters': {'retry_after': 3}}).encode()
+
+        with self.assertRaises(RateLimitError) as cm:
+            TelegramSender(token="token", chat_id="42", api_url=self.url).send("message")
+        self.assertEqual(cm.exception.retry_after, 3)
+
+
+class NotificationDigestTest(TestCase):
+    def test_build_digest_single_message(self):
+        self.assertEqual(build_digest(["a.jpg: 0.1s"], max_length=100), "a.jpg: 0.1s")
+
+    def test_build_digest_truncates(self):
+        messages = [f"image_{index}.jpg: 0.1s" for index in range(100)]
+
+        digest = build_digest(messages, max_length=200)
+
+        self.assertLessEqual(len(digest), 200)
+        self.assertTrue(digest.startswith("100 images processed:\nimage_0.jpg"))
+        self.assertRegex(digest, r"\.\.\. and \d+ more$")
+
+    @patch('photos.tasks.send_digest_task.apply_async')
+    @patch('photos.tasks.notification_digest')
+    def test_first_message_of_window_schedules_digest(self, mock_digest, mock_apply_async):
+        mock_digest.add.side_effect = [True, False]
+        mock_digest.window = 5
+
+        with patch('photos.tasks.get_handler') as mock_get_handler:
+            mock_get_handler.return_value.return_value = ({'image_random_num': 7}, 0.1)
+            image_task.apply(args=('a.jpg', None, 'batch-1'))
+            image_task.apply(args=('b.jpg', None, 'batch-1'))
+
+        self.assertEqual([call.args[0] for call in mock_digest.add.call_args_list], ['batch-1', 'batch-1'])
+        mock_apply_async.assert_called_once_with(('batch-1',), countdown=5)
+
+    @patch('photos.tasks.send_alert_task.delay')
+    @patch('photos.tasks.notification_digest')
+    @override_settings(NOTIFICATION_BACKENDS=['backend.a', 'backend.b'])
+    def test_send_digest_task_enqueues_alert_per_backend(self, mock_digest, mock_alert_delay):
+        mock_digest.pop.return_value = ["a.jpg: 0.1s", "b.jpg: 0.2s"]
+
+        result = send_digest_task.apply(args=('batch-1',)).get()
+
+        self.assertEqual(result, 2)
+        mock_digest.pop.assert_called_once_with('batch-1')
+        digest = "2 images processed:\na.jpg: 0.1s\nb.jpg: 0.2s"
+        self.assertEqual([call.args for call in mock_alert_delay.call_args_list],
+                         [('backend.a', digest), ('backend.b', digest)])
+
+    @patch('photos.tasks.send_alert_task.delay')
+    @patch('photos.tasks.notification_digest')
+    def test_empty_digest_is_not_sent(self, mock_digest, mock_alert_delay):
+        mock_digest.pop.return_value = []
+
+        send_digest_task.apply(args=('batch-1',))
+
+        mock_alert_delay.assert_not_called()
+
+
+@override_settings(NOTIFICATION_MAX_RETRIES=2, NOTIFICATION_BACKOFF_BASE=2, NOTIFICATION_BACKOFF_MAX=5)
+@patch('photos.tasks.rate_limiter.acquire', return_value=0.0)
+@patch('photos.tasks.get_handler')
+class SendAlertTaskTest(TestCase):
+    # Eager retries run immediately; countdowns are checked on the retry calls
+    def run_task(self):
+        with patch.object(send_alert_task, 'retry', wraps=send_alert_task.retry) as mock_retry:
+            result = send_alert_task.apply(args=('backend.a', 'message')).get()
+        return result, [call.kwargs for call in mock_retry.call_args_list]
+
+    def test_success(self, mock_get_handler, mock_acquire):
+        mock_get_handler.return_value.send.return_value = True
+
+        result, retries = self.run_task()
+
+        self.assertTrue(result)
+        self.assertEqual(retries, [])
+        mock_acquire.assert_called_once_with('backend.a')
+
+    def test_exponential_backoff_then_dead_letter(self, mock_get_handler, mock_acquire):
+        mock_get_handler.return_value.send.side_effect = [False, ConnectionError("down"), False]
+        before = sample_value('photos_notifications_total', backend='backend.a', outcome='dead_letter')
+
+        result, retries = self.run_task()
+
+        self.assertFalse(result)
+        self.assertEqual([retry['countdown'] for retry in retries], [2, 4])
+        failed = FailedNotification.objects.get()
+        self.assertEqual((failed.backend, failed.message, failed.attempts), ('backend.a', 'message', 3))
+        self.assertIn('alert failed', failed.error)
+        self.assertEqual(sample_value('photos_notifications_total', backend='backend.a', outcome='dead_letter'), before + 1)
+
+    def test_retry_after_overrides_backoff(self, mock_get_handler, mock_acquire):
+        mock_get_handler.return_value.send.side_effect = [RateLimitError("429", retry_after=30), True]
+
+        result, retries = self.run_task()
+
+        self.assertTrue(result)
+        self.assertEqual(retries[0]['countdown'], 30)
+        self.assertFalse(FailedNotification.objects.exists())
+
+    def test_rate_limit_wait_is_not_an_attempt(self, mock_get_handler, mock_acquire):
+        mock_acquire.side_effect = [0.5, 0.5, 0.0]
+        mock_get_handler.return_value.send.return_value = True
+
+        result, retries = self.run_task()
+
+        self.assertTrue(result)
+        self.assertEqual([retry['countdown'] for retry in retries], [0.5, 0.5])
+        self.assertTrue(all('kwargs' not in retry for retry in retries))
+
+
+class TokenBucketTest(TestCase):
+    def test_unknown_backend_is_not_limited(self):
+        bucket = TokenBucket('redis://localhost:1/0', limits={})
+
+        self.assertEqual(bucket.acquire('backend.a'), 0.0)
+
+    def test_fails_open_without_redis(self):
+        bucket = TokenBucket('redis://localhost:1/0', limits={'backend.a': (1.0, 1)})
+
+        self.assertEqual(bucket.acquire('backend.a'), 0.0)
+
+    def test_script_result(self):
+        bucket = TokenBucket('redis://localhost:1/0', limits={'backend.a': (2.0, 5)})
+        bucket._acquire = MagicMock(return_value=b'0.25')
+
+        self.assertEqual(bucket.acquire('backend.a'), 0.25)
+        kwargs = bucket._acquire.call_args.kwargs
+        self.assertEqual(kwargs['keys'], ['rate-limit:backend.a'])
+        self.assertEqual(kwargs['args'][:2], [2.0, 5])
+
+
+class BenchmarkTest(TestCase):
+    def test_percentiles(self):
+        data = percentiles([index / 1000 for index in range(1, 101)])
+
+        self.assertAlmostEqual(data['p50'], 50.5)
+        self.assertAlmostEqual(data['p95'], 95.05)
+        self.assertAlmostEqual(data['p99'], 99.01)
+        self.assertEqual(percentiles([0.002]), {'p50': 2.0, 'p95': 2.0, 'p99': 2.0, 'mean': 2.0})
+
+    def test_compare_results(self):
+        baseline = {'upload': {'latency_ms': {'p50': 10.0}, 'requests_per_sec': 100.0}}
+        current = {'upload': {'latency_ms': {'p50': 13.0}, 'requests_per_sec': 90.0}}
+
+        rows = {row['metric']: row for row in compare_results(baseline, current, threshold=0.2)}
+
+        self.assertEqual(set(rows), {'upload.latency_ms.p50', 'upload.requests_per_sec'})
+        self.assertTrue(rows['upload.latency_ms.p50']['regressed'])
+        self.assertFalse(rows['upload.requests_per_sec']['regressed'])
+        self.assertEqual(rows['upload.requests_per_sec']['change'], -0.1)
+
+    def test_local_run(self):
+        with tempfile.TemporaryDirectory() as output, tempfile.TemporaryDirectory() as variant_root, \
+                override_settings(VARIANT_CACHE_ROOT=variant_root):
+            call_command('benchmark', files=2, rounds=2, image_size=16, seed=1, output=output, stdout=io.StringIO())
+            # Variants of the benchmark's blobs stay in its temporary directory
+            self.assertEqual(os.listdir(variant_root), [])
+
+            [name] = os.listdir(output)
+            with open(os.path.join(output, name)) as file:
+                result = json.load(file)
+
+        self.assertEqual(result['config']['files'], 2)
+        self.assertEqual(result['upload']['requests'], 2)
+        self.assertEqual(result['process']['tasks'], 4)
+        self.assertEqual(set(result['process']['latency_ms']), {'p50', 'p95', 'p99', 'mean'})
+        self.assertEqual(set(result['status']), {'task_status_ms', 'batch_status_ms', 'queries_per_poll'})
+        # Benchmark writes are rolled back
+        self.assertFalse(ImageRecord.objects.exists())
+
+    def test_connection_churn(self):
+        output = io.StringIO()
+        call_command('connection_churn', iterations=5, stdout=output)
+
+        result = json.loads(output.getvalue())
+        self.assertEqual(result['iterations'], 5)
+        self.assertEqual(result['config']['database'], 'sqlite')
+        self.assertLessEqual(result['connections_opened'], 5)
+
+    def test_migrations_committed(self):
+        # Containers only apply migrations on start, so every model change must ship with one
+        call_command('makemigrations', 'photos', check=True, dry_run=True, stdout=io.StringIO())
+
+
+def sample_value(name: str, **labels) -> float:
+    return REGISTRY.get_sample_value(name, labels) or 0.0
+
+
+class MetricsTest(TestCase):
+    def test_validation_rejects_counted_by_reason(self):
+        before = sample_value('photos_validation_rejects_total', reason='extension')
+        images = [
+            SimpleUploadedFile("ok.jpg", JPEG_CONTENT, "image/jpeg"),
+            SimpleUploadedFile("bad.gif", b"GIF89a", "image/gif"),
+        ]
+
+        ImageBatchValidator()(images)
+
+        self.assertEqual(sample_value('photos_validation_rejects_total', reason='extension'), before + 1)
+
+    def test_publish_stamps_enqueue_time(self):
+        headers = {}
+
+        _stamp_enqueued_at(headers=headers)
+
+        self.assertAlmostEqual(headers['enqueued_at'], time.time(), delta=1)
+
+    def test_queue_wait_observed_from_publish_or_eta(self):
+        task = MagicMock()
+        task.name = 'photos.tasks.metrics_test'
+        task.request.is_eager = False
+        task.request.enqueued_at = time.time() - 2
+        task.request.eta = None
+
+        _observe_queue_wait(task=task)
+        self.assertGreaterEqual(sample_value('photos_task_queue_wait_seconds_sum', task=task.name), 2)
+
+        # The countdown of a retry is not counted as waiting
+        task.request.eta = datetime.now(dt_timezone.utc).isoformat()
+        _observe_queue_wait(task=task)
+        self.assertEqual(sample_value('photos_task_queue_wait_seconds_count', task=task.name), 2)
+        self.assertLess(sample_value('photos_task_queue_wait_seconds_sum', task=task.name), 3)
+
+    def test_eager_tasks_are_not_observed(self):
+        task = MagicMock()
+        task.name = 'photos.tasks.metrics_eager_test'
+        task.request.is_eager = True
+        task.request.enqueued_at = time.time()
+
+        _observe_queue_wait(task=task)
+
+        self.assertEqual(sample_value('photos_task_queue_wait_seconds_count', task=task.name), 0)
+
+    @patch('config.celery.app.connection_for_read')
+    def test_metrics_view(self, mock_connection):
+        channel = mock_connection.return_value.__enter__.return_value.default_channel
+        channel.queue_declare.return_value = ('images', 3, 0)
+
+        response = MetricsView.as_view()(RequestFactory().get('/metrics'))
+        body = response.content.decode()
+
+        self.assertEqual(response.status_code, 200)
+        self.assertIn('photos_image_handler_seconds', body)
+        self.assertIn('photos_queue_depth{queue="images"} 3.0', body)
+        self.assertIn('photos_queue_depth{queue="notifications"} 3.0', body)
+
+    def test_containers_aggregated_from_separate_directories(self):
+        root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, root)
+        web, worker = os.path.join(root, 'web'), os.path.join(root, 'images')
+        os.makedirs(web)
+        os.makedirs(worker)
+        subprocess.run(
+            [sys.executable, '-c', "from prometheus_client import Counter; Counter('photos_probe', 'x').inc()"],
+            env={**os.environ, 'PROMETHEUS_MULTIPROC_DIR': web}, check=True,
+        )
+        # Another container's process with the same PID writes a file of the same name
+        [name] = os.listdir(web)
+        shutil.copy(os.path.join(web, name), os.path.join(worker, name))
+
+        with patch.dict(os.environ, {'PROMETHEUS_MULTIPROC_ROOT': root}), \
+                patch('config.celery.app.connection_for_read', side_effect=ConnectionError("broker down")):
+            body = generate_metrics().decode()
+
+        self.assertIn('photos_probe_total 2.0', body)
+
+    @patch('config.celery.app.connection_for_read', side_effect=ConnectionError("broker down"))
+    def test_queue_depth_broker_unavailable(self, mock_connection):
+        [family] = QueueDepthCollector().collect()
+
+        self.assertEqual(family.samples, [])
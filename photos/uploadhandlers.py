@@ -0,0 +1,155 @@
+import logging
+from types import SimpleNamespace
+
+from django.core.exceptions import ValidationError
+from django.core.files.uploadedfile import UploadedFile
+from django.core.files.uploadhandler import FileUploadHandler, SkipFile, StopFutureHandlers
+
+from .metrics import count_rejection
+from .storage import blob_store
+from .validators import FileValidationResult, ImageValidator, SIGNATURE_LENGTH
+
+
+logger = logging.getLogger(__name__)
+
+
+class StoredUploadedFile(UploadedFile):
+    """An upload already written to the blob store; digest is its SHA-256."""
+
+    def __init__(self, name, content_type, size, charset, digest, created, content_type_extra=None):
+        super().__init__(open(blob_store.path(digest), 'rb'), name, content_type, size, charset, content_type_extra)
+        self.digest = digest
+        self.created = created
+
+    def temporary_file_path(self):
+        return blob_store.path(self.digest)
+
+
+class ValidatingUploadHandler(FileUploadHandler):
+    """
+    Validates image uploads while they are received and streams them into the blob store.
+
+    The extension and name are checked before the first byte is stored, the
+    magic bytes on the first chunk, and the size on every chunk, so a rejected
+    file is dropped as soon as the problem shows up instead of after the whole
+    request is buffered. The SHA-256 is computed on the fly. Rejected files
+    are collected in request.upload_rejections as FileValidationResult, stored
+    ones in request.stored_uploads for discard_new_blobs.
+    """
+
+    field_name = 'images'
+
+    def __init__(self, request=None):
+        super().__init__(request)
+        self.validator = ImageValidator()
+        self.blob_writer = None
+        self.header = b''
+        if request is not None:
+            request.upload_rejections = []
+            request.stored_uploads = []
+
+    def new_file(self, field_name, file_name, *args, **kwargs):
+        super().new_file(field_name, file_name, *args, **kwargs)
+        if field_name != self.field_name:
+            return
+
+        image = SimpleNamespace(name=file_name, size=0)
+        try:
+            self.validator.validate_extension(image)
+            self.validator.validate_name(image)
+        except ValidationError as e:
+            self.reject(e)
+
+        self.header = b''
+        self.blob_writer = blob_store.writer()
+        raise StopFutureHandlers()
+
+    def receive_data_chunk(self, raw_data, start):
+        if self.blob_writer is None:
+            return raw_data
+
+        image = SimpleNamespace(name=self.file_name, size=self.blob_writer.size + len(raw_data))
+        try:
+            if len(self.header) < SIGNATURE_LENGTH:
+                self.header += raw_data[:SIGNATURE_LENGTH - len(self.header)]
+                if len(self.header) >= SIGNATURE_LENGTH:
+                    self.validator.validate_signature(image, self.header)
+            self.validator.validate_size(image)
+        except ValidationError as e:
+            self.discard()
+            self.reject(e)
+
+        self.blob_writer.write(raw_data)
+        return None
+
+    def file_complete(self, file_size):
+        if self.blob_writer is None:
+            return None
+
+        # file_complete cannot skip a file; files shorter than the signature are left to ImageValidator
+        digest, created = self.blob_writer.commit()
+        self.blob_writer = None
+        file = StoredUploadedFile(
+            name=self.file_name,
+            content_type=self.content_type,
+            size=file_size,
+            charset=self.charset,
+            digest=digest,
+            created=created,
+            content_type_extra=self.content_type_extra,
+        )
+        if self.request is not None:
+            self.request.stored_uploads.append(file)
+        return file
+
+    def upload_interrupted(self):
+        self.discard()
+
+    def discard(self):
+        if self.blob_writer is not None:
+            self.blob_writer.abort()
+            self.blob_writer = None
+
+    def reject(self, error: ValidationError):
+        result = FileValidationResult(self.file_name, error=error)
+        logger.warning("Invalid image %s: %s", self.file_name, result.message)
+        count_rejection(error)
+        if self.request is not None:
+            self.request.upload_rejections.append(result)
+        raise SkipFile()
+
+
+def discard_new_blobs(request, keep=()):
+    """
+    Removes the blobs the request's uploads added to the store, except the digests in keep.
+
+    Called once the request is done, so files that were rejected or never
+    handed to a task (e.g. a 503) do not stay in the store. Blobs that
+    existed before the request (created=False) are left alone, and so are
+    blobs a concurrent upload of the same bytes pinned meanwhile (see
+    BlobStore.delete).
+    """
+    for file in getattr(request, 'stored_uploads', []):
+        if file.created and file.digest not in keep:
+            file.close()
+            blob_store.delete(file.digest)
+
+
+class PipelinedUploadHandler(ValidatingUploadHandler):
+    """ValidatingUploadHandler that passes every stored file and rejection to callback as soon as its part ends."""
+
+    def __init__(self, request=None, callback=None):
+        super().__init__(request)
+        self.callback = callback
+
+    def file_complete(self, file_size):
+        file = super().file_complete(file_size)
+        if file is not None:
+            self.callback(file)
+        return file
+
+    def reject(self, error: ValidationError):
+        try:
+            super().reject(error)
+        finally:
+            self.callback(FileValidationResult(self.file_name, error=error))
@@ -1,12 +1,40 @@
-from django.urls import path
+from django.urls import path, register_converter
 
 
-from photos.views import UploadView, TaskStatusView
+from photos.views import (
+    UploadView, AsyncUploadView,
+    UploadSessionView, UploadSessionDetailView, UploadChunkView, UploadFinalizeView,
+    TaskStatusView, BatchStatusView, BatchEventsView, CacheStatsView, ImageListView, VariantView,
+)
+
+
+class SHA256Converter:
+    """Blob store key: hex SHA-256 digest."""
+    regex = '[0-9a-f]{64}'
+
+    def to_python(self, value):
+        return value
+
+    def to_url(self, value):
+        return value
+
+
+register_converter(SHA256Converter, 'sha256')
 
 urlpatterns = [
     path('', UploadView.as_view(), name='home'),
     path('upload/', UploadView.as_view(), name='upload'),
+    path('upload/async/', AsyncUploadView.as_view(), name='upload-async'),
+    path('uploads/', UploadSessionView.as_view(), name='upload-session'),
+    path('uploads/<uuid:upload_id>/', UploadSessionDetailView.as_view(), name='upload-session-detail'),
+    path('uploads/<uuid:upload_id>/files/<int:index>/', UploadChunkView.as_view(), name='upload-chunk'),
+    path('uploads/<uuid:upload_id>/finalize/', UploadFinalizeView.as_view(), name='upload-finalize'),
     path('task-status/', TaskStatusView.as_view(), name='task-status'),
+    path('batch-status/', BatchStatusView.as_view(), name='batch-status'),
+    path('batch-events/', BatchEventsView.as_view(), name='batch-events'),
+    path('images/', ImageListView.as_view(), name='image-list'),
+    path('variants/<sha256:digest>/<int:size>.<str:extension>', VariantView.as_view(), name='variant'),
+    path('cache-stats/', CacheStatsView.as_view(), name='cache-stats'),
 ]
 
 
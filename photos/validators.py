@@ -1,7 +1,12 @@
 import os
 import logging
+from concurrent.futures import ThreadPoolExecutor
+
 from django.core.exceptions import ValidationError
 from django.utils.translation import gettext_lazy as _
+from PIL import Image
+
+from .metrics import count_rejection
 
 logger = logging.getLogger(__name__)
 
@@ -9,7 +14,49 @@ ALLOWED_EXTENSIONS = ('jpg', 'jpeg', 'png', 'pdf', 'webp')
 MAX_SIZE = 5 * 1024 * 1024 # 5MB
 MAX_LENGTH = 255
 BATCH_MAX_COUNT = 100
+MAX_PIXELS = 40_000_000 # decompression bomb guard
+VALIDATION_WORKERS = 8
+
+# Format a file content must have for each allowed extension
+EXTENSION_FORMATS = {'jpg': 'jpeg', 'jpeg': 'jpeg', 'png': 'png', 'pdf': 'pdf', 'webp': 'webp'}
+SIGNATURE_LENGTH = 12
+
+
+def sniff_format(header: bytes) -> str | None:
+    """Detects the file format from its first SIGNATURE_LENGTH bytes (magic bytes)."""
+    if header.startswith(b'\xff\xd8\xff'):
+        return 'jpeg'
+    if header.startswith(b'\x89PNG\r\n\x1a\n'):
+        return 'png'
+    if header.startswith(b'%PDF-'):
+        return 'pdf'
+    if header[:4] == b'RIFF' and header[8:12] == b'WEBP':
+        return 'webp'
+    return None
+
+
+class FileValidationResult:
+    """Outcome of validating one uploaded file; error is the ValidationError of a rejected file."""
+
+    def __init__(self, name: str, image=None, error: ValidationError | None = None):
+        self.name = name
+        self.image = image
+        self.error = error
 
+    @property
+    def valid(self) -> bool:
+        return self.error is None
+
+    @property
+    def code(self) -> str | None:
+        return None if self.error is None else getattr(self.error, 'code', None)
+
+    @property
+    def message(self) -> str | None:
+        return None if self.error is None else ' '.join(self.error.messages)
+
+    def as_dict(self) -> dict:
+        return {'file_name': self.name, 'valid': self.valid, 'code': self.code, 'error': self.message}
 
 
 class ImageValidator:
@@ -17,18 +64,25 @@ class ImageValidator:
             self,
             allowed_extensions=ALLOWED_EXTENSIONS,
             max_size=MAX_SIZE,
-            max_length=MAX_LENGTH
+            max_length=MAX_LENGTH,
+            max_pixels=MAX_PIXELS
     ):
         self.allowed_extensions = allowed_extensions
         self.max_size = max_size
         self.max_length = max_length
+        self.max_pixels = max_pixels
 
     def __call__(self, image):
         """Validate a single image file"""
+        self.validate_metadata(image)
+        self.validate_content(image)
+        return True
+
+    def validate_metadata(self, image):
+        """Checks that need only the name and size, no file I/O."""
         self.validate_extension(image)
         self.validate_size(image)
         self.validate_name(image)
-        return True
 
     def validate_extension(self, image):
         ext = os.path.splitext(image.name)[1][1:].lower()
@@ -38,7 +92,8 @@ class ImageValidator:
                 params={
                     'ext': ext,
                     'allowed': ', '.join(self.allowed_extensions)
-                }
+                },
+                code='extension',
             )
 
     def validate_size(self, image):
@@ -48,47 +103,133 @@ class ImageValidator:
                 params={
                     'size': image.size / (1024 * 1024),
                     'max': self.max_size / (1024 * 1024)
-                }
+                },
+                code='size',
             )
 
+    def validate_signature(self, image, header: bytes):
+        ext = os.path.splitext(image.name)[1][1:].lower()
+        if sniff_format(header) != EXTENSION_FORMATS.get(ext):
+            raise ValidationError(
+                _("File content does not match extension '%(ext)s'"),
+                params={'ext': ext},
+                code='signature',
+            )
+
+    def validate_content(self, image):
+        """Check the signature and dimensions reading only the file header.
+
+        Pillow's open is lazy: it parses the header to get format and size
+        without decoding pixel data, so this costs a few KB of I/O per file.
+        """
+        image.seek(0)
+        try:
+            header = image.read(SIGNATURE_LENGTH)
+            self.validate_signature(image, header)
+            if sniff_format(header) == 'pdf':
+                return
+
+            image.seek(0)
+            try:
+                with Image.open(image) as decoded:
+                    width, height = decoded.size
+            except (Image.DecompressionBombError, OSError, SyntaxError, ValueError) as e:
+                raise ValidationError(
+                    _("Unreadable image data: %(error)s"),
+                    params={'error': str(e)},
+                    code='unreadable',
+                )
+
+            if width * height > self.max_pixels:
+                raise ValidationError(
+                    _("Image too large (%(pixels)d > %(max)d pixels)"),
+                    params={'pixels': width * height, 'max': self.max_pixels},
+                    code='pixels',
+                )
+        finally:
+            image.seek(0)
+
     def validate_name(self, image):
         if len(image.name) > self.max_length:
             raise ValidationError(
                 _("Name too long (%(length)d > %(max)d characters)"),
-                params={'length': len(image.name), 'max': self.max_length}
+                params={'length': len(image.name), 'max': self.max_length},
+                code='name',
             )
 
 
+def too_many_images(count: int, max_count: int = BATCH_MAX_COUNT) -> ValidationError:
+    return ValidationError(
+        _("Too many images (%(count)d > %(max)d)"),
+        params={'count': count, 'max': max_count},
+        code='count',
+    )
+
+
 class ImageBatchValidator:
-    def __init__(self, max_count=BATCH_MAX_COUNT):
+    def __init__(self, max_count=BATCH_MAX_COUNT, max_workers=VALIDATION_WORKERS):
         self.max_count = max_count
-
-    def __call__(self, images):
-        """Validate a batch of images"""
-        if len(images) > self.max_count:
-            raise ValidationError(
-                _("Too many images (%(count)d > %(max)d)"),
-                params={'count': len(images), 'max': self.max_count}
-            )
+        self.max_workers = max_workers
+
+    def __call__(self, images, rejected=()):
+        """Validate a batch of images, returns the valid ones"""
+        return self.accepted(self.validate(images, rejected))
+
+    def validate(self, images, rejected=()) -> list[FileValidationResult]:
+        """Validates a batch and returns one result per file, rejected files first.
+
+        Cheapest checks go first: the batch size is checked before any file,
+        name and size of every file before any content is read, and only
+        files that pass are handed to the thread pool for header reads.
+        rejected holds the results of files already rejected while they were
+        received (see photos.uploadhandlers); they count towards the batch size.
+        """
+        count = len(images) + len(rejected)
+        if count > self.max_count:
+            error = too_many_images(count, self.max_count)
+            count_rejection(error, len(images))
+            raise error
 
         validator = ImageValidator()
-        valid_images = []
-        error_messages = []
-
-        for image in images:
+        results = [FileValidationResult(image.name, image) for image in images]
+        for result in results:
             try:
-                validator(image)
-                valid_images.append(image)
-                logger.info("Valid image: %s", image.name)
+                validator.validate_metadata(result.image)
             except ValidationError as e:
-                logger.warning("Invalid image %s: %s", image.name, str(e))
-                error_messages.append(str(e))
+                result.error = e
 
+        def validate_content(result):
+            try:
+                validator.validate_content(result.image)
+            except ValidationError as e:
+                result.error = e
+
+        # Header reads overlap in a bounded thread pool; a single file is not worth a thread
+        pending = [result for result in results if result.valid]
+        if len(pending) == 1:
+            validate_content(pending[0])
+        elif pending:
+            with ThreadPoolExecutor(max_workers=min(self.max_workers, len(pending))) as pool:
+                list(pool.map(validate_content, pending))
+
+        for result in results:
+            if not result.valid:
+                logger.warning("Invalid image %s: %s", result.name, result.message)
+                count_rejection(result.error)
+        results = [*rejected, *results]
+        logger.info(
+            "Validated %s files: %s valid, %s rejected",
+            len(results), sum(result.valid for result in results), sum(not result.valid for result in results),
+        )
+        return results
+
+    def accepted(self, results: list[FileValidationResult]) -> list:
+        """The valid files of a batch; raises if there are none."""
+        valid_images = [result.image for result in results if result.valid]
         if not valid_images:
             # Include all individual error messages
             raise ValidationError(
                 _("No valid images provided. Errors: %(errors)s"),
-                params={'errors': ' | '.join(error_messages)}
+                params={'errors': ' | '.join(result.message for result in results)}
             )
-
-        return valid_images
\ No newline at end of file
+        return valid_images
@@ -0,0 +1,203 @@
+import io
+import os
+import logging
+import tempfile
+
+from django.conf import settings
+from django.core.cache import caches
+from PIL import Image, ImageOps
+
+from .storage import blob_store
+from .validators import MAX_PIXELS
+
+
+logger = logging.getLogger(__name__)
+
+# Pillow save format and content type per requested extension
+VARIANT_FORMATS = {
+    'webp': ('WEBP', 'image/webp'),
+    'jpeg': ('JPEG', 'image/jpeg'),
+    'png': ('PNG', 'image/png'),
+}
+# Eviction frees space down to this share of the cap, so it does not run on every write
+EVICTION_TARGET = 0.9
+# Only one process evicts at a time; the lock expires if it dies while scanning
+EVICTION_LOCK_TTL = 300
+
+
+class VariantCache:
+    """
+    Resized copies of stored originals, generated on first request.
+
+    The worker stores the IMAGE_VARIANT_SIZES webp variants here while it
+    processes an upload (see photos.handlers), so those are usually hits.
+
+    Variants live next to each other under <root>/<digest[:2]>/ as
+    <digest>_<size>.<format>. A file's mtime is its last use: hits touch it
+    and, once the directory grows past max_bytes, the least recently used
+    files are removed. Writes go through a temporary file and an atomic
+    rename, so concurrent requests for the same variant at worst render it
+    twice and never read a partial file.
+
+    The size of the directory is a counter in the RESULT_CACHE_ALIAS cache
+    (INCRBY on every write, DECRBY by what an eviction removed), shared by
+    all web and worker processes. Without the cache every write rescans
+    the directory instead.
+    """
+
+    size_prefix = 'variant-cache-bytes:'
+    lock_prefix = 'variant-cache-evicting:'
+
+    def __init__(self, root: str | None = None, max_bytes: int | None = None):
+        self._root = root
+        self._max_bytes = max_bytes
+
+    @property
+    def cache(self):
+        return caches[settings.RESULT_CACHE_ALIAS]
+
+    @property
+    def root(self) -> str:
+        return self._root or settings.VARIANT_CACHE_ROOT
+
+    @property
+    def max_bytes(self) -> int:
+        return self._max_bytes if self._max_bytes is not None else settings.VARIANT_CACHE_MAX_BYTES
+
+    def path(self, digest: str, size: int, extension: str) -> str:
+        return os.path.join(self.root, digest[:2], f"{digest}_{size}.{extension}")
+
+    @staticmethod
+    def etag(digest: str, size: int, extension: str) -> str:
+        """Variants are fully determined by the original, the parameters and the quality setting."""
+        return f'"{digest}-{size}-q{settings.IMAGE_VARIANT_QUALITY}.{extension}"'
+
+    def get(self, digest: str, size: int, extension: str) -> str:
+        """Returns the path of the variant, rendering it from the original on a miss.
+
+        Raises FileNotFoundError if the original is not stored and
+        PIL.UnidentifiedImageError if it is not an image.
+        """
+        path = self.path(digest, size, extension)
+        try:
+            os.utime(path)
+            return path
+        except FileNotFoundError:
+            pass
+
+        data = render_variant(digest, size, extension)
+        path = self.put(digest, size, extension, data)
+        logger.info("Variant %s rendered (%s bytes)", os.path.basename(path), len(data))
+        return path
+
+    def put(self, digest: str, size: int, extension: str, data: bytes) -> str:
+        """Stores an already rendered variant, e.g. one the worker made while processing the upload."""
+        path = self.path(digest, size, extension)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix='.tmp')
+        with os.fdopen(fd, 'wb') as file:
+            file.write(data)
+        try:
+            replaced = os.stat(path).st_size  # rendered twice concurrently
+        except FileNotFoundError:
+            replaced = 0
+        os.replace(tmp_path, path)
+
+        self._add(len(data) - replaced)
+        return path
+
+    def forget_size(self):
+        """Drops the shared size counter of the root, e.g. after its directory was removed."""
+        try:
+            self.cache.delete(self.size_prefix + self.root)
+        except Exception as e:
+            logger.warning("Variant cache counter unavailable: %s", e)
+
+    def _add(self, size: int):
+        """Counts written bytes and evicts once the cache directory outgrows max_bytes."""
+        key = self.size_prefix + self.root
+        try:
+            try:
+                total = self.cache.incr(key, size)
+            except ValueError:
+                # No counter yet (or it was lost): start from the directory, this write included
+                total = self._scanned_size()
+                if not self.cache.add(key, total, timeout=None):
+                    total = self.cache.incr(key, size)
+        except Exception as e:
+            logger.warning("Variant cache counter unavailable: %s", e)
+            if self._scanned_size() > self.max_bytes:
+                self._evict(int(self.max_bytes * EVICTION_TARGET))
+            return
+        if total <= self.max_bytes:
+            return
+
+        lock = self.lock_prefix + self.root
+        try:
+            if not self.cache.add(lock, 1, timeout=EVICTION_LOCK_TTL):
+                return  # another process is already evicting
+            try:
+                self.cache.decr(key, self._evict(int(self.max_bytes * EVICTION_TARGET)))
+            finally:
+                self.cache.delete(lock)
+        except Exception as e:
+            logger.warning("Variant cache counter unavailable: %s", e)
+
+    def _scanned_size(self) -> int:
+        return sum(size for _, size, _ in self._scan())
+
+    def _scan(self) -> list[tuple[float, int, str]]:
+        files = []
+        for directory, _, names in os.walk(self.root):
+            for name in names:
+                if name.endswith('.tmp'):
+                    continue  # another request is writing it; removing it would fail its os.replace
+                path = os.path.join(directory, name)
+                try:
+                    stat = os.stat(path)
+                except FileNotFoundError:
+                    continue  # evicted by another process
+                files.append((stat.st_mtime, stat.st_size, path))
+        return files
+
+    def _evict(self, target: int) -> int:
+        """Removes least recently used variants until the cache fits target; returns the bytes removed."""
+        files = sorted(self._scan())
+        total = sum(size for _, size, _ in files)
+        removed, removed_bytes = 0, 0
+        for _, size, path in files:
+            if total <= target:
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass  # removed by another process, which took it off the counter
+            else:
+                removed += 1
+                removed_bytes += size
+            total -= size
+        logger.info("Variant cache evicted %s files, %s bytes left", removed, total)
+        return removed_bytes
+
+
+def render_variant(digest: str, size: int, extension: str) -> bytes:
+    """Renders the original scaled to fit size x size pixels in the given format."""
+    image_format, _ = VARIANT_FORMATS[extension]
+    with blob_store.open(digest) as file, Image.open(file) as image:
+        if image.width * image.height > MAX_PIXELS:
+            raise ValueError(f"Image too large ({image.width * image.height} > {MAX_PIXELS} pixels)")
+        # JPEG is decoded straight at a reduced scale
+        image.draft('RGB', (size, size))
+        image = ImageOps.exif_transpose(image)
+        image.thumbnail((size, size), Image.Resampling.LANCZOS)
+
+        if image_format == 'JPEG':
+            image = image.convert('RGB')
+        elif image.mode not in ('RGB', 'RGBA'):
+            image = image.convert('RGBA' if 'A' in image.getbands() else 'RGB')
+        buffer = io.BytesIO()
+        image.save(buffer, image_format, quality=settings.IMAGE_VARIANT_QUALITY)
+        return buffer.getvalue()
+
+
+variant_cache = VariantCache()
@@ -1,58 +1,295 @@
+import io
+import json
+import asyncio
 import logging
 
+from asgiref.sync import sync_to_async
 from celery.result import AsyncResult
-from django.core.exceptions import ValidationError
-from django.http import JsonResponse
+from django.core.exceptions import TooManyFilesSent, ValidationError
+from django.conf import settings
+from django.http import FileResponse, HttpResponse, JsonResponse, QueryDict, StreamingHttpResponse
+from django.middleware.csrf import CsrfViewMiddleware
 from django.shortcuts import render
+from django.utils.cache import patch_cache_control
+from django.utils.decorators import method_decorator
+from django.views.decorators.csrf import csrf_exempt
+from django.views.decorators.http import condition
 from django.views.generic import View, DetailView
+from PIL import UnidentifiedImageError
+from prometheus_client import CONTENT_TYPE_LATEST
 
-from config.celery import check_celery_available
-from .tasks import image_task
-from .validators import ImageBatchValidator
+from config.celery import check_celery_available, run_in_broker_executor
+from .cache import result_cache
+from .listing import list_records, parse_bound, parse_fields
+from .metrics import count_rejection, generate_metrics
+from .resumable import OffsetMismatch, UnknownUpload, UploadSession
+from .status import (
+    batch_status, fetch_record_results, new_batch_id, restore_batch, save_batch,
+    stream_batch_events, supports_streaming, task_status_data,
+)
+from .storage import blob_store
+from .tasks import aenqueue_images, enqueue_images
+from .uploadhandlers import discard_new_blobs
+from .validators import ImageBatchValidator, BATCH_MAX_COUNT, too_many_images
+from .variants import VARIANT_FORMATS, render_variant, variant_cache
 
 
 logger = logging.getLogger(__name__)
 
+def store_image(image) -> str:
+    """Persists the bytes for the workers, identical files share one blob"""
+    digest = getattr(image, 'digest', None)
+    created = getattr(image, 'created', None)
+    if digest is None:
+        digest, created = blob_store.save(image)
+    if not created:
+        logger.info("Repeat upload of %s (%s)", image.name, digest)
+    return digest
+
+
+def split_cached(valid_images, digests, cached) -> tuple[list[dict], list[tuple[str, str]]]:
+    """Separates files answered from the result cache from the (file_name, digest) pairs to process."""
+    cached_files = []
+    files = []
+    for image, digest in zip(valid_images, digests):
+        if digest in cached:
+            cached_files.append({'file_name': image.name, 'digest': digest, 'result': cached[digest]})
+        else:
+            files.append((image.name, digest))
+    return cached_files, files
+
+
+def upload_data(batch_id, task_ids, files, cached_files, results) -> dict:
+    logger.info("Successfully scheduled %s tasks, %s cached", len(task_ids), len(cached_files))
+    return {
+        'batch_id': batch_id,
+        'task_ids': task_ids,
+        'valid_images': [file_name for file_name, _ in files],
+        'digests': [digest for _, digest in files],
+        'cached': cached_files,
+        'rejected': [result.as_dict() for result in results if not result.valid],
+    }
+
+
+def upload_response(batch_id, task_ids, files, cached_files, results) -> JsonResponse:
+    return JsonResponse(upload_data(batch_id, task_ids, files, cached_files, results), status=202 if task_ids else 200)
+
+
+def upload_error_data(error: Exception) -> tuple[dict, int]:
+    """The error body and status code of a failed upload."""
+    if isinstance(error, ConnectionError):
+        logger.error("Connection error: %s", str(error))
+        return {"error": "Service unavailable. Please try again later."}, 503
+    if isinstance(error, ValidationError):
+        return {"error": str(error)}, 400
+    logger.exception("Unexpected upload error", exc_info=error)
+    return {"error": "Internal server error"}, 500
+
+
+def upload_error_response(error: Exception) -> JsonResponse:
+    data, status = upload_error_data(error)
+    return JsonResponse(data, status=status)
+
+
+def files_limit_error() -> ValidationError:
+    """The 'count' rejection of a body Django's parser gave up on (DATA_UPLOAD_MAX_NUMBER_FILES)."""
+    error = too_many_images(settings.DATA_UPLOAD_MAX_NUMBER_FILES + 1)
+    count_rejection(error)
+    return error
+
+
+def read_uploads(request) -> tuple[list, list]:
+    """Parses the multipart body; ValidatingUploadHandler validates and stores every file while reading it."""
+    try:
+        images = request.FILES.getlist('images')
+    except TooManyFilesSent:
+        raise files_limit_error() from None
+    # Files rejected by ValidatingUploadHandler while they were received
+    return images, getattr(request, 'upload_rejections', [])
+
+
 class UploadView(View):
     def get(self, request):
         return render(request, "home.html")
 
     def post(self,request):
+        # Digests handed to the workers or the result cache; other new blobs are removed afterwards
+        kept = set()
         try:
             # Check Celery status first
             check_celery_available()
 
-            if 'images' not in request.FILES:
+            images, rejected = read_uploads(request)
+            if not images and not rejected:
                 return JsonResponse({"error": "No files provided"}, status=400)
 
-            images = request.FILES.getlist('images')
             # Validate all images at once
-            valid_images = ImageBatchValidator()(images)
+            validator = ImageBatchValidator()
+            results = validator.validate(images, rejected=rejected)
+            valid_images = validator.accepted(results)
+
+            digests = [store_image(image) for image in valid_images]
+            kept.update(digests)
+
+            # Files processed before are answered from the result cache
+            cached_files, files = split_cached(valid_images, digests, result_cache.get_many(digests))
 
             # Only process valid images
-            task_ids = []
-            for image in valid_images:
-                logger.info("Processing file: %s", image.name)
-                task = image_task.delay(image.name)
-                task_ids.append(task.id)
-
-            logger.info("Successfully scheduled %s tasks", len(task_ids))
-            data = {
-                'task_ids': task_ids,
-                'valid_images': [image.name for image in valid_images]
-            }
-            return JsonResponse(data,status=202)
+            batch_id = new_batch_id() if files else None
+            task_ids = enqueue_images(files, batch_id) if files else []
+            if task_ids:
+                save_batch(task_ids, batch_id)
+
+            return upload_response(batch_id, task_ids, files, cached_files, results)
+
+        except Exception as e:
+            return upload_error_response(e)
+        finally:
+            discard_new_blobs(request, kept)
+
+
+def check_csrf_header(request) -> HttpResponse | None:
+    """CsrfViewMiddleware's checks with the token taken from the X-CSRFToken header only.
+
+    On a POST the middleware reads request.POST for a form token, which
+    parses (and with ValidatingUploadHandler, stores) the whole multipart
+    body before the view runs. An empty POST is set for the check and
+    removed afterwards, so the view parses the body itself.
+    """
+    request._post = QueryDict()
+    try:
+        return CsrfViewMiddleware(lambda request: None).process_view(request, None, (), {})
+    finally:
+        del request._post
+
+
+@method_decorator(csrf_exempt, name='dispatch')
+class AsyncUploadView(View):
+    """
+    UploadView for ASGI servers (config.asgi).
+
+    The request never holds a thread while it waits: body parsing,
+    validation and blob writes run in asgiref's thread pool, broker pings
+    and publishes in the bounded broker executor (see
+    config.celery.broker_executor), and the messages of a batch are
+    published concurrently. The CSRF token is checked from the header
+    (check_csrf_header), otherwise the middleware would parse the body in
+    its single sync thread before the view is called.
+    """
 
-        except ConnectionError as e:
-            logger.error("Connection error: %s", str(e))
-            return JsonResponse({"error": "Service unavailable. Please try again later."}, status=503)
+    async def get(self, request):
+        return render(request, "home.html")
+
+    async def post(self, request):
+        forbidden = check_csrf_header(request)
+        if forbidden is not None:
+            return forbidden
+        kept = set()
+        try:
+            await run_in_broker_executor(check_celery_available)
+
+            images, rejected = await sync_to_async(read_uploads, thread_sensitive=False)(request)
+            if not images and not rejected:
+                return JsonResponse({"error": "No files provided"}, status=400)
+
+            validator = ImageBatchValidator()
+            results = await sync_to_async(validator.validate, thread_sensitive=False)(images, rejected=rejected)
+            valid_images = validator.accepted(results)
+
+            digests = await asyncio.gather(*(
+                sync_to_async(store_image, thread_sensitive=False)(image) for image in valid_images
+            ))
+            kept.update(digests)
+
+            # The database fallback of the result cache needs the thread that owns the connection
+            cached = await sync_to_async(result_cache.get_many)(digests)
+            cached_files, files = split_cached(valid_images, digests, cached)
+
+            batch_id = new_batch_id() if files else None
+            task_ids = await aenqueue_images(files, batch_id) if files else []
+            if task_ids:
+                await run_in_broker_executor(save_batch, task_ids, batch_id)
+
+            return upload_response(batch_id, task_ids, files, cached_files, results)
+
+        except Exception as e:
+            return upload_error_response(e)
+        finally:
+            await sync_to_async(discard_new_blobs, thread_sensitive=False)(request, kept)
+
+
+class UploadSessionView(View):
+    """
+    Resumable uploads (see photos.resumable.UploadSession).
 
-        except ValidationError as e:
-            return JsonResponse({"error": str(e)}, status=400)
+    POST {"files": [{"name": ..., "size": ...}]} starts a session; every
+    file is then sent with PUT .../files/<index> in chunks carrying an
+    Upload-Offset header, GET .../<upload_id> reports the acknowledged
+    offsets to resume from, and POST .../finalize completes the batch.
+    """
 
+    def post(self, request):
+        try:
+            check_celery_available()
+            try:
+                files = json.loads(request.body).get('files')
+            except (ValueError, AttributeError):
+                return JsonResponse({"error": "Invalid JSON body"}, status=400)
+
+            session, results = UploadSession.create(files or [])
+            data = session.status()
+            data['rejected'] = [result.as_dict() for result in results if not result.valid]
+            return JsonResponse(data, status=201)
+
+        except Exception as e:
+            return upload_error_response(e)
+
+
+class UploadSessionDetailView(View):
+    def get(self, request, upload_id):
+        try:
+            return JsonResponse(UploadSession(str(upload_id)).status(), status=200)
+        except UnknownUpload as e:
+            return JsonResponse({"error": str(e)}, status=404)
+
+
+class UploadChunkView(View):
+    def put(self, request, upload_id, index):
+        try:
+            offset = int(request.headers['Upload-Offset'])
+            length = int(request.headers['Content-Length'])
+        except (KeyError, ValueError):
+            return JsonResponse({"error": "Upload-Offset and Content-Length headers are required"}, status=400)
+        if length > settings.UPLOAD_CHUNK_MAX_SIZE:
+            return JsonResponse(
+                {"error": f"Chunk too large ({length} > {settings.UPLOAD_CHUNK_MAX_SIZE} bytes)"}, status=413
+            )
+
+        try:
+            data = UploadSession(str(upload_id)).write_chunk(index, offset, request, length)
+            response = JsonResponse(data, status=200)
+            response['Upload-Offset'] = data['offset']
+            return response
+        except UnknownUpload as e:
+            return JsonResponse({"error": str(e)}, status=404)
+        except OffsetMismatch as e:
+            response = JsonResponse({"error": str(e), "offset": e.offset}, status=409)
+            response['Upload-Offset'] = e.offset
+            return response
         except Exception as e:
-            logger.exception("Unexpected upload error")
-            return JsonResponse({"error": "Internal server error"}, status=500)
+            return upload_error_response(e)
+
+
+class UploadFinalizeView(View):
+    def post(self, request, upload_id):
+        try:
+            data = UploadSession(str(upload_id)).finalize()
+            logger.info("Successfully scheduled %s tasks, %s cached", len(data['task_ids']), len(data['cached']))
+            return JsonResponse(data, status=202 if data['task_ids'] else 200)
+        except UnknownUpload as e:
+            return JsonResponse({"error": str(e)}, status=404)
+        except Exception as e:
+            return upload_error_response(e)
 
 
 class TaskStatusView(DetailView):
@@ -60,6 +297,12 @@ class TaskStatusView(DetailView):
         try:
             task_id = request.GET.get('task_id')
             task = AsyncResult(task_id)
+            if task.status == 'PENDING':
+                # The backend entry may have expired: finished tasks have a record
+                meta = fetch_record_results([task_id]).get(task_id)
+                if meta is not None:
+                    return JsonResponse(task_status_data(meta), status=200)
+
             response_data = {
                 'status': task.status,
                 'result': task.result if task.status == 'SUCCESS' else None
@@ -74,4 +317,148 @@ class TaskStatusView(DetailView):
             return JsonResponse({'Error': str(e)}, status=500)
 
 
+class BatchStatusView(View):
+    def get(self, request):
+        try:
+            batch_id = request.GET.get('batch_id')
+            if batch_id:
+                task_ids = restore_batch(batch_id)
+                if task_ids is None:
+                    return JsonResponse({'error': 'Unknown batch'}, status=404)
+            else:
+                task_ids = [task_id for task_id in request.GET.get('task_ids', '').split(',') if task_id]
+
+            if not task_ids:
+                return JsonResponse({'error': 'No task ids provided'}, status=400)
+            if len(task_ids) > BATCH_MAX_COUNT:
+                return JsonResponse(
+                    {'error': f'Too many task ids ({len(task_ids)} > {BATCH_MAX_COUNT})'}, status=400
+                )
+
+            data = batch_status(task_ids, request.GET.get('cursor', ''))
+            return JsonResponse(data, status=200)
+
+        except Exception as e:
+            logger.error("Unexpected error: %s", str(e))
+            return JsonResponse({'Error': str(e)}, status=500)
+
+
+class BatchEventsView(View):
+    """Streams state transitions of an upload batch as Server-Sent Events.
+
+    Meant to be served through config.asgi so an open stream does not hold a worker thread.
+    """
+
+    async def get(self, request):
+        batch_id = request.GET.get('batch_id')
+        if not batch_id:
+            return JsonResponse({'error': 'No batch id provided'}, status=400)
+        if not supports_streaming():
+            return JsonResponse({'error': 'Streaming requires a Redis result backend'}, status=501)
+
+        try:
+            task_ids = await sync_to_async(restore_batch)(batch_id)
+        except Exception as e:
+            logger.error("Unexpected error: %s", str(e))
+            return JsonResponse({'Error': str(e)}, status=500)
+        if task_ids is None:
+            return JsonResponse({'error': 'Unknown batch'}, status=404)
+
+        response = StreamingHttpResponse(stream_batch_events(task_ids), content_type='text/event-stream')
+        response['Cache-Control'] = 'no-cache'
+        response['X-Accel-Buffering'] = 'no'
+        return response
+
+
+class ImageListView(View):
+    """Processed images, newest first, one keyset-paginated page per request.
+
+    Query parameters: batch_id, status, since/until (ISO date or datetime),
+    fields (comma separated), limit and the next_cursor of the previous page.
+    """
+
+    def get(self, request):
+        try:
+            params = request.GET
+            since, until = params.get('since'), params.get('until')
+            limit = params.get('limit')
+            data = list_records(
+                batch_id=params.get('batch_id'),
+                status=params.get('status'),
+                since=parse_bound(since) if since else None,
+                until=parse_bound(until, end=True) if until else None,
+                fields=parse_fields(params.get('fields')),
+                cursor=params.get('cursor'),
+                limit=int(limit) if limit else None,
+            )
+            return JsonResponse(data, status=200)
 
+        except ValueError as e:
+            return JsonResponse({'error': str(e)}, status=400)
+
+        except Exception as e:
+            logger.error("Unexpected error: %s", str(e))
+            return JsonResponse({'Error': str(e)}, status=500)
+
+
+def variant_etag(request, digest, size, extension):
+    if size not in settings.VARIANT_SIZES or extension not in VARIANT_FORMATS:
+        return None
+    return variant_cache.etag(digest, size, extension)
+
+
+@method_decorator(condition(etag_func=variant_etag), name='get')
+class VariantView(View):
+    """Resized copy of a stored original, e.g. /api/variants/<sha256>/256.webp.
+
+    Variants are rendered on the first request and then served from the
+    disk cache. The URL is content-addressed, so the response is immutable:
+    browsers keep it for VARIANT_CACHE_MAX_AGE and a revalidation with
+    If-None-Match is answered with 304 before the cache is even looked up.
+    """
+
+    def get(self, request, digest, size, extension):
+        if size not in settings.VARIANT_SIZES:
+            return JsonResponse(
+                {'error': f"Unsupported size {size}. Allowed: {', '.join(map(str, settings.VARIANT_SIZES))}"},
+                status=400,
+            )
+        if extension not in VARIANT_FORMATS:
+            return JsonResponse(
+                {'error': f"Unsupported format '{extension}'. Allowed: {', '.join(VARIANT_FORMATS)}"}, status=400
+            )
+
+        try:
+            path = variant_cache.get(digest, size, extension)
+            try:
+                file = open(path, 'rb')
+            except FileNotFoundError:
+                # Evicted by another process between the lookup and the open
+                file = io.BytesIO(render_variant(digest, size, extension))
+        except FileNotFoundError:
+            return JsonResponse({'error': 'Unknown image'}, status=404)
+        except (UnidentifiedImageError, ValueError) as e:
+            return JsonResponse({'error': f"Cannot render a variant: {e}"}, status=415)
+        except Exception as e:
+            logger.error("Unexpected error: %s", str(e))
+            return JsonResponse({'Error': str(e)}, status=500)
+
+        response = FileResponse(file, content_type=VARIANT_FORMATS[extension][1])
+        patch_cache_control(response, public=True, max_age=settings.VARIANT_CACHE_MAX_AGE, immutable=True)
+        return response
+
+
+class CacheStatsView(View):
+    def get(self, request):
+        try:
+            return JsonResponse(result_cache.stats(), status=200)
+        except Exception as e:
+            logger.error("Unexpected error: %s", str(e))
+            return JsonResponse({'Error': str(e)}, status=500)
+
+
+class MetricsView(View):
+    """Prometheus scrape endpoint: metrics of the web server and Celery workers."""
+
+    def get(self, request):
+        return HttpResponse(generate_metrics(), content_type=CONTENT_TYPE_LATEST)
@@ -0,0 +1,138 @@
+import logging
+import threading
+from concurrent.futures import Future
+
+from celery.signals import worker_init
+from django.conf import settings
+
+from .metrics import DB_WRITE_DURATION
+from .models import ImageRecord
+
+
+logger = logging.getLogger(__name__)
+
+
+# Pools that run several tasks in one process; only there can inserts of concurrent tasks be coalesced
+CONCURRENT_POOLS = ('thread', 'threads', 'gevent', 'eventlet')
+BULK_MODES = {'1': True, '0': False, 'auto': None}
+
+# Overwritten when a record with the same task_id exists; created_at keeps the first write
+UPSERT_FIELDS = [
+    field.name for field in ImageRecord._meta.concrete_fields
+    if field.name not in ('id', 'task_id', 'created_at')
+]
+
+
+def upsert(records: list[ImageRecord], batch_size: int):
+    """Inserts records; a retried or redelivered task updates its existing row instead of adding one."""
+    ImageRecord.objects.bulk_create(
+        records, batch_size=batch_size,
+        update_conflicts=True, unique_fields=['task_id'], update_fields=UPSERT_FIELDS,
+    )
+
+
+class ImageRecordWriter:
+    """Coalesces ImageRecord inserts from concurrent tasks into bulk_create flushes.
+
+    The first caller of an empty buffer becomes the leader: it waits until the
+    buffer reaches batch_size or flush_interval elapses, then flushes everything
+    buffered so far. Every caller blocks until its own record has a primary key.
+    Writes are upserts on task_id (see upsert()), so one task never gets two rows.
+
+    bulk=None ("auto") turns coalescing on only in a worker whose pool runs
+    tasks concurrently in one process (see configure_for_pool); in a prefork
+    child every leader would wait the whole interval for a batch of one.
+    The leader also stops waiting once as many records are buffered as tasks
+    can run at a time.
+    """
+
+    def __init__(self, bulk: bool | None = True, batch_size: int = 50, flush_interval: float = 0.05,
+                 concurrency: int | None = None):
+        self.auto = bulk is None
+        self.bulk = bool(bulk)
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.concurrency = concurrency
+        self._lock = threading.Lock()
+        self._pending: list[tuple[ImageRecord, Future]] = []
+        self._full = threading.Event()
+
+    def write(self, **fields) -> ImageRecord:
+        if not self.bulk:
+            with DB_WRITE_DURATION.labels(mode='single').time():
+                return self._save(ImageRecord(**fields))
+
+        record = ImageRecord(**fields)
+        future = Future()
+        with self._lock:
+            self._pending.append((record, future))
+            leader = len(self._pending) == 1
+            if leader:
+                self._full = threading.Event()
+            if len(self._pending) >= min(self.batch_size, self.concurrency or self.batch_size):
+                self._full.set()
+            full = self._full
+
+        if leader:
+            full.wait(self.flush_interval)
+            self.flush()
+        return future.result()
+
+    def configure_for_pool(self, pool, concurrency: int):
+        """Adapts the writer to the worker pool (a Celery pool alias or class) it runs in."""
+        name = pool if isinstance(pool, str) else pool.__module__.rsplit('.', 1)[-1]
+        self.concurrency = concurrency if name in CONCURRENT_POOLS else 1
+        if self.auto:
+            self.bulk = self.concurrency > 1
+        logger.info("ImageRecord writer: %s pool, concurrency %s, bulk %s", name, self.concurrency, self.bulk)
+
+    def write_many(self, rows: list[dict]) -> list[ImageRecord]:
+        """Inserts rows produced together (e.g. by one batch task) without waiting for other writers."""
+        records = [ImageRecord(**fields) for fields in rows]
+        if not self.bulk:
+            for record in records:
+                with DB_WRITE_DURATION.labels(mode='single').time():
+                    self._save(record)
+            return records
+        if records:
+            with DB_WRITE_DURATION.labels(mode='batch').time():
+                upsert(records, self.batch_size)
+        return records
+
+    def _save(self, record: ImageRecord) -> ImageRecord:
+        if record.task_id is None:
+            record.save()
+        else:
+            upsert([record], 1)
+        return record
+
+    def flush(self):
+        with self._lock:
+            pending, self._pending = self._pending, []
+        if not pending:
+            return
+
+        records = [record for record, _ in pending]
+        try:
+            with DB_WRITE_DURATION.labels(mode='bulk').time():
+                upsert(records, self.batch_size)
+        except Exception as e:
+            logger.error("Bulk insert of %s records failed: %s", len(records), e)
+            for _, future in pending:
+                future.set_exception(e)
+        else:
+            logger.info("Bulk inserted %s records", len(records))
+            for record, future in pending:
+                future.set_result(record)
+
+
+image_record_writer = ImageRecordWriter(
+    bulk=BULK_MODES[settings.IMAGE_RECORD_BULK_CREATE],
+    batch_size=settings.IMAGE_RECORD_BATCH_SIZE,
+    flush_interval=settings.IMAGE_RECORD_FLUSH_INTERVAL,
+)
+
+
+@worker_init.connect
+def _configure_writer(sender=None, **kwargs):
+    image_record_writer.configure_for_pool(sender.pool_cls, sender.concurrency)
@@ -139,8 +139,19 @@ document.addEventListener('DOMContentLoaded', function() {
 
             const data = await response.json();
 
-            if (data.task_ids && data.valid_images) {
-                monitorTasks(data.task_ids, data.valid_images);
+            // Files processed before are answered right away
+            const cachedTasks = new Set();
+            (data.cached || []).forEach((item, index) => {
+                renderTaskResult(`cached-${index}`, item.file_name, { status: 'SUCCESS', result: item.result }, cachedTasks);
+            });
+
+            if (data.batch_id && data.task_ids && data.valid_images) {
+                streamTasks(data.batch_id, data.task_ids, data.valid_images);
+            } else if (data.cached && data.cached.length > 0) {
+                progressBar.style.width = '100%';
+                statusDiv.textContent = 'All tasks completed!';
+                statusDiv.className = 'success';
+                resetUploadButton();
             } else {
                 throw new Error('Invalid server response format');
             }
@@ -153,68 +164,73 @@ document.addEventListener('DOMContentLoaded', function() {
         }
     }
 
-    // Task monitoring - now matches task IDs with their filenames
-    async function monitorTasks(taskIds, validImageNames) {
+    // Task monitoring - server pushes state changes, falls back to polling if the stream fails
+    function streamTasks(batchId, taskIds, validImageNames) {
+        if (!window.EventSource) {
+            monitorTasks(batchId, taskIds, validImageNames);
+            return;
+        }
         const statusDiv = document.getElementById('status');
-        const resultsDiv = document.getElementById('results');
         const progressBar = document.getElementById('progressBar');
-        const uploadButton = document.getElementById('uploadButton');
 
-        let completedTasks = 0;
         const totalTasks = taskIds.length;
+        const fileNames = new Map(taskIds.map((id, index) => [id, validImageNames[index] || `File ${index + 1}`]));
         const processedTasks = new Set();
+        const source = new EventSource(`/api/batch-events/?${new URLSearchParams({ batch_id: batchId })}`);
+
+        source.addEventListener('status', event => {
+            const res = JSON.parse(event.data);
+            renderTaskResult(res.task_id, fileNames.get(res.task_id), res, processedTasks);
+            const progress = Math.min(100, Math.round((processedTasks.size / totalTasks) * 100));
+            progressBar.style.width = `${progress}%`;
+        });
+
+        source.addEventListener('done', event => {
+            source.close();
+            const data = JSON.parse(event.data);
+            if (data.completed >= data.total) {
+                statusDiv.textContent = 'All tasks completed!';
+                statusDiv.className = 'success';
+                resetUploadButton();
+            } else {
+                monitorTasks(batchId, taskIds, validImageNames, processedTasks);
+            }
+        });
+
+        source.onerror = () => {
+            source.close();
+            monitorTasks(batchId, taskIds, validImageNames, processedTasks);
+        };
+    }
+
+    // Task monitoring - one batch status request per poll, only changed tasks are returned
+    async function monitorTasks(batchId, taskIds, validImageNames, processedTasks = new Set()) {
+        const statusDiv = document.getElementById('status');
+        const progressBar = document.getElementById('progressBar');
+
+        const totalTasks = taskIds.length;
+        const fileNames = new Map(taskIds.map((id, index) => [id, validImageNames[index] || `File ${index + 1}`]));
+        let cursor = '';
 
         const checkStatus = async () => {
             try {
-                const results = await Promise.all(
-                    taskIds.map(id =>
-                        fetch(`/api/task-status/?task_id=${id}`)
-                            .then(res => res.json())
-                            .catch(() => ({ status: 'FAILURE' }))
-                    )
-                );
-
-                // Update progress based on ACTUAL tasks created (not original files)
-                const newCompleted = results.filter(r => r.status === 'SUCCESS' || r.status === 'FAILURE').length;
-                if (newCompleted > completedTasks) {
-                    completedTasks = newCompleted;
-                    const progress = Math.min(100, Math.round((completedTasks / totalTasks) * 100));
-                    progressBar.style.width = `${progress}%`;
+                const params = new URLSearchParams({ batch_id: batchId, cursor: cursor });
+                const response = await fetch(`/api/batch-status/?${params}`);
+                if (!response.ok) {
+                    throw new Error(`Batch status request failed (${response.status})`);
                 }
+                const data = await response.json();
+                cursor = data.cursor;
 
-                // Process results with proper filename matching
-                results.forEach((res, index) => {
-                    if ((res.status === 'SUCCESS' || res.status === 'FAILURE') && !processedTasks.has(taskIds[index])) {
-                        processedTasks.add(taskIds[index]);
-
-                        const resultDiv = document.createElement('div');
-                        resultDiv.className = 'result-item';
-                        resultDiv.id = `task-${taskIds[index]}`;
-
-                        // Get the corresponding filename
-                        const fileName = validImageNames[index] || `File ${index + 1}`;
-
-                        if (res.status === 'SUCCESS') {
-                            resultDiv.innerHTML = `
-                                <p><strong>File:</strong> ${fileName}</p>
-                                <p><strong>Status:</strong> <span class="success">Success</span></p>
-                                ${res.result?.file_name ? `<p><strong>Processed As:</strong> ${res.result.file_name}</p>` : ''}
-                                ${res.result?.image_random_num ? `<p><strong>Result:</strong> ${res.result.image_random_num}</p>` : ''}
-                            `;
-                        } else {
-                            resultDiv.innerHTML = `
-                                <p><strong>File:</strong> ${fileName}</p>
-                                <p><strong>Status:</strong> <span class="error">Failed</span></p>
-                                <p><strong>Error:</strong> ${res.error || 'Unknown error'}</p>
-                            `;
-                        }
-
-                        resultsDiv.appendChild(resultDiv);
-                    }
+                Object.entries(data.tasks).forEach(([taskId, res]) => {
+                    renderTaskResult(taskId, fileNames.get(taskId), res, processedTasks);
                 });
 
+                const progress = Math.min(100, Math.round((data.completed / totalTasks) * 100));
+                progressBar.style.width = `${progress}%`;
+
                 // Check completion
-                if (completedTasks >= totalTasks) {
+                if (data.completed >= totalTasks) {
                     statusDiv.textContent = 'All tasks completed!';
                     statusDiv.className = 'success';
                     resetUploadButton();
@@ -233,6 +249,37 @@ document.addEventListener('DOMContentLoaded', function() {
         checkStatus();
     }
 
+    // Renders a finished task once
+    function renderTaskResult(taskId, fileName, res, processedTasks) {
+        if ((res.status !== 'SUCCESS' && res.status !== 'FAILURE') || processedTasks.has(taskId)) {
+            return;
+        }
+        processedTasks.add(taskId);
+
+        const resultsDiv = document.getElementById('results');
+        const resultDiv = document.createElement('div');
+        resultDiv.className = 'result-item';
+        resultDiv.id = `task-${taskId}`;
+
+        if (res.status === 'SUCCESS') {
+            resultDiv.innerHTML = `
+                <p><strong>File:</strong> ${fileName}</p>
+                <p><strong>Status:</strong> <span class="success">Success</span></p>
+                ${res.result?.file_name ? `<p><strong>Processed As:</strong> ${res.result.file_name}</p>` : ''}
+                ${res.result?.image_random_num ? `<p><strong>Result:</strong> ${res.result.image_random_num}</p>` : ''}
+                ${res.result?.width ? `<p><strong>Size:</strong> ${res.result.width}×${res.result.height} ${res.result.format}</p>` : ''}
+            `;
+        } else {
+            resultDiv.innerHTML = `
+                <p><strong>File:</strong> ${fileName}</p>
+                <p><strong>Status:</strong> <span class="error">Failed</span></p>
+                <p><strong>Error:</strong> ${res.error || 'Unknown error'}</p>
+            `;
+        }
+
+        resultsDiv.appendChild(resultDiv);
+    }
+
     // Helper function to reset upload button
     function resetUploadButton() {
         const uploadButton = document.getElementById('uploadButton');